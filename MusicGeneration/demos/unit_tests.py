@@ -7,8 +7,9 @@ import unittest
 
 from . import *
 from MusicGeneration.rhythm import fourfour
-from MusicGeneration.instruments import WaveInstrument, DefaultDrumkitInstrument, PrinterInstrument
+from MusicGeneration.instruments import WaveInstrument, DefaultDrumkitInstrument, PrinterInstrument, ProcessInstrument
 from MusicGeneration.sample_generators import SAMPLING_RATE, generators
+from MusicGeneration.sample_generators.parallel import ParallelMixerGenerator
 # from MusicGeneration.sample_generators.envelopes import VolumeEnvelope
 from MusicGeneration.rhythm.interval_sequences import SimpleIntervalGenerator, ParametricIntervalGenerator
 from MusicGeneration.theory.tone_sequences import (CyclicMelodyGenerator, RandomWalkMelodyGenerator,
@@ -311,7 +312,15 @@ class TestSongGeneration():
         # Setup to instruments
         drumkit = DefaultDrumkitInstrument(bpm, phrase=None, sampling_rate=SAMPLING_RATE)
         piano = WaveInstrument(bpm, phrase=None, sampling_rate=SAMPLING_RATE, wave_class=generators.SineWaveGenerator)
-        mixer = generators.MixerGenerator([drumkit, piano], scaling=[0.3, 0.3])
+        # Set to render each instrument in its own worker process.
+        use_parallel_mix = False
+        if use_parallel_mix:
+            # Render each instrument on its own core (same output as the serial mix).
+            drumkit = ProcessInstrument(drumkit)
+            piano = ProcessInstrument(piano)
+            mixer = ParallelMixerGenerator([drumkit, piano], scaling=[0.3, 0.3])
+        else:
+            mixer = generators.MixerGenerator([drumkit, piano], scaling=[0.3, 0.3])
         # mixer = generators.MixerGenerator([drumkit], scaling=0.3)
 
         # Assign to instruments
@@ -367,6 +376,8 @@ class TestSongGeneration():
                 data = mixer.get(int(SAMPLING_RATE * measure_time))
             wave_file.writeData(data)
         wave_file.close()
+        if use_parallel_mix:
+            mixer.close()
         PlaySoundIfWindows(filename)
 
 
@@ -1,27 +1,207 @@
 """Instrument Library: Classes that produce wave data from musical Phrases."""
 
+import heapq
+import itertools
 import os
+import threading
+import time
+import numpy
 from MusicGeneration.composers.events import EventReceiver
 from MusicGeneration.rhythm import TimeSignature
 from MusicGeneration.music import Phrase
-from MusicGeneration.sample_generators import generators, envelopes, SAMPLING_RATE
+from MusicGeneration.sample_generators import generators, envelopes, parallel, SAMPLING_RATE
+from MusicGeneration.sample_generators.sample_banks import ArrayCache, sample_bank
 from MusicGeneration.theory.utils import ToneToFrequency
 
 
+DEFAULT_PHRASE_QUEUE_SIZE = 16
+DRY_POLICIES = ("repeat", "silence")
+QUEUE_MODES = ("latest", "fifo")
+
+
+class PhraseQueue:
+    """A single-producer, single-consumer queue of phrases.
+
+    In "fifo" mode, every phrase put is played in turn. The composer's
+    thread only ever advances the put count and the render thread only
+    ever advances the take count, so neither side takes a lock or waits
+    for the other. Phrases put while the queue is full are dropped (put()
+    returns False).
+
+    In "latest" mode, a phrase replaces any that has not been taken yet.
+    This suits composers that re-send an updated phrase whenever one of
+    their inputs changes (e.g. MixerComposer), where only the last one
+    sent before the phrase boundary should play. The pending phrase and
+    its sequence number are swapped in as one reference, so this is
+    lock-free too.
+
+    num_dropped counts the phrases that were dropped or replaced.
+    """
+    def __init__(self, capacity=DEFAULT_PHRASE_QUEUE_SIZE, mode="latest"):
+        assert mode in QUEUE_MODES
+        self._mode = mode
+        self._phrases = [None] * capacity
+        self._num_put = 0
+        self._num_taken = 0
+        self._num_dropped = 0
+        # For "latest" mode: (sequence number, phrase) of the newest phrase.
+        self._latest = (0, None)
+
+    def put(self, phrase):
+        """Appends a phrase, returning False if the queue was full."""
+        if self._mode == "latest":
+            if len(self):
+                self._num_dropped += 1
+            self._latest = (self._num_put + 1, phrase)
+            self._num_put += 1
+            return True
+        if self._num_put - self._num_taken >= len(self._phrases):
+            self._num_dropped += 1
+            return False
+        self._phrases[self._num_put % len(self._phrases)] = phrase
+        self._num_put += 1
+        return True
+
+    def take(self):
+        """Removes and returns the oldest phrase, or None if there is none."""
+        if self._mode == "latest":
+            (sequence, phrase) = self._latest
+            if sequence == self._num_taken:
+                return None
+            self._num_taken = sequence
+            return phrase
+        if self._num_taken == self._num_put:
+            return None
+        index = self._num_taken % len(self._phrases)
+        (phrase, self._phrases[index]) = (self._phrases[index], None)
+        self._num_taken += 1
+        return phrase
+
+    @property
+    def mode(self): return self._mode
+
+    @property
+    def capacity(self): return len(self._phrases) if self._mode == "fifo" else 1
+
+    @property
+    def num_dropped(self): return self._num_dropped
+
+    def __len__(self):
+        if self._mode == "latest":
+            return int(self._latest[0] != self._num_taken)
+        return self._num_put - self._num_taken
+
+
 @EventReceiver("phrase", "set_next_phrase")
 class Instrument(generators.SampleGenerator):
+    """Base class for instruments.
+
+    Phrases received with set_next_phrase() (e.g. from a composer's thread)
+    wait in a PhraseQueue, and are played when the current phrase ends. By
+    default the latest phrase received replaces any pending one; with
+    set_queue_mode("fifo") each phrase is queued and played in turn.
+    When a phrase ends with none queued, the dry policy decides what plays:
+    "repeat" the last phrase, or "silence" until one is queued. Either way,
+    dry_count counts how often that happened.
+    """
     def __init__(self, bpm, phrase=None, sampling_rate=SAMPLING_RATE):
         generators.SampleGenerator.__init__(self, sampling_rate)
-        self._current_phrase = phrase
-        self._next_phrase = None
+        self._current_phrase = None
+        self._phrase_queue = PhraseQueue()
+        if phrase:
+            self._phrase_queue.put(phrase)
+        self._dry_policy = "repeat"
+        self._dry_count = 0
         self._bpm = bpm
+        # For render_phrase(): the time at which the next phrase starts, and
+        # the samples of notes that ring on past the end of the last phrase.
+        self._render_time = 0.0
+        self._tail = numpy.zeros(0, dtype=numpy.float32)
 
     def _get(self):
         raise Exception("Not implemented.")
 
+    def _render_note(self, note, tick_to_seconds):
+        """Returns the samples of a note (or None for a silent note)."""
+        raise Exception("Not implemented.")
+
+    def render_phrase(self, phrase, bpm=None):
+        """Renders a whole phrase offline, returning a float32 array.
+
+        Each note is rendered in one go by _render_note() and added into
+        the phrase's buffer at its start sample (overlap-add), without going
+        through the instrument's real-time voices.
+        Notes that ring on past the end of the phrase are carried into the
+        buffer of the next render_phrase() call; render_tail() returns what
+        is left after the last phrase. Successive phrases are laid out on
+        the same sample grid as get() and render() would play them.
+        """
+        bpm = self._bpm if bpm is None else bpm
+        tick_to_seconds = lambda _tick: phrase.get_time_signature().convert_tick_to_seconds(_tick, bpm)
+        self._phrase_start_time = self._render_time
+        start_sample = int(round(self._render_time * self._sampling_rate))
+        notes = []
+        for note in phrase.notes:
+            samples = self._render_note(note, tick_to_seconds)
+            if samples is None: continue
+            offset = int(round((self._render_time + tick_to_seconds(note.start_tick)) * self._sampling_rate))
+            notes.append((offset - start_sample, samples, note.volume))
+        self._render_time += phrase.phrase_endtime_in_seconds(bpm)
+        num_samples = int(round(self._render_time * self._sampling_rate)) - start_sample
+        length = max([num_samples, len(self._tail)] + [offset + len(samples) for (offset, samples, _) in notes])
+        data = numpy.zeros(length, dtype=numpy.float32)
+        data[:len(self._tail)] = self._tail
+        for (offset, samples, volume) in notes:
+            if volume == 1.0:
+                data[offset:offset + len(samples)] += samples
+            else:
+                data[offset:offset + len(samples)] += volume * samples
+        self._tail = data[num_samples:].copy()
+        return data[:num_samples]
+
+    def render_tail(self):
+        """Returns the samples still ringing after the last rendered phrase."""
+        (tail, self._tail) = (self._tail, numpy.zeros(0, dtype=numpy.float32))
+        return tail
+
     def set_next_phrase(self, sender, phrase):
-      """After the current phrase has played, this phrase will be played."""
-      self._next_phrase = phrase
+      """Queues a phrase, to be played once the current one has ended."""
+      self._phrase_queue.put(phrase)
+
+    def set_queue_mode(self, mode, capacity=DEFAULT_PHRASE_QUEUE_SIZE):
+        """Chooses whether a new phrase replaces the pending one ("latest")
+        or is queued after it ("fifo"). Call this before phrases are sent."""
+        queue = PhraseQueue(capacity, mode)
+        phrase = self._phrase_queue.take()
+        while phrase is not None:
+            queue.put(phrase)
+            phrase = self._phrase_queue.take()
+        self._phrase_queue = queue
+
+    def set_dry_policy(self, dry_policy):
+        """Sets what plays when a phrase ends with none queued: "repeat" or "silence"."""
+        assert dry_policy in DRY_POLICIES
+        self._dry_policy = dry_policy
+
+    def _take_phrase(self):
+        """Called when the current phrase has ended (or while silent): makes
+        the next phrase current and returns it (None for silence)."""
+        phrase = self._phrase_queue.take()
+        if phrase is None:
+            if self._current_phrase is not None:
+                self._dry_count += 1
+            if self._dry_policy == "repeat":
+                phrase = self._current_phrase
+        self._current_phrase = phrase
+        return phrase
+
+    @property
+    def phrase_queue(self): return self._phrase_queue
+
+    @property
+    def dry_count(self):
+        """How many times a phrase ended with no next phrase queued."""
+        return self._dry_count
 
 
 @EventReceiver("phrase", "print_phrase")
@@ -37,98 +217,505 @@ class PrinterInstrument(Instrument):
             print("  %d-->%d" % (note.start_tick, note.tone))
 
 
+@EventReceiver("phrase", "set_next_phrase")
+class ProcessInstrument(parallel.ProcessGenerator):
+    """Plays an Instrument that renders in a worker process.
+
+    Register this (rather than the instrument) as the phrase observer: the
+    phrases it receives are passed on to the instrument in order, before
+    the next block is rendered. Mix several with a ParallelMixerGenerator
+    to render them on separate cores.
+    """
+    def __init__(self, instrument, max_block_size=parallel.DEFAULT_MAX_BLOCK_SIZE, context=None):
+        parallel.ProcessGenerator.__init__(self, instrument, max_block_size, instrument._sampling_rate, context)
+
+    def set_next_phrase(self, sender, phrase):
+        # The sender stays in this process.
+        self.call("set_next_phrase", None, phrase)
+
+
 class GeneratorInstrument(Instrument):
     """Base class for Instruments whose notes produce independent generators."""
     def __init__(self, bpm, phrase=None, sampling_rate=SAMPLING_RATE):
         Instrument.__init__(self, bpm, phrase, sampling_rate)
         self._source = None
+        self._max_polyphony = None
+        self._steal_policy = "oldest"
+
+    def set_polyphony(self, max_polyphony, steal_policy="oldest"):
+        """Limits how many notes can sound at once (None for no limit).
+
+        When a note starts beyond the limit, a sounding note is stolen:
+        the "oldest", the "quietest", or ("retrigger") one of the same
+        tone, falling back to the oldest. Stolen notes are faded out quickly.
+        This bounds the cost of rendering each block.
+        """
+        self._max_polyphony = max_polyphony
+        self._steal_policy = steal_policy
+        if self._source:
+            self._source.set_max_voices(max_polyphony, steal_policy)
 
     def _add_phrase_to_mix(self, phrase):
         assert phrase
-        if not self._source:
-            self._source = generators.MixerGenerator()
         play_time = self._source.getTime()
+        self._phrase_start_time = play_time
         self._update_time = play_time + phrase.phrase_endtime_in_seconds(self._bpm)
         print("Adding notes, time=%g, update_time=%g" % (play_time, self._update_time))
         convert_tick_to_seconds = lambda _tick: phrase.get_time_signature().convert_tick_to_seconds(_tick, self._bpm)
-        for note in self._current_phrase.notes:
+        for note in phrase.notes:
             generator = self._get_generator(note, convert_tick_to_seconds)
             if not generator: continue
             start_time = convert_tick_to_seconds(note.start_tick)
-            self._source.add(generator, start_time=(play_time + start_time))
+            self._source.add(generator, start_time=(play_time + start_time), gain=note.volume,
+                             voice_key=note.tone)
 
         # TODO: Think about this some more: By looping on an integer number of samples, we might have
         # drift between this and a source that kept full float precision. It will only be off by <1 sample for
         # each phrase, which is pretty small, but we could add back that sample every Nth round.
-        self._remaining_samples = int(convert_tick_to_seconds(self._current_phrase.phrase_endtime()) * self._sampling_rate)
+        self._remaining_samples = int(convert_tick_to_seconds(phrase.phrase_endtime()) * self._sampling_rate)
 
     def _get_generator(self, note, tick_to_seconds):
         raise Exception("Not implemented.")
 
-    def _get(self):
-        if self._current_phrase is None:
-            self._current_phrase = self._next_phrase
-            self._next_phrase = None
+    def _render_note(self, note, tick_to_seconds):
+        """Returns the samples of a note (or None for a silent note)."""
+        generator = self._get_generator(note, tick_to_seconds)
+        return render_note(generator) if generator else None
 
+    def _update_phrase(self):
+        """Adds the next phrase to the mix once the current one has ended."""
         if not self._source:
-            self._add_phrase_to_mix(self._current_phrase)
+            self._source = generators.MixerGenerator(max_voices=self._max_polyphony,
+                                                     steal_policy=self._steal_policy)
+        elif self._samples_until_update() > 0:
+            return
+        phrase = self._take_phrase()
+        if phrase:
+            self._add_phrase_to_mix(phrase)
+        else:
+            # Silent: look for a phrase again at the next block.
+            self._update_time = self._source.getTime()
 
-        play_time = self._source.getTime()
-        if play_time >= self._update_time:
-            if self._next_phrase:
-                self._current_phrase = self._next_phrase
-                self._next_phrase = None
-            self._add_phrase_to_mix(self._current_phrase)
+    def _samples_until_update(self):
+        return int(round((self._update_time - self._source.getTime()) * self._sampling_rate))
+
+    def _get(self):
+        self._update_phrase()
         return self._source.__next__()
 
+    def _render(self, num_samples):
+        self._advance_time(num_samples)
+        data = numpy.empty(num_samples)
+        offset = 0
+        # Split the block at phrase boundaries.
+        while offset < num_samples:
+            self._update_phrase()
+            end = num_samples
+            if self._current_phrase:
+                end = min(num_samples, offset + max(1, self._samples_until_update()))
+            data[offset:end] = self._source._render(end - offset)
+            offset = end
+        return data
 
 
 
-def get_synth_note_generator(wave_class, freq, duration, sampling_rate):
+
+def get_synth_note_generator(wave_class, freq, duration, sampling_rate, start_time=None):
+    """Returns an enveloped note. If start_time is given, the oscillator starts
+    at that point of its waveform (wave_class must support seek())."""
     synth_note = wave_class(freq, sampling_rate)
+    if start_time is not None:
+        synth_note.seek(start_time)
     print("Make note: freq=%g, duration=%g" % (freq, duration))
+    # Notes of the same duration share one precomputed envelope gain table.
+    (segments, start_level) = get_synth_note_envelope(duration)
+    return envelopes.BreakpointEnvelope(synth_note, segments, start_level=start_level, sampling_rate=sampling_rate)
+
+
+def get_synth_note_envelope(duration):
+    """Returns the envelope segments and start level of a synth note."""
     if duration >= 1.0:
-        enveloped_note = envelopes.StandardEnvelope(synth_note, attack=0.05, decay=0.0, peak=1,
-                                                    level=1, sustain=duration-0.95, release=0.9)
-    else:
-        enveloped_note = envelopes.StandardEnvelope(synth_note, attack=0, decay=0, peak=1,
-                                                    level=1, sustain=duration/2, release=duration/2)
-    return enveloped_note
+        return ([(0.05, 1.0, "linear"), (duration - 0.95, 1.0, "linear"), (0.9, 0.0, "linear")], 0.0)
+    return ([(duration / 2, 1.0, "linear"), (duration / 2, 0.0, "linear")], 1.0)
+
+
+DEFAULT_NOTE_CACHE_BYTES = 64 * 2 ** 20
+NOTE_BLOCK_SIZE = 4096
+
+
+def render_note(generator, block_size=NOTE_BLOCK_SIZE):
+    """Renders a note generator until it finishes, into a float32 array."""
+    blocks = []
+    while not generator.is_finished():
+        blocks.append(generator.render(block_size))
+    data = numpy.concatenate(blocks) if blocks else numpy.zeros(0, dtype=numpy.float32)
+    # Drop the silence after the end of the note.
+    nonzero = numpy.flatnonzero(data)
+    return data[:nonzero[-1] + 1] if len(nonzero) else data[:0]
+
+
+class NoteCache(ArrayCache):
+    """Renders each distinct note once, and shares the samples between all
+    instruments that play it.
+
+    Entries are keyed by whatever identifies a note's sound (e.g. wave
+    class, frequency, duration and sampling rate). When the rendered notes
+    use more than max_bytes, the least recently used are evicted. The
+    returned arrays are read-only, since they are shared.
+    """
+    def __init__(self, max_bytes=DEFAULT_NOTE_CACHE_BYTES):
+        ArrayCache.__init__(self, max_bytes)
+
+    def get(self, key, make_generator):
+        """Returns the rendered samples for key, calling make_generator() to
+        create the note's generator if they are not cached."""
+        return self.lookup(key, lambda: render_note(make_generator()))
+
+
+note_cache = NoteCache()
 
 
 class WaveInstrument(GeneratorInstrument):
-    def __init__(self, bpm, phrase=None, sampling_rate=SAMPLING_RATE, wave_class=generators.SineWaveGenerator):
+    """Plays each note on a new oscillator of wave_class, with an envelope.
+
+    By default every note starts at the oscillator's zero phase, so a note
+    always sounds the same: it is rendered once into note_cache and replayed
+    from there (pass note_cache=None to synthesize every note live).
+    With free_running=True, notes instead continue the phase of an
+    oscillator that has been running since the instrument started, as if
+    all notes were gated from one oscillator. Such notes differ each time,
+    so they are always synthesized live.
+
+    An instrument using note_cache is pickled without it (e.g. to render in
+    a worker process), and uses the note_cache of the process it is
+    unpickled in.
+    """
+    def __init__(self, bpm, phrase=None, sampling_rate=SAMPLING_RATE, wave_class=generators.SineWaveGenerator,
+                 note_cache=note_cache, free_running=False):
         GeneratorInstrument.__init__(self, bpm, phrase, sampling_rate)
         self._wave_class = wave_class
+        self._note_cache = note_cache
+        self._free_running = free_running
 
     def _get_generator(self, note, tick_to_seconds):
         freq = ToneToFrequency(note.tone)
         duration = tick_to_seconds(note.duration)
-        # TODO(ciaran): Handle note volume (could simply enclose in a volume envelope)
-        return get_synth_note_generator(self._wave_class, freq, duration, self._sampling_rate)
+        if self._free_running:
+            start_time = self._phrase_start_time + tick_to_seconds(note.start_tick)
+            return get_synth_note_generator(self._wave_class, freq, duration, self._sampling_rate, start_time)
+        if self._note_cache is None:
+            return get_synth_note_generator(self._wave_class, freq, duration, self._sampling_rate)
+        return generators.BufferGenerator(self._get_cached_note(freq, duration), self._sampling_rate)
+
+    def _render_note(self, note, tick_to_seconds):
+        if self._free_running or self._note_cache is None:
+            return GeneratorInstrument._render_note(self, note, tick_to_seconds)
+        # Cached notes are used as they are.
+        return self._get_cached_note(ToneToFrequency(note.tone), tick_to_seconds(note.duration))
+
+    def _get_cached_note(self, freq, duration):
+        make_generator = lambda: get_synth_note_generator(self._wave_class, freq, duration, self._sampling_rate)
+        key = (self._wave_class, freq, duration, self._sampling_rate)
+        return self._note_cache.get(key, make_generator)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self._note_cache is note_cache:
+            state["_note_cache"] = "shared"
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if isinstance(self._note_cache, str):
+            self._note_cache = note_cache
+
+
+# Vectorized waveforms of the oscillators, as functions of the phase in cycles.
+WAVE_SHAPES = {
+    generators.SineWaveGenerator: lambda phases: numpy.sin(2 * numpy.pi * phases),
+    generators.SquareWaveGenerator: lambda phases: numpy.where(phases < 0.5, 1.0, -1.0),
+    generators.SawtoothWaveGenerator: lambda phases: (phases * 2) - 1,
+}
+DEFAULT_MAX_VOICES = 64
+
+
+class PolySynthInstrument(Instrument):
+    """Plays notes like WaveInstrument, with all voices rendered as one batch.
+
+    Instead of a generator per note, each voice is a slot in parallel arrays
+    holding its phase, phase increment, envelope position and gain. Each
+    block computes every sounding voice at once, as the rows of one array,
+    and sums them, so the Python overhead per block does not grow with the
+    number of notes. The envelopes are the same gain tables as
+    WaveInstrument's, packed into one array.
+
+    At most max_voices notes sound at once: starting a note beyond that
+    steals the oldest one, which fades out linearly over fade_time seconds
+    (like a voice stolen by MixerGenerator) in one of max_voices spare
+    slots.
+    """
+    def __init__(self, bpm, phrase=None, sampling_rate=SAMPLING_RATE, wave_class=generators.SineWaveGenerator,
+                 max_voices=DEFAULT_MAX_VOICES, fade_time=0.005):
+        Instrument.__init__(self, bpm, phrase, sampling_rate)
+        assert wave_class in WAVE_SHAPES
+        self._wave_shape = WAVE_SHAPES[wave_class]
+        self._sample_index = 0
+        self._update_sample = 0
+        # Notes waiting to start: (start sample, sequence number, frequency, duration, gain).
+        self._pending_notes = []
+        self._sequence = itertools.count()
+        # Per-voice state. A voice's envelope is entries [offset, offset + length)
+        # of self._tables.
+        self._max_voices = max_voices
+        num_slots = 2 * max_voices
+        self._active = numpy.zeros(num_slots, dtype=bool)
+        self._phases = numpy.zeros(num_slots)
+        self._increments = numpy.zeros(num_slots)
+        self._positions = numpy.zeros(num_slots, dtype=numpy.int64)
+        self._offsets = numpy.zeros(num_slots, dtype=numpy.int64)
+        self._lengths = numpy.ones(num_slots, dtype=numpy.int64)
+        self._gains = numpy.zeros(num_slots)
+        self._start_samples = numpy.zeros(num_slots, dtype=numpy.int64)
+        # Stolen voices, and how many samples of their fade are left.
+        self._fading = numpy.zeros(num_slots, dtype=bool)
+        self._fade_remaining = numpy.zeros(num_slots, dtype=numpy.int64)
+        self._fade_samples = max(1, int(round(fade_time * sampling_rate)))
+        # The envelope tables, packed into one array that grows by doubling,
+        # and the (offset, length) of each note duration's table in it.
+        self._tables = numpy.zeros(0)
+        self._tables_size = 0
+        self._table_offsets = {}
+
+    @property
+    def max_voices(self): return self._max_voices
+
+    @property
+    def num_voices(self):
+        """The number of notes sounding now (not counting stolen notes that
+        are fading out)."""
+        return int((self._active & ~self._fading).sum())
+
+    def _get_table(self, duration):
+        """Returns the (offset, length) of the envelope table for a duration."""
+        if duration not in self._table_offsets:
+            (segments, start_level) = get_synth_note_envelope(duration)
+            table = envelopes.get_gain_table(segments, start_level, self._sampling_rate)
+            (offset, end) = (self._tables_size, self._tables_size + len(table))
+            if end > len(self._tables):
+                tables = numpy.zeros(max(end, 2 * len(self._tables)))
+                tables[:offset] = self._tables[:offset]
+                self._tables = tables
+            self._tables[offset:end] = table
+            self._tables_size = end
+            self._table_offsets[duration] = (offset, len(table))
+        return self._table_offsets[duration]
+
+    def _start_voice(self, freq, duration, gain):
+        held = numpy.flatnonzero(self._active & ~self._fading)
+        if len(held) >= self._max_voices:
+            victim = held[numpy.argmin(self._start_samples[held])]
+            self._fading[victim] = True
+            self._fade_remaining[victim] = self._fade_samples
+        free = numpy.flatnonzero(~self._active)
+        if len(free):
+            slot = free[0]
+        else:
+            # Every spare slot is fading: cut off the nearest to silence.
+            fading = numpy.flatnonzero(self._fading)
+            slot = fading[numpy.argmin(self._fade_remaining[fading])]
+        self._active[slot] = True
+        self._fading[slot] = False
+        self._phases[slot] = 0.0
+        self._increments[slot] = freq / self._sampling_rate
+        self._positions[slot] = 0
+        (self._offsets[slot], self._lengths[slot]) = self._get_table(duration)
+        self._gains[slot] = gain
+        self._start_samples[slot] = self._sample_index
+
+    def _add_phrase(self, phrase):
+        phrase_time = self._sample_index / self._sampling_rate
+        convert_tick_to_seconds = lambda _tick: phrase.get_time_signature().convert_tick_to_seconds(_tick, self._bpm)
+        for note in phrase.notes:
+            start_sample = int(round((phrase_time + convert_tick_to_seconds(note.start_tick)) * self._sampling_rate))
+            heapq.heappush(self._pending_notes, (start_sample, next(self._sequence), ToneToFrequency(note.tone),
+                                                 convert_tick_to_seconds(note.duration), note.volume))
+        self._update_sample = self._sample_index + int(round(phrase.phrase_endtime_in_seconds(self._bpm) * self._sampling_rate))
+
+    def _update_phrase(self):
+        """Schedules the notes of the next phrase once the current one has ended."""
+        if self._sample_index < self._update_sample: return
+        phrase = self._take_phrase()
+        if phrase:
+            self._add_phrase(phrase)
+
+    def _process(self, num_samples):
+        data = numpy.zeros(num_samples)
+        offset = 0
+        # Split the block where phrases and notes start.
+        while offset < num_samples:
+            self._update_phrase()
+            while self._pending_notes and self._pending_notes[0][0] <= self._sample_index:
+                (_, _, freq, duration, gain) = heapq.heappop(self._pending_notes)
+                self._start_voice(freq, duration, gain)
+            end_sample = self._sample_index + num_samples - offset
+            if self._update_sample > self._sample_index:
+                end_sample = min(end_sample, self._update_sample)
+            if self._pending_notes:
+                end_sample = min(end_sample, self._pending_notes[0][0])
+            end = offset + end_sample - self._sample_index
+            data[offset:end] = self._render_voices(end - offset)
+            self._sample_index = end_sample
+            offset = end
+        return data
+
+    def _render_voices(self, num_samples):
+        """Renders and sums num_samples of every sounding voice."""
+        voices = numpy.flatnonzero(self._active)
+        if not len(voices):
+            return 0.0
+        steps = numpy.arange(num_samples)
+        phases = (self._phases[voices, numpy.newaxis] + self._increments[voices, numpy.newaxis] * steps) % 1.0
+        positions = self._positions[voices, numpy.newaxis] + steps
+        lengths = self._lengths[voices, numpy.newaxis]
+        gains = self._tables[self._offsets[voices, numpy.newaxis] + numpy.minimum(positions, lengths - 1)]
+        gains *= self._gains[voices, numpy.newaxis]
+        fading = self._fading[voices]
+        if fading.any():
+            remaining = self._fade_remaining[voices[fading], numpy.newaxis]
+            gains[fading] *= numpy.maximum(0.0, remaining - steps) / self._fade_samples
+            self._fade_remaining[voices[fading]] -= num_samples
+        data = (self._wave_shape(phases) * gains).sum(axis=0)
+        self._phases[voices] = (self._phases[voices] + self._increments[voices] * num_samples) % 1.0
+        self._positions[voices] += num_samples
+        # A voice is freed once it reaches the table's final zero, or the
+        # end of its fade.
+        self._active[voices] = ((self._positions[voices] < self._lengths[voices] - 1) &
+                                ~(fading & (self._fade_remaining[voices] <= 0)))
+        self._fading &= self._active
+        return data
+
+    def _render_note(self, note, tick_to_seconds):
+        # For render_phrase(): one voice, rendered as _render_voices() would,
+        # without the voice limit.
+        (offset, length) = self._get_table(tick_to_seconds(note.duration))
+        phases = (ToneToFrequency(note.tone) / self._sampling_rate * numpy.arange(length)) % 1.0
+        return (self._wave_shape(phases) * self._tables[offset:offset + length]).astype(numpy.float32)
+
+    def _get(self):
+        return float(self._process(1)[0])
+
+    def _render(self, num_samples):
+        self._advance_time(num_samples)
+        return self._process(num_samples)
+
+
+PRELOAD_MODES = ("eager", "lazy")
+DRUMS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "wav_data", "drums")
 
 
 class TriggerPadInstrument(GeneratorInstrument):
-    """Trigger Pad where each note triggers a WAV file to play."""
-    def __init__(self, note_mapping, bpm, phrase=None, sampling_rate=SAMPLING_RATE):
+    """Trigger Pad where each note triggers a WAV file to play.
+
+    All mapped files are checked when the pad is created, so a bad path
+    fails straight away rather than on the first hit. The samples are then
+    decoded into the sample bank by a thread pool: with preload="eager"
+    the constructor waits for them all, and with preload="lazy" they are
+    decoded in the background while the pad starts playing (a note hit
+    before its sample is ready decodes it on the spot). If the background
+    decoding fails, the error is raised by wait_until_loaded() and by the
+    next note played. load_time and num_bytes report what loading the kit
+    cost.
+
+    Pads can be pickled (e.g. to render in a worker process). A pad using
+    the shared sample bank uses the shared bank of the process it is
+    unpickled in.
+    """
+    def __init__(self, note_mapping, bpm, phrase=None, sampling_rate=SAMPLING_RATE, preload="eager", bank=None):
         GeneratorInstrument.__init__(self, bpm, phrase, sampling_rate)
         # dictionary mapping a note number to a WAV filename
-        assert type(note_mapping) == dict        
+        assert type(note_mapping) == dict
+        assert preload in PRELOAD_MODES
+        for filename in note_mapping.values():
+            if not os.path.isfile(filename):
+                raise IOError("Trigger pad sample not found: %s" % filename)
         self._note_mapping = note_mapping
+        self._bank = sample_bank if bank is None else bank
+        # The decoded samples of each note, filled in by _load().
+        self._samples = {}
+        self._load_time = None
+        self._load_error = None
+        self._loader = None
+        if preload == "eager":
+            self._load()
+        else:
+            self._loader = threading.Thread(target=self._load_in_background, name="TriggerPad loader", daemon=True)
+            self._loader.start()
+
+    def _load(self):
+        start = time.perf_counter()
+        notes = list(self._note_mapping)
+        samples = self._bank.prefetch([self._note_mapping[note_num] for note_num in notes], self._sampling_rate)
+        self._samples.update(zip(notes, samples))
+        self._load_time = time.perf_counter() - start
+
+    def _load_in_background(self):
+        try:
+            self._load()
+        except Exception as error:
+            self._load_error = error
+
+    def _check_load_error(self):
+        if self._load_error is not None:
+            raise IOError("Trigger pad samples failed to load") from self._load_error
+
+    def wait_until_loaded(self, timeout=None):
+        """Waits for a lazy pad to finish decoding its samples, and returns
+        True if they are all loaded. Raises the error if decoding failed."""
+        if self._loader is not None:
+            self._loader.join(timeout)
+        self._check_load_error()
+        return self._load_time is not None
+
+    def __getstate__(self):
+        if self._loader is not None:
+            self._loader.join()
+        state = self.__dict__.copy()
+        state["_loader"] = None
+        if self._bank is sample_bank:
+            state["_bank"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._bank is None:
+            self._bank = sample_bank
+
+    @property
+    def load_time(self):
+        """Seconds it took to decode all samples (None until they are)."""
+        return self._load_time
+
+    @property
+    def num_bytes(self):
+        """Memory used by the samples decoded so far."""
+        return sum(samples.nbytes for samples in list(self._samples.values()))
 
     def _get_generator(self, note, tick_to_seconds):
-        # TODO(ciaran): Handle note volume (could simply enclose in a volume envelope)
         note_num = note.tone
         if note_num not in self._note_mapping:
             return None
-        return generators.WaveFileGenerator(self._note_mapping[note_num], self._sampling_rate)
+        self._check_load_error()
+        if note_num not in self._samples:
+            self._samples[note_num] = self._bank.get(self._note_mapping[note_num], self._sampling_rate)
+        return generators.BufferGenerator(self._samples[note_num][0], self._sampling_rate)
 
 
 class DefaultDrumkitInstrument(TriggerPadInstrument):
   """Drumkit Trigger Pad where each note triggers a WAV file to play."""
-  def __init__(self, bpm, phrase=None, sampling_rate=SAMPLING_RATE):
+  def __init__(self, bpm, phrase=None, sampling_rate=SAMPLING_RATE, preload="eager", bank=None):
     note_mapping = {}
     for (index, note_num) in enumerate(range(0, 42)):
-        note_mapping[note_num] = os.path.join("MusicGeneration", "wav_data", "drums", "DR1-%d.WAV" % index)
-    TriggerPadInstrument.__init__(self, note_mapping, bpm, phrase=phrase, sampling_rate=sampling_rate)
+        note_mapping[note_num] = os.path.join(DRUMS_DIR, "DR1-%d.WAV" % index)
+    TriggerPadInstrument.__init__(self, note_mapping, bpm, phrase=phrase, sampling_rate=sampling_rate,
+                                  preload=preload, bank=bank)
 
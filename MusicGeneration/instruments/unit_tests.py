@@ -1,15 +1,30 @@
 """Unit tests for instrument libraries."""
 
 import os
+import pickle
 import platform
+import shutil
+import tempfile
 import unittest
+import numpy
 
 from MusicGeneration.music import Phrase, Note
 from MusicGeneration import rhythm
 from MusicGeneration.sample_generators import SAMPLING_RATE, generators
+from MusicGeneration.sample_generators.sample_banks import sample_bank
 from MusicGeneration import wavefile
+from MusicGeneration.composers import SimpleComposer
+from MusicGeneration.composers.clock import BasicClock
+from MusicGeneration.composers.listening import MixerComposer
+from MusicGeneration.rhythm.interval_sequences import SimpleIntervalGenerator
+from MusicGeneration.theory.tone_sequences import CyclicMelodyGenerator
 
-from . import WaveInstrument, TriggerPadInstrument
+from MusicGeneration.sample_generators.sample_banks import SampleBank
+
+from MusicGeneration.sample_generators.parallel import ParallelMixerGenerator
+
+from . import (WaveInstrument, TriggerPadInstrument, PolySynthInstrument, DefaultDrumkitInstrument, ProcessInstrument,
+               NoteCache, PhraseQueue, note_cache)
 
 
 def create_phrase(tone_list, time_signature):
@@ -84,6 +99,138 @@ class TestWaveInstrument(unittest.TestCase):
             self.assertGreater(min(loop_data[note_length+1:4*note_length-1]), -0.01, msg=error_msg)
 
 
+    def test_finished_notes_are_removed(self):
+        time_signature = rhythm.fourfour
+        phrase = create_phrase([60, 0, 0, 0, 67], time_signature)
+        bpm = 150
+        num_loops = 8
+        sine_instrument = WaveInstrument(bpm, phrase)
+        end_time = phrase.phrase_endtime_in_seconds(bpm)
+        sine_instrument.get(int(SAMPLING_RATE * end_time * num_loops))
+        # Only the notes of the current phrase can still be in the mix.
+        self.assertLessEqual(len(sine_instrument._source._source_list), phrase.get_num_notes())
+
+    def test_render_matches_get(self):
+        time_signature = rhythm.fourfour
+        phrase = create_phrase([60, 0, 64, 0, 67], time_signature)
+        bpm = 150
+        num_samples = int(SAMPLING_RATE * phrase.phrase_endtime_in_seconds(bpm) * 2.5)
+        expected = WaveInstrument(bpm, phrase).get(num_samples)
+        instrument = WaveInstrument(bpm, phrase)
+        data = [instrument.render(0)]
+        while sum(len(d) for d in data) < num_samples:
+            data.append(instrument.render(min(9999, num_samples - sum(len(d) for d in data))))
+        self.assertEqual(numpy.concatenate(data).tolist(), numpy.float32(expected).tolist())
+
+    def test_note_cache(self):
+        time_signature = rhythm.fourfour
+        phrase = create_phrase([60, 0, 64, 0, 60, 0, 64], time_signature)
+        bpm = 150
+        num_samples = int(SAMPLING_RATE * phrase.phrase_endtime_in_seconds(bpm) * 2)
+        expected = WaveInstrument(bpm, phrase, note_cache=None).get(num_samples)
+        cache = NoteCache()
+        data = WaveInstrument(bpm, phrase, note_cache=cache).get(num_samples)
+        numpy.testing.assert_allclose(data, expected, atol=1e-6)
+        # Two distinct notes, each played four times.
+        self.assertEqual(len(cache), 2)
+        self.assertEqual((cache.hits, cache.misses), (6, 2))
+        note_bytes = cache.num_bytes
+        # A new note evicts the least recently used one.
+        cache.set_max_bytes(note_bytes)
+        WaveInstrument(bpm, create_phrase([67], time_signature), note_cache=cache).get(100)
+        self.assertEqual(len(cache), 2)
+        self.assertLessEqual(cache.num_bytes, note_bytes * 1.5)
+        self.assertEqual(cache.misses, 3)
+
+    def test_pickle(self):
+        phrase = create_phrase([60, 0, 64], rhythm.fourfour)
+        WaveInstrument(150, phrase).get(20000)
+        self.assertGreater(note_cache.num_bytes, 0)
+        instrument = WaveInstrument(150, phrase)
+        data = pickle.dumps(instrument)
+        # The shared cache is not pickled along with the instrument.
+        self.assertLess(len(data), 10000)
+        copy = pickle.loads(data)
+        self.assertIs(copy._note_cache, note_cache)
+        self.assertEqual(copy.get(20000), instrument.get(20000))
+        cache = NoteCache()
+        self.assertIsNot(pickle.loads(pickle.dumps(WaveInstrument(150, note_cache=cache)))._note_cache, cache)
+        self.assertIsNone(pickle.loads(pickle.dumps(WaveInstrument(150, note_cache=None)))._note_cache)
+
+    def test_free_running_notes(self):
+        time_signature = rhythm.fourfour
+        phrase = create_phrase([69, 0, 69], time_signature)
+        bpm = 150
+        note_start = int(round(SAMPLING_RATE * 2 * phrase.phrase_endtime_in_seconds(bpm) / 8))
+        data = WaveInstrument(bpm, phrase, free_running=True).get(note_start + 100)
+        # The second note continues the phase of a 440Hz sine started at time 0.
+        times = numpy.arange(note_start, note_start + 100) / SAMPLING_RATE
+        numpy.testing.assert_allclose(data[note_start:], numpy.sin(2 * numpy.pi * 440 * times), atol=1e-3)
+        reset = WaveInstrument(bpm, phrase).get(note_start + 100)
+        numpy.testing.assert_allclose(reset[note_start:], reset[:100], atol=1e-6)
+
+    def test_polyphony_limit(self):
+        time_signature = rhythm.fourfour
+        # Eight overlapping whole notes.
+        notes = [Note(tone, i * time_signature.eighth_note, 8 * time_signature.eighth_note)
+                 for (i, tone) in enumerate([60, 62, 64, 65, 67, 69, 71, 72])]
+        phrase = Phrase(notes, time_signature)
+        bpm = 150
+        for steal_policy in ["oldest", "quietest", "retrigger"]:
+            instrument = WaveInstrument(bpm, phrase, note_cache=None)
+            instrument.set_polyphony(3, steal_policy)
+            max_voices = 0
+            for _ in range(100):
+                instrument.render(1000)
+                voices = [source for source in instrument._source._source_list
+                          if not isinstance(source, generators.FadeOutGenerator)]
+                max_voices = max(max_voices, len(voices))
+            self.assertEqual(max_voices, 3)
+
+    def test_render_phrase(self):
+        time_signature = rhythm.fourfour
+        notes = [Note(60, 0, time_signature.eighth_note), Note(64, 2 * time_signature.eighth_note, time_signature.eighth_note),
+                 Note(67, 6 * time_signature.eighth_note, 2 * time_signature.eighth_note, volume=0.5)]
+        phrase = Phrase(notes, time_signature)
+        bpm = 150
+        phrase_samples = int(round(SAMPLING_RATE * phrase.phrase_endtime_in_seconds(bpm)))
+        for note_cache in [NoteCache(), None]:
+            expected = WaveInstrument(bpm, phrase, note_cache=note_cache).render(3 * phrase_samples)
+            instrument = WaveInstrument(bpm, note_cache=note_cache)
+            data = [instrument.render_phrase(phrase) for _ in range(3)]
+            self.assertEqual([len(d) for d in data], 3 * [phrase_samples])
+            self.assertEqual(data[0].dtype, numpy.float32)
+            numpy.testing.assert_allclose(numpy.concatenate(data), expected, atol=1e-6)
+            self.assertEqual(len(instrument.render_tail()), 0)
+
+    def test_render_phrase_tails(self):
+        time_signature = rhythm.fourfour
+        # The first sample lasts for over two phrases.
+        note_mapping = {
+            26: os.path.join("MusicGeneration", "wav_data", "drums", "DR1-26.WAV"),
+            10: os.path.join("MusicGeneration", "wav_data", "drums", "DR1-10.WAV"),
+        }
+        phrase = Phrase([Note(26, 0, time_signature.eighth_note),
+                         Note(10, 7 * time_signature.eighth_note, time_signature.eighth_note)], time_signature)
+        bpm = 150
+        phrase_samples = int(round(SAMPLING_RATE * phrase.phrase_endtime_in_seconds(bpm)))
+        expected = TriggerPadInstrument(note_mapping, bpm, phrase).render(4 * phrase_samples)
+        instrument = TriggerPadInstrument(note_mapping, bpm)
+        data = numpy.concatenate([instrument.render_phrase(phrase) for _ in range(4)])
+        numpy.testing.assert_allclose(data, expected, atol=1e-6)
+        # What rings on after the fourth phrase: the end of the last two hits
+        # of the long sample, and of the last short one.
+        (long_sample, short_sample) = [sample_bank.get(note_mapping[tone])[0] for tone in [26, 10]]
+        expected = numpy.zeros(len(long_sample))
+        expected[:len(long_sample) - phrase_samples] += long_sample[phrase_samples:]
+        expected[:len(long_sample) - 2 * phrase_samples] += long_sample[2 * phrase_samples:]
+        short_end = len(short_sample) - phrase_samples // 8
+        expected[:short_end] += short_sample[phrase_samples // 8:]
+        tail = instrument.render_tail()
+        self.assertLessEqual(len(tail), len(long_sample) - phrase_samples)
+        numpy.testing.assert_allclose(tail, expected[:len(tail)], atol=1e-6)
+        self.assertEqual(numpy.abs(expected[len(tail):]).max(), 0.0)
+
     def test_sawtooth_instrument(self):
         time_signature = rhythm.fourfour
         phrase = create_phrase([60, 62, 64, 65, 67, 69, 71, 72], time_signature)
@@ -104,6 +251,154 @@ class TestWaveInstrument(unittest.TestCase):
             self.assertGreater(max(data[i*note_length:(i+1)*note_length]), 0.75)
 
 
+class TestPhraseQueue(unittest.TestCase):
+
+    def test_put_and_take(self):
+        queue = PhraseQueue(3, mode="fifo")
+        self.assertIsNone(queue.take())
+        for item in range(4):
+            self.assertEqual(queue.put(item), item < 3)
+        self.assertEqual((len(queue), queue.num_dropped), (3, 1))
+        self.assertEqual([queue.take(), queue.take()], [0, 1])
+        # The queue wraps around.
+        self.assertTrue(queue.put(4))
+        self.assertTrue(queue.put(5))
+        self.assertFalse(queue.put(6))
+        self.assertEqual([queue.take() for _ in range(4)], [2, 4, 5, None])
+
+    def test_latest_wins(self):
+        queue = PhraseQueue()
+        self.assertIsNone(queue.take())
+        for item in range(3):
+            self.assertTrue(queue.put(item))
+        self.assertEqual((len(queue), queue.num_dropped), (1, 2))
+        self.assertEqual([queue.take(), queue.take()], [2, None])
+        queue.put(3)
+        self.assertEqual([queue.take(), queue.take()], [3, None])
+
+    def test_mixer_composer_feed(self):
+        # MixerComposer re-sends a growing partial mix each time one of its
+        # sources sends a phrase: only the full mix should be played.
+        time_signature = rhythm.fourfour
+        clock = BasicClock("conductor")
+        sources = []
+        for tone in range(60, 66):
+            sources.append(SimpleComposer(SimpleIntervalGenerator(num_ticks=time_signature.ticks_per_beat),
+                                          CyclicMelodyGenerator([tone])))
+            clock.add_tick_observer(sources[-1])
+        mixer = MixerComposer(*sources)
+        instrument = WaveInstrument(150)
+        fifo_instrument = WaveInstrument(150)
+        fifo_instrument.set_queue_mode("fifo")
+        mixer.add_phrase_observer(instrument)
+        mixer.add_phrase_observer(fifo_instrument)
+        for measure in range(3):
+            clock.increment(time_signature.ticks_per_measure)
+            self.assertEqual(len(instrument.phrase_queue), 1)
+            phrase = instrument.phrase_queue.take()
+            self.assertEqual(sorted(set(note.tone for note in phrase.notes)), list(range(60, 66)))
+        self.assertEqual(instrument.phrase_queue.num_dropped, 15)
+        # Queued in order, the partial mixes would each be played.
+        self.assertEqual([fifo_instrument.phrase_queue.take().get_num_notes() for _ in range(6)],
+                         [4, 8, 12, 16, 20, 24])
+
+    def test_queued_phrases_play_in_order(self):
+        time_signature = rhythm.fourfour
+        phrases = [create_phrase([60, 0, 64], time_signature), create_phrase([67, 0, 0, 72], time_signature)]
+        bpm = 150
+        phrase_samples = int(round(SAMPLING_RATE * phrases[0].phrase_endtime_in_seconds(bpm)))
+        reference = WaveInstrument(bpm)
+        expected = numpy.concatenate([reference.render_phrase(phrase) for phrase in phrases + phrases[1:]])
+        instrument = WaveInstrument(bpm)
+        instrument.set_queue_mode("fifo")
+        for phrase in phrases:
+            instrument.set_next_phrase(self, phrase)
+        data = [instrument.render(1000) for _ in range(3 * phrase_samples // 1000)]
+        numpy.testing.assert_allclose(numpy.concatenate(data), expected[:len(data) * 1000], atol=1e-6)
+        # The queue ran dry once, and the last phrase was repeated.
+        self.assertEqual(instrument.dry_count, 1)
+
+    def test_silence_when_dry(self):
+        time_signature = rhythm.fourfour
+        phrase = create_phrase([60, 0, 64], time_signature)
+        bpm = 150
+        phrase_samples = int(round(SAMPLING_RATE * phrase.phrase_endtime_in_seconds(bpm)))
+        for instrument in [WaveInstrument(bpm, phrase), PolySynthInstrument(bpm, phrase)]:
+            instrument.set_dry_policy("silence")
+            first = instrument.render(phrase_samples)
+            self.assertGreater(numpy.abs(first).max(), 0.5)
+            self.assertEqual(numpy.abs(instrument.render(phrase_samples)).max(), 0.0)
+            self.assertEqual(instrument.dry_count, 1)
+            # A phrase queued while silent starts at the next block.
+            instrument.set_next_phrase(self, phrase)
+            numpy.testing.assert_allclose(instrument.render(phrase_samples), first, atol=1e-6)
+            self.assertEqual(instrument.dry_count, 1)
+
+
+class TestPolySynthInstrument(unittest.TestCase):
+
+    def test_matches_wave_instrument(self):
+        time_signature = rhythm.fourfour
+        phrase = create_phrase([60, 0, 64, 0, 67, 72], time_signature)
+        bpm = 150
+        num_samples = int(SAMPLING_RATE * phrase.phrase_endtime_in_seconds(bpm) * 2.5)
+        for wave_class in [generators.SineWaveGenerator, generators.SawtoothWaveGenerator]:
+            expected = WaveInstrument(bpm, phrase, wave_class=wave_class, note_cache=None).render(num_samples)
+            instrument = PolySynthInstrument(bpm, phrase, wave_class=wave_class)
+            data = [instrument.render(1000) for _ in range(num_samples // 1000 + 1)]
+            numpy.testing.assert_allclose(numpy.concatenate(data)[:num_samples], expected, atol=1e-5)
+
+    def test_stolen_voices_fade_out(self):
+        time_signature = rhythm.fourfour
+        notes = [Note(60, 0, 8 * time_signature.eighth_note), Note(67, time_signature.eighth_note, time_signature.eighth_note)]
+        instrument = PolySynthInstrument(150, Phrase(notes, time_signature), max_voices=1, fade_time=0.005)
+        steal_sample = int(round(SAMPLING_RATE * 0.2))
+        data = instrument.render(steal_sample + 10)
+        # The first note does not stop dead when the second steals its voice...
+        self.assertLess(numpy.abs(numpy.diff(data[steal_sample - 10:])).max(), 0.1)
+        self.assertEqual(instrument.num_voices, 1)
+        self.assertEqual(int(instrument._active.sum()), 2)
+        # ... and has gone once its fade is over.
+        fade_samples = int(SAMPLING_RATE * 0.005)
+        instrument.render(fade_samples)
+        self.assertEqual(int(instrument._active.sum()), 1)
+        expected = PolySynthInstrument(150, Phrase(notes[1:], time_signature)).render(steal_sample + fade_samples + 510)
+        numpy.testing.assert_allclose(instrument.render(500), expected[-500:], atol=1e-6)
+
+    def test_render_phrase(self):
+        time_signature = rhythm.fourfour
+        notes = [Note(60, 0, time_signature.eighth_note), Note(64, 2 * time_signature.eighth_note, 3 * time_signature.eighth_note),
+                 Note(67, 6 * time_signature.eighth_note, 4 * time_signature.eighth_note, volume=0.5)]
+        phrase = Phrase(notes, time_signature)
+        bpm = 150
+        phrase_samples = int(round(SAMPLING_RATE * phrase.phrase_endtime_in_seconds(bpm)))
+        expected = PolySynthInstrument(bpm, phrase).render(3 * phrase_samples)
+        instrument = PolySynthInstrument(bpm)
+        data = [instrument.render_phrase(phrase) for _ in range(3)]
+        self.assertEqual([len(d) for d in data], 3 * [phrase_samples])
+        self.assertEqual(data[0].dtype, numpy.float32)
+        numpy.testing.assert_allclose(numpy.concatenate(data), expected, atol=1e-5)
+        self.assertEqual(len(instrument.render_tail()), 0)
+
+    def test_voice_limit(self):
+        time_signature = rhythm.fourfour
+        notes = [Note(48 + i, (i % 8) * time_signature.eighth_note, 8 * time_signature.eighth_note)
+                 for i in range(64)]
+        instrument = PolySynthInstrument(150, Phrase(notes, time_signature), max_voices=16)
+        num_voices = []
+        for _ in range(100):
+            instrument.render(1000)
+            num_voices.append(instrument.num_voices)
+        self.assertEqual(max(num_voices), 16)
+        # Voices are freed when their envelopes end.
+        self.assertEqual(PolySynthInstrument(150, create_phrase([60], time_signature)).num_voices, 0)
+        instrument = PolySynthInstrument(150, create_phrase([60], time_signature))
+        instrument.render(10)
+        self.assertEqual(instrument.num_voices, 1)
+        instrument.render(int(SAMPLING_RATE * 0.2))
+        self.assertEqual(instrument.num_voices, 0)
+
+
 class TestTriggerPadInstrument(unittest.TestCase):
 
     def test_trigger_pad_instrument(self):
@@ -136,6 +431,97 @@ class TestTriggerPadInstrument(unittest.TestCase):
                 self.assertGreater(max(note_data), 0.1, msg=error_msg)
 
 
+    def test_drumkit_preload(self):
+        time_signature = rhythm.fourfour
+        phrase = create_phrase(range(0, 8), time_signature)
+        bpm = 150
+        num_samples = int(SAMPLING_RATE * phrase.phrase_endtime_in_seconds(bpm))
+        expected = TriggerPadInstrument({tone: os.path.join("MusicGeneration", "wav_data", "drums", "DR1-%d.WAV" % tone)
+                                         for tone in range(8)}, bpm, phrase).render(num_samples)
+        # The kit's samples are found wherever the current directory is.
+        cwd = os.getcwd()
+        temp_dir = tempfile.mkdtemp()
+        try:
+            os.chdir(temp_dir)
+            bank = SampleBank()
+            eager = DefaultDrumkitInstrument(bpm, phrase, bank=bank)
+            self.assertIsNotNone(eager.load_time)
+            self.assertEqual(len(bank), 42)
+            self.assertEqual(eager.num_bytes, sum(bank.get(f).nbytes for f in eager._note_mapping.values()))
+            lazy = DefaultDrumkitInstrument(bpm, phrase, preload="lazy", bank=SampleBank())
+            numpy.testing.assert_allclose(lazy.render(num_samples), expected)
+            self.assertTrue(lazy.wait_until_loaded(timeout=10.0))
+            self.assertEqual(lazy.num_bytes, eager.num_bytes)
+            numpy.testing.assert_allclose(eager.render(num_samples), expected)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(temp_dir)
+
+    def test_lazy_load_error(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(temp_dir, "broken.WAV")
+            with open(filename, "wb") as f:
+                f.write(b"not a wave file" * 10)
+            pad = TriggerPadInstrument({60: filename}, 150, create_phrase([60], rhythm.fourfour), preload="lazy")
+            with self.assertRaises(IOError) as context:
+                pad.wait_until_loaded(timeout=10.0)
+            self.assertIsNotNone(context.exception.__cause__)
+            with self.assertRaises(IOError):
+                pad.render(100)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_pickle(self):
+        time_signature = rhythm.fourfour
+        phrase = create_phrase(range(0, 8), time_signature)
+        bank = SampleBank()
+        for (pad_bank, preload) in [(None, "lazy"), (bank, "eager")]:
+            pad = DefaultDrumkitInstrument(150, phrase, preload=preload, bank=pad_bank)
+            copy = pickle.loads(pickle.dumps(pad))
+            self.assertIs(copy._bank, sample_bank if pad_bank is None else copy._bank)
+            self.assertTrue(copy.wait_until_loaded())
+            self.assertEqual(copy.render(20000).tolist(), pad.render(20000).tolist())
+        copy = pickle.loads(pickle.dumps(bank))
+        self.assertEqual(len(copy), 42)
+        copy.clear()
+
+    def test_missing_sample(self):
+        note_mapping = {60: os.path.join("MusicGeneration", "wav_data", "drums", "missing.WAV")}
+        for preload in ["eager", "lazy"]:
+            with self.assertRaises(IOError):
+                TriggerPadInstrument(note_mapping, 150, preload=preload)
+
+
+
+class TestProcessInstrument(unittest.TestCase):
+
+    def test_parallel_mix_matches_serial(self):
+        # Spawned workers are sent a pickled copy of each instrument.
+        for context in [None, "spawn"]:
+            self._check_parallel_mix(context)
+
+    def _check_parallel_mix(self, context):
+        time_signature = rhythm.fourfour
+        bpm = 150
+        phrases = [create_phrase([60, 0, 64, 0, 67], time_signature), create_phrase([35, 38, 42, 38], time_signature)]
+        next_phrases = [create_phrase([72, 71, 69], time_signature), create_phrase([36, 0, 36, 40], time_signature)]
+        make_instruments = lambda: [WaveInstrument(bpm, phrases[0]), DefaultDrumkitInstrument(bpm, phrases[1])]
+        instruments = make_instruments()
+        serial = generators.MixerGenerator(instruments, scaling=[0.3, 0.3])
+        remote_instruments = [ProcessInstrument(instrument, context=context) for instrument in make_instruments()]
+        with ParallelMixerGenerator(remote_instruments, scaling=[0.3, 0.3]) as mixer:
+            expected = [serial.render(5000)]
+            data = [mixer.render(5000)]
+            # Phrase events reach each instrument in order.
+            for (instrument, remote, phrase) in zip(instruments, remote_instruments, next_phrases):
+                instrument.phrase_event(self, phrase)
+                remote.phrase_event(self, phrase)
+            num_samples = int(SAMPLING_RATE * 2 * phrases[0].phrase_endtime_in_seconds(bpm))
+            expected.append(serial.render(num_samples))
+            data.append(mixer.render(num_samples))
+        self.assertTrue(numpy.array_equal(numpy.concatenate(data), numpy.concatenate(expected)))
+
 
 def main():
     print("Running unit tests for 'instrument' module")
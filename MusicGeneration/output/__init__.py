@@ -0,0 +1,289 @@
+"""Real-time audio output: plays a SampleGenerator through a sound device.
+
+A producer thread renders fixed-size blocks from the generator into a ring
+buffer, and a backend consumes the ring buffer at the device's pace:
+
+  with PyAudioSink(mixer) as sink:
+    sink.wait()
+
+NullSink and WaveFileSink stand in for a sound card (e.g. for tests, or on
+machines without one). Every sink counts underruns (the device wanted
+samples that were not ready) and overruns (pushed samples that did not fit),
+and reports how much audio is buffered, to help size buffers for live use.
+"""
+
+import threading
+import time
+import numpy
+from MusicGeneration.sample_generators import SAMPLING_RATE
+from MusicGeneration.wavefile import WaveFile
+
+
+DEFAULT_BLOCK_SIZE = 1024
+DEFAULT_NUM_BLOCKS = 4
+
+
+class RingBuffer:
+    """A single-producer, single-consumer ring buffer of float32 frames.
+
+    The producer only ever advances the write count and the consumer only
+    ever advances the read count, so the two sides can run in different
+    threads without a lock.
+    """
+    def __init__(self, capacity, num_channels=1):
+        self._capacity = capacity
+        self._data = numpy.zeros((capacity, num_channels), dtype=numpy.float32)
+        self._num_written = 0
+        self._num_read = 0
+
+    @property
+    def capacity(self): return self._capacity
+
+    @property
+    def available(self):
+        """The number of frames that can be read."""
+        return self._num_written - self._num_read
+
+    @property
+    def free(self):
+        """The number of frames that can be written."""
+        return self._capacity - self.available
+
+    def write(self, frames):
+        """Copies as many of the (frames x channels) frames as fit, and
+        returns how many were written."""
+        num_frames = min(len(frames), self.free)
+        start = self._num_written % self._capacity
+        first = min(num_frames, self._capacity - start)
+        self._data[start:start + first] = frames[:first]
+        self._data[:num_frames - first] = frames[first:num_frames]
+        self._num_written += num_frames
+        return num_frames
+
+    def read(self, out):
+        """Fills the start of out (frames x channels) with as many frames as
+        are available, and returns how many were read."""
+        num_frames = min(len(out), self.available)
+        start = self._num_read % self._capacity
+        first = min(num_frames, self._capacity - start)
+        out[:first] = self._data[start:start + first]
+        out[first:num_frames] = self._data[:num_frames - first]
+        self._num_read += num_frames
+        return num_frames
+
+
+class OutputSink:
+    """Base class for sinks that play a SampleGenerator.
+
+    The buffer holds num_blocks blocks of block_size frames. Subclasses
+    implement _start_backend() and _stop_backend(), and their device calls
+    pull() for each block it needs. With no source, blocks are pushed with
+    write() instead.
+    """
+    def __init__(self, source, block_size=DEFAULT_BLOCK_SIZE, num_blocks=DEFAULT_NUM_BLOCKS,
+                 sampling_rate=SAMPLING_RATE, num_channels=None):
+        assert num_blocks >= 1
+        self._source = source
+        self._block_size = block_size
+        self._sampling_rate = sampling_rate
+        if num_channels is None:
+            num_channels = source.num_channels if source else 1
+        self._num_channels = num_channels
+        self._ring = RingBuffer(block_size * num_blocks, self._num_channels)
+        self._underruns = 0
+        self._overruns = 0
+        self._min_available = None
+        self._running = False
+        self._producer = None
+
+    def fill(self):
+        """Renders blocks from the source until the buffer is full, and
+        returns the number of frames rendered."""
+        num_frames = 0
+        if self._source is None: return num_frames
+        while self._ring.free >= self._block_size and not self._source_finished():
+            block = self._source.render_channels(self._block_size)
+            num_frames += self._ring.write(block.T)
+        return num_frames
+
+    def write(self, block):
+        """Pushes a planar (channels x frames) block, for callers that produce
+        their own blocks instead of using a source. Frames that do not fit
+        are dropped, and counted as an overrun."""
+        block = numpy.asarray(block, dtype=numpy.float32).reshape(self._num_channels, -1)
+        if self._ring.write(block.T) < block.shape[1]:
+            self._overruns += 1
+
+    def pull(self, num_frames):
+        """Returns the next num_frames interleaved (frames x channels) float32
+        frames for the device. Frames that are not ready are played as
+        silence, and counted as an underrun."""
+        available = self._ring.available
+        if self._min_available is None or available < self._min_available:
+            self._min_available = available
+        frames = numpy.zeros((num_frames, self._num_channels), dtype=numpy.float32)
+        if self._ring.read(frames) < num_frames and not self._source_finished():
+            self._underruns += 1
+        return frames
+
+    def _source_finished(self):
+        return self._source is not None and self._source.is_finished()
+
+    def is_finished(self):
+        """Returns True once the source has finished and has been played."""
+        return self._source_finished() and self._ring.available == 0
+
+    def _produce(self):
+        block_time = self._block_size / self._sampling_rate
+        while self._running and not self._source_finished():
+            if not self.fill():
+                # Wait for the device to make room.
+                time.sleep(block_time / 4)
+
+    def start(self):
+        """Primes the buffer, then starts the producer thread and the device."""
+        assert not self._running
+        self._running = True
+        self.fill()
+        self._producer = threading.Thread(target=self._produce, name="OutputSink producer", daemon=True)
+        self._producer.start()
+        self._start_backend()
+
+    def stop(self):
+        if not self._running: return
+        self._running = False
+        self._producer.join()
+        self._stop_backend()
+
+    def _start_backend(self):
+        raise Exception("Base Class needs to be subclassed")
+
+    def _stop_backend(self):
+        raise Exception("Base Class needs to be subclassed")
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    @property
+    def underruns(self): return self._underruns
+
+    @property
+    def overruns(self): return self._overruns
+
+    @property
+    def latency(self):
+        """Seconds of audio currently buffered between the producer and the device."""
+        return self._ring.available / self._sampling_rate
+
+    @property
+    def max_latency(self):
+        """Seconds of audio that the buffer can hold."""
+        return self._ring.capacity / self._sampling_rate
+
+    @property
+    def min_latency(self):
+        """The least audio (in seconds) that was buffered when the device
+        asked for a block. Close to zero means the buffer is too small."""
+        if self._min_available is None: return None
+        return self._min_available / self._sampling_rate
+
+
+class SimulatedDeviceSink(OutputSink):
+    """A sink whose "device" is a thread that pulls one block every block
+    period (or as fast as it can, if realtime is False) and passes it to
+    _consume(). process() pulls blocks without a thread, for tests."""
+    def __init__(self, source, block_size=DEFAULT_BLOCK_SIZE, num_blocks=DEFAULT_NUM_BLOCKS,
+                 sampling_rate=SAMPLING_RATE, num_channels=None, realtime=True):
+        OutputSink.__init__(self, source, block_size, num_blocks, sampling_rate, num_channels)
+        self._realtime = realtime
+        self._device = None
+
+    def process(self, num_blocks):
+        """Pulls and consumes num_blocks blocks straight away."""
+        for _ in range(num_blocks):
+            self._consume(self.pull(self._block_size))
+
+    def _run_device(self):
+        block_time = self._block_size / self._sampling_rate
+        next_time = time.perf_counter()
+        while self._running and not self.is_finished():
+            self._consume(self.pull(self._block_size))
+            if self._realtime:
+                next_time += block_time
+                time.sleep(max(0.0, next_time - time.perf_counter()))
+
+    def _start_backend(self):
+        self._device = threading.Thread(target=self._run_device, name="OutputSink device", daemon=True)
+        self._device.start()
+
+    def _stop_backend(self):
+        self._device.join()
+        self._device = None
+
+    def wait(self, timeout=None):
+        """Waits until the source has finished playing."""
+        self._device.join(timeout)
+
+    def _consume(self, frames):
+        raise Exception("Base Class needs to be subclassed")
+
+
+class NullSink(SimulatedDeviceSink):
+    """A sink that discards the audio, with a sound card's timing."""
+    def _consume(self, frames):
+        pass
+
+
+class WaveFileSink(SimulatedDeviceSink):
+    """A sink that writes what would have been played to a WAV file,
+    including the silence of any underruns. Extra arguments are passed on
+    to WaveFile."""
+    def __init__(self, source, filename, block_size=DEFAULT_BLOCK_SIZE, num_blocks=DEFAULT_NUM_BLOCKS,
+                 sampling_rate=SAMPLING_RATE, num_channels=None, realtime=True, **wavefile_args):
+        SimulatedDeviceSink.__init__(self, source, block_size, num_blocks, sampling_rate, num_channels, realtime)
+        self._wave_file = WaveFile(filename, num_channels=self._num_channels, sampling_rate=sampling_rate,
+                                   **wavefile_args)
+
+    def _consume(self, frames):
+        self._wave_file.writeData(frames.T)
+
+    def close(self):
+        self.stop()
+        self._wave_file.close()
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+class PyAudioSink(OutputSink):
+    """A sink that plays through the default sound device with PyAudio."""
+    def _start_backend(self):
+        import pyaudio
+        self._pyaudio = pyaudio.PyAudio()
+
+        def callback(in_data, frame_count, time_info, status):
+            frames = self.pull(frame_count)
+            flag = pyaudio.paComplete if self.is_finished() else pyaudio.paContinue
+            return (frames.tobytes(), flag)
+
+        self._stream = self._pyaudio.open(format=pyaudio.paFloat32, channels=self._num_channels,
+                                          rate=self._sampling_rate, output=True,
+                                          frames_per_buffer=self._block_size, stream_callback=callback)
+        self._stream.start_stream()
+
+    def _stop_backend(self):
+        self._stream.stop_stream()
+        self._stream.close()
+        self._pyaudio.terminate()
+
+    def wait(self, timeout=None):
+        """Waits until the source has finished playing."""
+        start = time.perf_counter()
+        while self._stream.is_active():
+            if timeout is not None and time.perf_counter() - start > timeout:
+                return
+            time.sleep(self._block_size / self._sampling_rate)
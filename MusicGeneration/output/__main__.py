@@ -0,0 +1,6 @@
+"""Real-time audio output. Run with: python -m MusicGeneration.output"""
+
+from .unit_tests import *
+
+print("Running main 'output' code")
+main()
@@ -0,0 +1,99 @@
+"""Unit tests for real-time audio output."""
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+
+from . import *
+from MusicGeneration.sample_generators import generators
+from MusicGeneration.wavefile import WaveReader, FLOAT32
+
+
+class TestRingBuffer(unittest.TestCase):
+    def test_wrap_around(self):
+        ring = RingBuffer(8, num_channels=2)
+        frames = numpy.arange(20, dtype=numpy.float32).reshape(10, 2)
+        self.assertEqual(ring.write(frames[:6]), 6)
+        out = numpy.zeros((4, 2), dtype=numpy.float32)
+        self.assertEqual(ring.read(out), 4)
+        self.assertEqual(out.tolist(), frames[:4].tolist())
+        # Only 6 of the 8 frames fit.
+        self.assertEqual(ring.write(frames[2:]), 6)
+        self.assertEqual(ring.available, 8)
+        self.assertEqual(ring.free, 0)
+        out = numpy.zeros((10, 2), dtype=numpy.float32)
+        self.assertEqual(ring.read(out), 8)
+        self.assertEqual(out[:8].tolist(), frames[4:6].tolist() + frames[2:8].tolist())
+
+
+class TestOutputSinks(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_underruns_and_latency(self):
+        sink = NullSink(generators.SineWaveGenerator(440), block_size=100, num_blocks=3)
+        self.assertAlmostEqual(sink.max_latency, 300 / SAMPLING_RATE)
+        self.assertEqual(sink.fill(), 300)
+        self.assertAlmostEqual(sink.latency, 300 / SAMPLING_RATE)
+        sink.process(2)
+        self.assertEqual(sink.underruns, 0)
+        self.assertAlmostEqual(sink.min_latency, 200 / SAMPLING_RATE)
+        # The producer fell behind.
+        sink.process(2)
+        self.assertEqual(sink.underruns, 1)
+        self.assertEqual(sink.min_latency, 0.0)
+        self.assertFalse(sink.is_finished())
+
+    def test_overruns(self):
+        sink = NullSink(None, block_size=100, num_blocks=2, num_channels=2)
+        sink.write(numpy.zeros((2, 150)))
+        self.assertEqual(sink.overruns, 0)
+        sink.write(numpy.zeros((2, 100)))
+        self.assertEqual(sink.overruns, 1)
+        self.assertAlmostEqual(sink.latency, 200 / SAMPLING_RATE)
+
+    def test_wave_file_sink(self):
+        filename = os.path.join(self._dir, "sink.wav")
+        source = generators.MixerGenerator(num_channels=2)
+        source.add(generators.BufferGenerator(numpy.linspace(-1.0, 1.0, 1000)), pan=-0.5)
+        expected = generators.MixerGenerator(num_channels=2)
+        expected.add(generators.BufferGenerator(numpy.linspace(-1.0, 1.0, 1000)), pan=-0.5)
+        expected = expected.render_channels(1000)
+        sink = WaveFileSink(source, filename, block_size=128, sample_format=FLOAT32)
+        # Produce and play one block at a time, without threads, so the
+        # result does not depend on scheduling.
+        while not sink.is_finished():
+            sink.fill()
+            sink.process(1)
+        sink.close()
+        with WaveReader(filename) as reader:
+            self.assertEqual(reader.num_channels, 2)
+            data = reader.read(0, reader.num_frames)
+        # Whole blocks are played, so the end is padded with silence.
+        self.assertEqual(sink.underruns, 0)
+        self.assertEqual(data.shape, (2, 1024))
+        numpy.testing.assert_allclose(data[:, :1000], expected)
+        self.assertEqual(numpy.abs(data[:, 1000:]).max(), 0.0)
+
+    def test_realtime_null_sink(self):
+        source = generators.DelayedGenerator(generators.BufferGenerator(numpy.ones(2205)), start_time=0.0)
+        sink = NullSink(source, block_size=441)
+        start = time.perf_counter()
+        with sink:
+            sink.wait(timeout=10.0)
+        # Five blocks of 10ms, paced like a sound card.
+        self.assertGreaterEqual(time.perf_counter() - start, 0.04)
+        self.assertTrue(sink.is_finished())
+
+
+def main():
+    print("Running unit tests for 'output' module")
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""Dynamics processing: a lookahead limiter and two-pass normalization."""
+
+import tempfile
+import numpy
+from . import SAMPLING_RATE
+from .generators import SampleGenerator
+
+
+DEFAULT_BLOCK_SIZE = 2 ** 14
+
+
+def _sliding_minimum(values, window):
+    """Returns the minimum of every window of consecutive values.
+
+    Uses the van Herk/Gil-Werman algorithm: with values cut into chunks of
+    window, each window is covered by the end of one chunk and the start
+    of the next, so its minimum is that of a suffix minimum and a prefix
+    minimum. This costs O(1) per value, whatever the window.
+    """
+    num_windows = len(values) - window + 1
+    chunks = numpy.full(-(-len(values) // window) * window, numpy.inf)
+    chunks[:len(values)] = values
+    chunks = chunks.reshape(-1, window)
+    prefixes = numpy.minimum.accumulate(chunks, axis=1).ravel()
+    suffixes = numpy.minimum.accumulate(chunks[:, ::-1], axis=1)[:, ::-1].ravel()
+    return numpy.minimum(suffixes[:num_windows], prefixes[window - 1:window - 1 + num_windows])
+
+
+class LimiterGenerator(SampleGenerator):
+    """A lookahead peak limiter, to put at the end of a generator chain.
+
+    The output is the source delayed by the lookahead time, with a gain
+    that starts ramping down lookahead seconds before each peak, so that no
+    sample ever exceeds ceiling. The gain recovers linearly, taking release
+    seconds to come back up from silence to 1.0. All channels share one
+    gain, so the stereo image does not move.
+    """
+    def __init__(self, source, ceiling=0.98, lookahead=0.005, release=0.1, sampling_rate=SAMPLING_RATE):
+        SampleGenerator.__init__(self, sampling_rate, source.num_channels)
+        self._source = source
+        self._ceiling = ceiling
+        self._window = max(1, int(round(lookahead * sampling_rate)))
+        self._release_step = 1.0 / max(1.0, release * sampling_rate)
+        # The last window - 1 inputs (the delay line), required gains and
+        # held gains, and the last gain after release.
+        history = self._window - 1
+        self._delay_line = numpy.zeros((self._num_channels, history))
+        self._required_gains = numpy.ones(history)
+        self._held_gains = numpy.ones(history)
+        self._gain = 1.0
+        self._remaining_tail = history
+
+    def _process(self, num_samples):
+        if self._source.is_finished():
+            # Flush the delay line with silence.
+            data = numpy.zeros((self._num_channels, num_samples))
+            self._remaining_tail -= num_samples
+            if self._remaining_tail <= 0:
+                self._finished = True
+        else:
+            data = self._source._render_channels(num_samples)
+        window = self._window
+        peaks = numpy.abs(data).max(axis=0)
+        required = numpy.minimum(1.0, self._ceiling / numpy.maximum(peaks, 1e-30))
+        # The lowest gain required by any sample in the lookahead window.
+        required = numpy.concatenate([self._required_gains, required])
+        held = _sliding_minimum(required, window)
+        self._required_gains = required[num_samples:]
+        # Linear release: gain[n] = min(held[n], gain[n-1] + step), computed
+        # as a running minimum of the gains with the ramp taken out.
+        ramp = self._release_step * numpy.arange(1, num_samples + 1)
+        gains = numpy.minimum.accumulate(numpy.minimum(held - ramp, self._gain)) + ramp
+        self._gain = gains[-1]
+        # Average over the window, so that the gain ramps down smoothly and
+        # reaches its target as the peak leaves the delay line.
+        gains = numpy.concatenate([self._held_gains, gains])
+        sums = numpy.cumsum(numpy.concatenate([[0.0], gains]))
+        smoothed = (sums[window:] - sums[:-window]) / window
+        self._held_gains = gains[num_samples:]
+        delayed = numpy.concatenate([self._delay_line, data], axis=1)
+        self._delay_line = delayed[:, num_samples:]
+        return delayed[:, :num_samples] * smoothed
+
+    def _get(self):
+        return float(self._process(1).mean(axis=0)[0])
+
+    def _render_channels(self, num_samples):
+        self._time += self._sample_time * num_samples
+        return self._process(num_samples)
+
+    def _render(self, num_samples):
+        data = self._render_channels(num_samples)
+        return data[0] if self._num_channels == 1 else data.mean(axis=0)
+
+
+class NormalizedGenerator(SampleGenerator):
+    """Plays the first num_samples of a source, normalized as a whole.
+
+    The first pass renders the source block by block into a float32 scratch
+    file (memory-mapped, so hours of audio use constant RAM) while measuring
+    its peak and RMS levels. Playing the generator is the second pass, which
+    streams the scratch file back with one gain applied: the gain that
+    brings the peak to target_peak, or the RMS level to target_rms if
+    given (whichever is quieter).
+    """
+    def __init__(self, source, num_samples, target_peak=0.98, target_rms=None,
+                 block_size=DEFAULT_BLOCK_SIZE, sampling_rate=SAMPLING_RATE):
+        SampleGenerator.__init__(self, sampling_rate, source.num_channels)
+        self._num_frames = num_samples
+        self._scratch_file = tempfile.TemporaryFile()
+        self._scratch = numpy.memmap(self._scratch_file, dtype=numpy.float32, mode="w+",
+                                     shape=(max(1, num_samples), self._num_channels))
+        peak = 0.0
+        sum_of_squares = 0.0
+        for start in range(0, num_samples, block_size):
+            block = source.render_channels(min(block_size, num_samples - start))
+            self._scratch[start:start + block.shape[1]] = block.T
+            peak = max(peak, float(numpy.abs(block).max()))
+            sum_of_squares += float(numpy.square(block, dtype=numpy.float64).sum())
+        self._scratch.flush()
+        self._peak = peak
+        self._rms = (sum_of_squares / max(1, num_samples * self._num_channels)) ** 0.5
+        gains = [1.0]
+        if peak > 0.0:
+            gains = [target_peak / peak]
+            if target_rms is not None:
+                gains.append(target_rms / self._rms)
+        self._gain = min(gains)
+        self._index = 0
+        self._finished = (num_samples == 0)
+
+    @property
+    def peak(self):
+        """The peak level of the source, before normalization."""
+        return self._peak
+
+    @property
+    def rms(self):
+        """The RMS level of the source, before normalization."""
+        return self._rms
+
+    @property
+    def gain(self): return self._gain
+
+    def _get(self):
+        if self._index >= self._num_frames:
+            self._finished = True
+            return 0.0
+        value = float(self._scratch[self._index].mean()) * self._gain
+        self._index += 1
+        if self._index >= self._num_frames:
+            self._finished = True
+        return value
+
+    def _render_channels(self, num_samples):
+        self._time += self._sample_time * num_samples
+        data = numpy.zeros((self._num_channels, num_samples))
+        chunk = self._scratch[self._index:min(self._index + num_samples, self._num_frames)]
+        data[:, :len(chunk)] = chunk.T * self._gain
+        self._index += len(chunk)
+        if self._index >= self._num_frames:
+            self._finished = True
+        return data
+
+    def _render(self, num_samples):
+        data = self._render_channels(num_samples)
+        return data[0] if self._num_channels == 1 else data.mean(axis=0)
+
+    def close(self):
+        """Deletes the scratch file."""
+        self._scratch = None
+        self._scratch_file.close()
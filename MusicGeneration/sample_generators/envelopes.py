@@ -1,24 +1,78 @@
 """Various volume envelopes."""
 
+import math
+import numpy
 from . import SAMPLING_RATE
 from .generators import SampleGenerator
 
 
+_zeros = numpy.zeros(0)
+
+
+def _zero_block(num_samples):
+    """Returns a read-only block of num_samples zeros, shared by all callers."""
+    global _zeros
+    if len(_zeros) < num_samples:
+        _zeros = numpy.zeros(num_samples)
+        _zeros.flags.writeable = False
+    return _zeros[:num_samples]
+
+
 class Envelope(SampleGenerator):
-    """The Envelope base-class."""
+    """The Envelope base-class.
+
+    Subclasses implement _get_multiplier() for the current time, and
+    _get_multipliers() for a block of times. Envelopes that end set
+    _end_time; once it has passed, blocks are a shared zero block and the
+    source is no longer pulled.
+
+    The source may also be any iterator of samples, which is then pulled
+    one sample at a time.
+    """
     def __init__(self, source, sampling_rate=SAMPLING_RATE):
         SampleGenerator.__init__(self, sampling_rate)
         self._source = source.__iter__()
+        self._source_is_generator = isinstance(self._source, SampleGenerator)
+        self._end_time = None
 
     def _get(self):
         # Returns early if finished, which is efficient but will no longer
         # be requesting any samples from _source.
         if self._finished: return 0.0
-        return self._source.__next__() * self._get_multiplier()
+        value = self._source.__next__() * self._get_multiplier()
+        if self._source_is_generator and self._source.is_finished():
+            self._finished = True
+        return value
+
+    def _render(self, num_samples):
+        if not self._source_is_generator:
+            return SampleGenerator._render(self, num_samples)
+        if self._finished or num_samples == 0:
+            self._time += self._sample_time * num_samples
+            return _zero_block(num_samples)
+        times = self._advance_time(num_samples)
+        num_active = num_samples
+        if self._end_time is not None:
+            # Like _get(), the source is pulled up to and including the first
+            # sample at or after the end time.
+            num_active = min(num_samples, numpy.searchsorted(times, self._end_time) + 1)
+            if times[num_active - 1] >= self._end_time:
+                self._finished = True
+        data = self._source._render(num_active) * self._get_multipliers(times[:num_active])
+        if self._source.is_finished():
+            self._finished = True
+        if num_active < num_samples:
+            data = numpy.concatenate([data, _zero_block(num_samples - num_active)])
+        return data
 
     def _get_multiplier(self):
         raise Exception("Base Class needs to be subclassed")
 
+    def _get_multipliers(self, times):
+        """Returns the gain for each of the given times (an array, or a scalar
+        for a constant gain)."""
+        raise Exception("Base Class needs to be subclassed")
+
 
 class VolumeEnvelope(Envelope):
     def __init__(self, source, volume, sampling_rate=SAMPLING_RATE):
@@ -28,6 +82,9 @@ class VolumeEnvelope(Envelope):
     def _get_multiplier(self):
         return self._volume
 
+    def _get_multipliers(self, times):
+        return self._volume
+
 
 class StandardEnvelope(Envelope):
     def __init__(self, source, attack=0.1, decay=0.1, peak=1, level=0.8,
@@ -41,6 +98,7 @@ class StandardEnvelope(Envelope):
         self._decay = decay + attack
         self._sustain = sustain + decay + attack
         self._release = release + sustain + decay + attack
+        self._end_time = self._release
 
     def _get_multiplier(self):
         if self._time < self._attack:
@@ -54,4 +112,105 @@ class StandardEnvelope(Envelope):
         self._finished = True
         return 0.0
 
+    def _get_multipliers(self, times):
+        # Split the block at the segment boundaries, and compute each
+        # segment's ramp with the same expression as _get_multiplier().
+        (attack, decay, sustain, release) = numpy.searchsorted(
+            times, [self._attack, self._decay, self._sustain, self._release])
+        gains = numpy.empty(len(times))
+        gains[:attack] = self._peak * times[:attack] / self._attack
+        gains[attack:decay] = self._peak - (self._peak - self._level) * (
+            times[attack:decay] - self._attack) / (self._decay - self._attack)
+        gains[decay:sustain] = self._level
+        gains[sustain:release] = self._level * (
+            1.0 - (times[sustain:release] - self._sustain) / (self._release - self._sustain))
+        gains[release:] = 0.0
+        return gains
+
+
+# How sharply "exp" segments bend. They follow an RC-style charging curve,
+# making most of their change early on, scaled to end exactly on target.
+EXP_CURVATURE = 5.0
+
+
+def _linear_curve(x):
+    return x
+
+
+def _exp_curve(x):
+    return (1.0 - numpy.exp(-EXP_CURVATURE * x)) / (1.0 - math.exp(-EXP_CURVATURE))
+
+
+def _s_curve(x):
+    return 0.5 - 0.5 * numpy.cos(math.pi * x)
+
+
+# Maps a segment curve name to a function that maps 0.0 .. 1.0 (the fraction
+# of the segment's duration) to the fraction of the way to its target level.
+CURVES = {
+    "linear": _linear_curve,
+    "exp": _exp_curve,
+    "scurve": _s_curve,
+}
+
+
+_gain_tables = {}
+
+
+def get_gain_table(segments, start_level=0.0, sampling_rate=SAMPLING_RATE):
+    """Returns the shared, read-only gain table for a breakpoint envelope.
+
+    segments is a sequence of (duration, level, curve) tuples: each segment
+    moves from the previous level (start_level for the first one) to level
+    over duration seconds, following the named curve. Entry k of the table
+    is the gain at time k / sampling_rate, and the last entry is 0.0 (the
+    envelope has ended).
+    """
+    segments = tuple((duration, level, curve) for (duration, level, curve) in segments)
+    key = (segments, start_level, sampling_rate)
+    if key not in _gain_tables:
+        total = sum(duration for (duration, _, _) in segments)
+        times = numpy.arange(int(math.ceil(total * sampling_rate))) / sampling_rate
+        table = numpy.zeros(len(times) + 1)
+        (start_time, from_level) = (0.0, start_level)
+        for (duration, level, curve) in segments:
+            assert duration >= 0 and curve in CURVES
+            end_time = start_time + duration
+            (first, last) = numpy.searchsorted(times, [start_time, end_time])
+            if last > first:
+                x = (times[first:last] - start_time) / duration
+                table[first:last] = from_level + (level - from_level) * CURVES[curve](x)
+            (start_time, from_level) = (end_time, level)
+        table.flags.writeable = False
+        _gain_tables[key] = table
+    return _gain_tables[key]
+
+
+class BreakpointEnvelope(Envelope):
+    """A multi-segment envelope made of linear, exponential and S-curve segments.
+
+    See get_gain_table() for the segments. Envelopes with the same segments
+    share one precomputed gain table, so each note only costs a multiply.
+
+      # A plucked note: fast attack, exponential decay to silence.
+      BreakpointEnvelope(source, [(0.01, 1.0, "linear"), (0.5, 0.0, "exp")])
+    """
+    def __init__(self, source, segments, start_level=0.0, sampling_rate=SAMPLING_RATE):
+        Envelope.__init__(self, source, sampling_rate)
+        self._table = get_gain_table(segments, start_level, sampling_rate)
+        # The table's last entry is the first sample after the envelope.
+        self._end_time = (len(self._table) - 1.5) / sampling_rate
+
+    def _get_multiplier(self):
+        index = int(round(self._time * self._sampling_rate))
+        if index >= len(self._table) - 1:
+            self._finished = True
+            return 0.0
+        return self._table[index]
 
+    def _get_multipliers(self, times):
+        start = int(round(times[0] * self._sampling_rate))
+        gains = self._table[start:start + len(times)]
+        if len(gains) < len(times):
+            gains = numpy.concatenate([gains, numpy.zeros(len(times) - len(gains))])
+        return gains
@@ -1,10 +1,13 @@
 """Various sample generator classes."""
 
-import array
+import heapq
+import itertools
 import math
-import random
-import wave
+import numpy
 from . import SAMPLING_RATE
+from . import resampling
+from .sample_banks import sample_bank
+from MusicGeneration.wavefile import WaveReader
 
 
 class SampleGenerator:
@@ -15,9 +18,20 @@ class SampleGenerator:
     (i) an iterator, useful for applying volume envelopes to wave data
     or
     (ii) a source of "whole wave" segements, via the get(num_samples) method.
+    or
+    (iii) a source of numpy blocks, via the render(num_samples) method.
+    or
+    (iv) a source of planar (channels x frames) numpy blocks, via the
+    render_channels(num_samples) method.
+
+    Subclasses implement _get() to produce one sample, and may also override
+    _render() to produce a whole block with vectorized math. Multichannel
+    generators override _render_channels(); their _get() and _render() return
+    the mono downmix.
     """
-    def __init__(self, sampling_rate):
+    def __init__(self, sampling_rate, num_channels=1):
         self._sampling_rate = sampling_rate
+        self._num_channels = num_channels
         self._sample_time = 1.0 / sampling_rate
         # _time represents the time of the last sample generated
         self._time = -self._sample_time
@@ -36,16 +50,64 @@ class SampleGenerator:
     def _get(self):
         raise Exception("Base Class needs to be subclassed")
 
+    def _render(self, num_samples):
+        """Returns the next num_samples samples as a numpy float64 array.
+
+        The default implementation falls back to one _get() call per sample
+        (or downmixes _render_channels() for multichannel generators).
+        Vectorized overrides must advance the clock themselves, usually via
+        _advance_time().
+        """
+        if self._num_channels > 1:
+            return self._render_channels(num_samples).mean(axis=0)
+        return numpy.fromiter((self.__next__() for _ in range(num_samples)),
+                              dtype=numpy.float64, count=num_samples)
+
+    def _render_channels(self, num_samples):
+        """Returns the next num_samples frames as a (channels x frames) array."""
+        return self._render(num_samples)[numpy.newaxis, :]
+
+    def _advance_time(self, num_samples):
+        """Advances the clock by num_samples and returns each sample's time.
+
+        The times are accumulated exactly as __next__() would accumulate them,
+        so block and per-sample rendering produce identical samples.
+        """
+        steps = numpy.full(num_samples + 1, self._sample_time)
+        steps[0] = self._time
+        times = numpy.cumsum(steps)[1:]
+        if num_samples:
+            self._time = times[-1]
+        return times
+
+    def render(self, num_samples):
+        """Returns a numpy float32 array of the next num_samples samples."""
+        assert num_samples >= 0
+        return self._render(num_samples).astype(numpy.float32)
+
+    def render_channels(self, num_samples):
+        """Returns a planar (channels x frames) numpy float32 array of the next
+        num_samples frames."""
+        assert num_samples >= 0
+        return self._render_channels(num_samples).astype(numpy.float32)
+
     def get(self, num_samples):
         """Returns a list of floating point samples."""
         if num_samples == 0: return []
         assert num_samples > 0
-        return [self.__next__() for _ in range(num_samples)]
+        return self._render(num_samples).tolist()
 
     def getTime(self):
         """Returns the time of the next sample."""
         return self._time + self._sample_time
 
+    def is_finished(self):
+        """Returns True if the generator will only return 0.0 from now on."""
+        return self._finished
+
+    @property
+    def num_channels(self): return self._num_channels
+
 
 class ConstantGenerator(SampleGenerator):
     """A Sine-wave sample generator."""
@@ -56,22 +118,37 @@ class ConstantGenerator(SampleGenerator):
     def _get(self):
         return self._constant
 
+    def _render(self, num_samples):
+        self._advance_time(num_samples)
+        return numpy.full(num_samples, self._constant, dtype=numpy.float64)
 
-class SineWaveGenerator(SampleGenerator):
+
+class OscillatorGenerator(SampleGenerator):
+    """Base class for oscillators whose output is a function of their clock,
+    so they can be started anywhere in their waveform."""
+    def seek(self, time):
+        """Moves the oscillator so that the next sample is the one at time."""
+        self._time = time - self._sample_time
+
+
+class SineWaveGenerator(OscillatorGenerator):
     """A Sine-wave sample generator."""
     def __init__(self, freq, sampling_rate=SAMPLING_RATE):
-        SampleGenerator.__init__(self, sampling_rate)
+        OscillatorGenerator.__init__(self, sampling_rate)
         self._freq = freq
         self._freq_constant = 2 * math.pi * self._freq
 
     def _get(self):
         return math.sin(self._freq_constant * self._time)
 
+    def _render(self, num_samples):
+        return numpy.sin(self._freq_constant * self._advance_time(num_samples))
+
 
-class SquareWaveGenerator(SampleGenerator):
+class SquareWaveGenerator(OscillatorGenerator):
     """A Square-wave sample generator."""
     def __init__(self, freq, sampling_rate=SAMPLING_RATE):
-        SampleGenerator.__init__(self, sampling_rate)
+        OscillatorGenerator.__init__(self, sampling_rate)
         self._freq = freq
         self._cycle_time = 1.0 / self._freq
 
@@ -79,11 +156,15 @@ class SquareWaveGenerator(SampleGenerator):
         cycle_position = (self._time % self._cycle_time) / self._cycle_time
         return 1.0 if cycle_position < 0.5 else -1.0
 
+    def _render(self, num_samples):
+        cycle_position = (self._advance_time(num_samples) % self._cycle_time) / self._cycle_time
+        return numpy.where(cycle_position < 0.5, 1.0, -1.0)
+
 
-class SawtoothWaveGenerator(SampleGenerator):
+class SawtoothWaveGenerator(OscillatorGenerator):
     """A Sawtooth-wave sample generator."""
     def __init__(self, freq, sampling_rate=SAMPLING_RATE):
-        SampleGenerator.__init__(self, sampling_rate)
+        OscillatorGenerator.__init__(self, sampling_rate)
         self._freq = freq
         self._cycle_time = 1.0 / self._freq
 
@@ -91,34 +172,92 @@ class SawtoothWaveGenerator(SampleGenerator):
         cycle_position = (self._time % self._cycle_time) / self._cycle_time
         return (cycle_position * 2) - 1
 
+    def _render(self, num_samples):
+        cycle_position = (self._advance_time(num_samples) % self._cycle_time) / self._cycle_time
+        return (cycle_position * 2) - 1
+
+
+class LinearSweep:
+    """Phase of a sweep whose frequency changes linearly with time."""
+    def __init__(self, freq1, freq2, interval, start_phase):
+        self._freq1 = freq1
+        self._rate = (freq2 - freq1) / interval / 2
+
+    def phase(self, time):
+        return 2 * math.pi * time * (self._freq1 + self._rate * time)
+
+
+class ExpSweep:
+    """Phase of a sweep whose frequency changes exponentially with time."""
+    def __init__(self, freq1, freq2, interval, start_phase):
+        self._b = math.log(freq2 / freq1) / interval
+        self._a = 2 * math.pi * freq1 / self._b
+        self._a0 = -self._a + start_phase
+
+    def phase(self, time):
+        return self._a0 + self._a * numpy.exp(self._b * time)
+
+
+# Maps a sweep mode to the class that computes its phase.
+SWEEP_MODES = {
+    "linear": LinearSweep,
+    "exp": ExpSweep,
+}
 
-class SweepWaveGenerator(SampleGenerator):
-    """A Frequency-Sweep sample generator."""
+
+class SweepWaveGenerator(OscillatorGenerator):
+    """A Frequency-Sweep sample generator.
+
+    The phase is a closed-form function of time, so whole blocks are
+    computed at once and seek() can jump anywhere in the sweep.
+    """
     def __init__(self, freq1, freq2, interval, mode="linear", start_phase=0.0, sampling_rate=SAMPLING_RATE):
-        SampleGenerator.__init__(self, sampling_rate)
+        OscillatorGenerator.__init__(self, sampling_rate)
+        assert mode in SWEEP_MODES
         self._freq1 = freq1
         self._freq2 = freq2
         self._interval = interval
         self._mode = mode
-        self._b = math.log(self._freq2/self._freq1) / self._interval
-        self._a = 2 * math.pi * self._freq1 / self._b
-        self._a0 = -self._a + start_phase
+        self._sweep = SWEEP_MODES[mode](freq1, freq2, interval, start_phase)
 
     def _get(self):
-        if self._mode == "linear":
-            phase = 2 * math.pi * self._time * (self._freq1 + (self._freq2 - self._freq1) * self._time / self._interval / 2)
-        elif self._mode == "exp":
-            phase = self._a0 + self._a * math.exp(self._b * self._time)
-        else:
-            assert False
-        return math.sin(phase)
+        return math.sin(self._sweep.phase(self._time))
+
+    def _render(self, num_samples):
+        return numpy.sin(self._sweep.phase(self._advance_time(num_samples)))
+
+
+class NoiseBank:
+    """A shared, seeded block of white noise, handed out in consecutive slices.
+
+    Drawing excitation noise from a bank is much cheaper than calling
+    random.uniform() per sample, and makes renders reproducible.
+    """
+    def __init__(self, size=2**16, seed=0):
+        self._size = size
+        self.reseed(seed)
+
+    def reseed(self, seed):
+        """Regenerates the noise and restarts from the beginning of the bank."""
+        self._noise = numpy.random.RandomState(seed).uniform(-1.0, 1.0, self._size)
+        self._offset = 0
+
+    def take(self, num_samples):
+        """Returns a new array holding the next num_samples noise values."""
+        indices = (self._offset + numpy.arange(num_samples)) % self._size
+        self._offset = (self._offset + num_samples) % self._size
+        return self._noise[indices]
+
+
+noise_bank = NoiseBank()
 
 
 class GuitarWaveGenerator(SampleGenerator):
-    """A Guitar-string sample generator."""
-    def __init__(self, freq, sampling_rate=SAMPLING_RATE):
+    """A Guitar-string sample generator (Karplus-Strong)."""
+    def __init__(self, freq, sampling_rate=SAMPLING_RATE, noise=None):
         SampleGenerator.__init__(self, sampling_rate)
         self._freq = freq
+        self._noise = noise_bank if noise is None else noise
         self._setup_buffer()
 
     def _setup_buffer(self):
@@ -126,7 +265,7 @@ class GuitarWaveGenerator(SampleGenerator):
         assert self._bufsize > 0
         # TODO(oconaire): We can also initialize this with a squarewave or sawtooth
         # wave to get a different guitar string sound.
-        self._buffer = [random.uniform(-1.0, 1.0) for i in range(self._bufsize)]
+        self._buffer = self._noise.take(self._bufsize)
         self._bufindex = 0;
 
     def _get(self):
@@ -135,6 +274,23 @@ class GuitarWaveGenerator(SampleGenerator):
         self._bufindex = (self._bufindex + 1) % self._bufsize;
         return value
 
+    def _render(self, num_samples):
+        self._time += self._sample_time * num_samples
+        period = self._bufsize
+        if period == 1:
+            return numpy.full(num_samples, self._buffer[0])
+        # Lay out the ring buffer oldest-first, followed by the new samples.
+        # Each output only looks back (period - 1) samples at the latest, so
+        # that many samples can be computed in one vectorized step.
+        data = numpy.empty(period + num_samples)
+        data[:period] = numpy.roll(self._buffer, -self._bufindex)
+        for start in range(period, period + num_samples, period - 1):
+            end = min(start + period - 1, period + num_samples)
+            data[start:end] = (data[start-period:end-period] + data[start-period+1:end-period+1]) / 2.0
+        self._buffer = data[-period:].copy()
+        self._bufindex = 0
+        return data[period:]
+
 
 class DelayedGenerator(SampleGenerator):
     """A delayed sample generator."""
@@ -146,76 +302,409 @@ class DelayedGenerator(SampleGenerator):
     def _get(self):
         if self._time < self._start_time:
             return 0.0
-        return self._source.__next__()
+        value = self._source.__next__()
+        self._finished = self._source.is_finished()
+        return value
+
+    def _render(self, num_samples):
+        times = self._advance_time(num_samples)
+        num_silent = numpy.searchsorted(times, self._start_time)
+        if num_silent == num_samples:
+            return numpy.zeros(num_samples)
+        data = self._source._render(num_samples - num_silent)
+        self._finished = self._source.is_finished()
+        if num_silent == 0:
+            return data
+        return numpy.concatenate([numpy.zeros(num_silent), data])
+
+
+class FadeOutGenerator(SampleGenerator):
+    """Plays a source while fading it out linearly over num_samples, after
+    which it is finished."""
+    def __init__(self, source, num_samples):
+        SampleGenerator.__init__(self, source._sampling_rate, source.num_channels)
+        self._source = source
+        self._fade_samples = num_samples
+        self._remaining = num_samples
+
+    def _gains(self, num_samples):
+        gains = numpy.maximum(0.0, self._remaining - numpy.arange(num_samples)) / self._fade_samples
+        self._remaining = max(0, self._remaining - num_samples)
+        if self._remaining == 0 or self._source.is_finished():
+            self._finished = True
+        return gains
+
+    def _get(self):
+        value = self._source.__next__()
+        return value * self._gains(1)[0]
+
+    def _render_channels(self, num_samples):
+        self._time += self._sample_time * num_samples
+        data = self._source._render_channels(num_samples)
+        return data * self._gains(num_samples)
+
+    def _render(self, num_samples):
+        data = self._render_channels(num_samples)
+        return data[0] if self._num_channels == 1 else data.mean(axis=0)
+
+
+# Ways for a MixerGenerator to pick the source to steal when it is over its
+# voice limit.
+STEAL_POLICIES = ("oldest", "quietest", "retrigger")
+# When sources are mixed one sample at a time, their levels for the
+# "quietest" policy are followed with a peak meter that falls this fast
+# (by a factor of e per LEVEL_RELEASE_TIME seconds).
+LEVEL_RELEASE_TIME = 0.01
 
 
 class MixerGenerator(SampleGenerator):
-    """A sample generator to combines other generators."""
-    def __init__(self, source_list=None, scaling=1.0, sampling_rate=SAMPLING_RATE):
-        SampleGenerator.__init__(self, sampling_rate)
+    """A sample generator to combines other generators.
+
+    Sources are dropped from the mix once they are finished, so the cost per
+    sample only depends on the sources that are still sounding. A mixer whose
+    sources have all been dropped is itself finished, until add() is called.
+
+    Sources added with a start_time wait in a queue, ordered by the sample on
+    which they start, and cost nothing until they are activated.
+
+    With max_voices, at most that many sources play at once: activating a
+    source beyond the limit steals a playing one, chosen by steal_policy
+    ("oldest", "quietest", or "retrigger", which steals a source added with
+    the same voice_key, e.g. the same note, and otherwise the oldest).
+    Stolen sources fade out over fade_time seconds instead of stopping dead,
+    so briefly a few more than max_voices sources may be mixed.
+
+    A mixer can have several output channels. Each source has a gain and a
+    pan (-1.0 is hard left, +1.0 hard right), which are combined into one
+    (output channels x source channels) mixing matrix, so each block is mixed
+    with a single matrix multiply. Mono sources are panned into stereo with a
+    constant-power pan law.
+    """
+    def __init__(self, source_list=None, scaling=1.0, sampling_rate=SAMPLING_RATE, num_channels=1, pan=None,
+                 max_voices=None, steal_policy="oldest", fade_time=0.005):
+        SampleGenerator.__init__(self, sampling_rate, num_channels)
         source_list = [] if source_list is None else source_list
-        self._source_list = source_list
+        self._source_list = list(source_list)
         self._scaling = scaling
+        self._gains = [1.0] * len(source_list)
         if type(self._scaling) == list:
             assert len(scaling) == len(source_list)
+            self._gains = list(scaling)
+            self._scaling = 1.0
+        self._pans = [0.0] * len(source_list) if pan is None else list(pan)
+        assert len(self._pans) == len(source_list)
+        self._voice_keys = [None] * len(source_list)
+        # The peak level of each source (after its gain) in the last block,
+        # only measured for the "quietest" policy. Sources that have not
+        # played yet are never the quietest.
+        self._levels = [math.inf] * len(source_list)
+        self._level_decay = math.exp(-1.0 / (LEVEL_RELEASE_TIME * sampling_rate))
+        assert steal_policy in STEAL_POLICIES
+        self._max_voices = max_voices
+        self._steal_policy = steal_policy
+        self._fade_samples = max(1, int(round(fade_time * sampling_rate)))
+        self._matrix = None
+        self._downmix_gains = None
+        # Index of the next sample to be generated.
+        self._sample_index = 0
+        # Heap of (start_sample, sequence_number, source, gain, pan, voice_key) for
+        # sources that have not started yet. The sequence number keeps the
+        # order of add() calls for sources starting on the same sample.
+        self._pending_sources = []
+        self._sequence = itertools.count()
 
-    # TODO(oconaire): Include a MarkFinished() method in Generator, which will tell listeners
-    # that it's being marked as finished. That way, the mixer can remove it.
     def _get(self):
+        self._activate_pending_sources()
+        self._sample_index += 1
+        self._time = (self._sample_index - 1) * self._sample_time
         if not self._source_list: return 0.0
-        if type(self._scaling) == list:
-            return sum([volume * source.__next__() for (volume, source) in zip(self._scaling, self._source_list)])
-        return self._scaling * sum([source.__next__() for source in self._source_list])
+        values = [source.__next__() for source in self._source_list]
+        value = sum([volume * sample for (volume, sample) in zip(self._get_downmix_gains(), values)])
+        if self._steal_policy == "quietest":
+            for (index, sample) in enumerate(values):
+                level = abs(sample) * self._get_level_gain(index)
+                if self._levels[index] != math.inf:
+                    level = max(level, self._levels[index] * self._level_decay)
+                self._levels[index] = level
+        self._remove_finished_sources()
+        return value
 
-    def add(self, source, start_time=None):
+    def _render_channels(self, num_samples):
+        data = numpy.zeros((self._num_channels, num_samples))
+        offset = 0
+        # Split the block wherever a pending source starts.
+        while offset < num_samples:
+            self._activate_pending_sources()
+            end = num_samples
+            if self._pending_sources:
+                end = min(end, offset + self._pending_sources[0][0] - self._sample_index)
+            self._mix(data[:, offset:end])
+            self._sample_index += end - offset
+            offset = end
+        self._time = (self._sample_index - 1) * self._sample_time
+        return data
+
+    def _render(self, num_samples):
+        data = self._render_channels(num_samples)
+        return data[0] if self._num_channels == 1 else data.mean(axis=0)
+
+    def _mix(self, data):
+        """Writes the mix of the next data.shape[1] samples into data."""
+        if not self._source_list: return
+        num_samples = data.shape[1]
+        matrix = self._get_matrix()
+        source_data = numpy.empty((matrix.shape[1], num_samples))
+        row = 0
+        for (index, source) in enumerate(self._source_list):
+            source_data[row:row + source.num_channels] = source._render_channels(num_samples)
+            if self._steal_policy == "quietest":
+                self._levels[index] = self._get_level_gain(index) * numpy.abs(source_data[row:row + source.num_channels]).max()
+            row += source.num_channels
+        data[:] = numpy.dot(matrix, source_data)
+        self._remove_finished_sources()
+
+    def _get_level_gain(self, index):
+        """The gain that a source's level is measured after."""
+        return abs(self._gains[index] * self._scaling)
+
+    def _get_matrix(self):
+        """Returns the (output channels x total source channels) mixing matrix."""
+        if self._matrix is None:
+            self._matrix = numpy.hstack([self._get_source_matrix(source.num_channels, gain, pan)
+                                         for (source, gain, pan) in zip(self._source_list, self._gains, self._pans)])
+        return self._matrix
+
+    def _get_source_matrix(self, num_channels, gain, pan):
+        gain *= self._scaling
+        if self._num_channels == 1:
+            return numpy.full((1, num_channels), gain / num_channels)
+        if num_channels == 1:
+            if self._num_channels == 2:
+                angle = (pan + 1.0) * math.pi / 4
+                return gain * numpy.array([[math.cos(angle)], [math.sin(angle)]])
+            return numpy.full((self._num_channels, 1), gain)
+        if num_channels == self._num_channels:
+            matrix = gain * numpy.identity(num_channels)
+            if num_channels == 2:
+                # Balance: panning right turns the left channel down, and vice versa.
+                matrix[0, 0] *= min(1.0, 1.0 - pan)
+                matrix[1, 1] *= min(1.0, 1.0 + pan)
+            return matrix
+        return numpy.full((self._num_channels, num_channels), gain / num_channels)
+
+    def _get_downmix_gains(self):
+        """Returns the gain of each source in the mono downmix of the mix."""
+        if self._downmix_gains is None:
+            matrix = self._get_matrix().mean(axis=0)
+            self._downmix_gains = []
+            row = 0
+            for source in self._source_list:
+                self._downmix_gains.append(float(matrix[row:row + source.num_channels].sum()))
+                row += source.num_channels
+        return self._downmix_gains
+
+    def _activate_pending_sources(self):
+        while self._pending_sources and self._pending_sources[0][0] <= self._sample_index:
+            (_, _, source, gain, pan, voice_key) = heapq.heappop(self._pending_sources)
+            self._append_source(source, gain, pan, voice_key)
+
+    def _append_source(self, source, gain, pan, voice_key=None):
+        if self._max_voices is not None:
+            self._steal_voices(voice_key)
+        self._source_list.append(source)
+        self._gains.append(gain)
+        self._pans.append(pan)
+        self._voice_keys.append(voice_key)
+        self._levels.append(math.inf)
+        self._matrix = None
+        self._downmix_gains = None
+
+    def set_max_voices(self, max_voices, steal_policy="oldest"):
+        """Changes the voice limit (None for no limit) and steal policy.
+        Takes effect when the next source is activated."""
+        assert steal_policy in STEAL_POLICIES
+        self._max_voices = max_voices
+        self._steal_policy = steal_policy
+
+    def _steal_voices(self, voice_key):
+        """Fades out playing sources until there is room for one more."""
+        voices = [index for (index, source) in enumerate(self._source_list)
+                  if not isinstance(source, FadeOutGenerator)]
+        while voices and len(voices) >= self._max_voices:
+            victim = voices[0]
+            if self._steal_policy == "quietest":
+                victim = min(voices, key=lambda index: self._levels[index])
+            elif self._steal_policy == "retrigger" and voice_key is not None:
+                victim = next((index for index in voices if self._voice_keys[index] == voice_key), victim)
+            # Same number of channels, so the mixing matrix is unchanged.
+            self._source_list[victim] = FadeOutGenerator(self._source_list[victim], self._fade_samples)
+            voices.remove(victim)
+
+    def _remove_finished_sources(self):
+        finished = [source.is_finished() for source in self._source_list]
+        if not any(finished): return
+        keep = lambda values: [value for (value, done) in zip(values, finished) if not done]
+        self._gains = keep(self._gains)
+        self._pans = keep(self._pans)
+        self._voice_keys = keep(self._voice_keys)
+        self._levels = keep(self._levels)
+        self._source_list = keep(self._source_list)
+        self._matrix = None
+        self._downmix_gains = None
+        self._finished = not self._source_list and not self._pending_sources
+
+    def add(self, source, start_time=None, gain=1.0, pan=0.0, voice_key=None):
+        """Adds a source to the mix.
+
+        If start_time is given, the source starts playing on the sample
+        nearest to that time (in seconds, measured on this mixer's clock).
+        Otherwise it starts with the next sample.
+        voice_key identifies the source for the "retrigger" steal policy.
+        """
         if start_time:
             assert start_time > 0
-            self._source_list.append(
-                    DelayedGenerator(source, start_time - self.getTime(), self._sampling_rate))
+            start_sample = int(round(start_time * self._sampling_rate))
+            heapq.heappush(self._pending_sources,
+                           (start_sample, next(self._sequence), source, gain, pan, voice_key))
         else:
-            self._source_list.append(source)
+            self._append_source(source, gain, pan, voice_key)
+        self._finished = False
 
 
-class WaveFileGenerator(SampleGenerator):
-    """A sample generator made from a WAV file."""
-    def __init__(self, filename, sampling_rate=SAMPLING_RATE):
+class ResampleGenerator(SampleGenerator):
+    """Plays a generator running at one sampling rate at another rate."""
+    def __init__(self, source, source_rate, sampling_rate=SAMPLING_RATE):
         SampleGenerator.__init__(self, sampling_rate)
-        self._filename = filename
-        self._wf = wave.open(self._filename, 'rb')
-        (nchannels, sample_width, framerate, nframes, comptype, compname) = self._wf.getparams()
-        assert framerate == self._sampling_rate
-        assert nchannels in [1, 2]
-        assert sample_width == 2
-        self._stereo = (nchannels == 2)
-        self._scaling = 2.0 ** ((sample_width * 8) - 1)
+        self._source = source
+        self._resampler = resampling.Resampler(source_rate, sampling_rate)
+        self._source_rate = source_rate
+        self._buffer = numpy.zeros(0)
+        self._source_finished = False
+
+    def _get(self):
+        return self._pull(1)[0]
+
+    def _render(self, num_samples):
+        self._time += self._sample_time * num_samples
+        return self._pull(num_samples)
+
+    def _pull(self, num_samples):
+        blocks = [self._buffer]
+        available = len(self._buffer)
+        while available < num_samples and not self._source_finished:
+            block_size = max(1, int(num_samples * self._source_rate / self._sampling_rate)) + 64
+            block = self._resampler.process(self._source._render(block_size))
+            if self._source.is_finished():
+                self._source_finished = True
+                block = numpy.concatenate([block, self._resampler.flush()])
+            blocks.append(block)
+            available += len(block)
+        data = numpy.concatenate(blocks)
+        if len(data) < num_samples:
+            data = numpy.concatenate([data, numpy.zeros(num_samples - len(data))])
+        self._buffer = data[num_samples:]
+        if self._source_finished and not len(self._buffer):
+            self._finished = True
+        return data[:num_samples]
+
+
+class BufferGenerator(SampleGenerator):
+    """A sample generator that plays back a buffer of samples once.
+
+    The buffer is either 1-D (mono) or planar (channels x frames).
+    """
+    def __init__(self, buffer, sampling_rate=SAMPLING_RATE):
+        num_channels = 1 if len(buffer.shape) == 1 else buffer.shape[0]
+        SampleGenerator.__init__(self, sampling_rate, num_channels)
+        self._buffer = buffer
+        self._num_frames = buffer.shape[-1]
         self.reset()
 
     def reset(self):
-        # TODO(oconaire): Instead of always reading from a WAV file, we might
-        # just buffer the whole file in memory. Perhaps using a different class:
-        # e.g. WaveSampleGenerator
-        self._wf.rewind()
-        self._nsamples = self._wf.getnframes()
-        self._index = -1
-        self._buffer = []
-        self._finished = False
+        self._index = 0
+        self._finished = (self._num_frames == 0)
 
     def _get(self):
-        if self._nsamples <= 0:
+        if self._index >= self._num_frames:
             self._finished = True
             return 0.0
-        if self._index >= (len(self._buffer) - 1):
-            # Read (at most) one second of data
-            self._index = -1
-            raw_data = array.array("h")
-            raw_string = self._wf.readframes(self._sampling_rate)
-            raw_data.frombytes(raw_string)
-            raw_values = raw_data.tolist()
-            if self._stereo:
-                # Drop every second value, so that a mono signal is returned
-                raw_values = [r for (i,r) in enumerate(raw_values) if (i%2)==0]
-            self._buffer = [v / self._scaling for v in raw_values]
-
-        self._nsamples -= 1
+        value = float(numpy.mean(self._buffer[..., self._index]))
         self._index += 1
-        return self._buffer[self._index]
+        if self._index >= self._num_frames:
+            self._finished = True
+        return value
+
+    def _render_channels(self, num_samples):
+        self._time += self._sample_time * num_samples
+        data = numpy.zeros((self._num_channels, num_samples))
+        chunk = self._buffer[..., self._index:self._index + num_samples]
+        data[:, :chunk.shape[-1]] = chunk
+        self._index += chunk.shape[-1]
+        if self._index >= self._num_frames:
+            self._finished = True
+        return data
+
+    def _render(self, num_samples):
+        data = self._render_channels(num_samples)
+        return data[0] if self._num_channels == 1 else data.mean(axis=0)
+
+
+class WaveFileGenerator(BufferGenerator):
+    """A sample generator made from a WAV file.
+
+    By default the file is decoded once by the shared sample bank (and
+    resampled to sampling_rate if needed), so creating many generators for the
+    same file is cheap. With stream=True the file is memory-mapped instead and
+    converted block by block as it plays, which suits long backing tracks that
+    should not be held in memory. Streamed files must already be at
+    sampling_rate; wrap them in a ResampleGenerator otherwise.
+
+    With num_channels=1 only the first channel of the file is played. Pass
+    num_channels=2 to keep both channels of a stereo file.
+
+    A streamed file is closed once it has been played, or by close(), and
+    cannot be reset after that.
+    """
+    def __init__(self, filename, sampling_rate=SAMPLING_RATE, bank=None, stream=False, num_channels=1):
+        self._filename = filename
+        self._reader = None
+        if stream:
+            self._reader = WaveReader(filename)
+            assert self._reader.sampling_rate == sampling_rate
+            buffer = self._reader.channels()
+        else:
+            bank = sample_bank if bank is None else bank
+            buffer = bank.get(filename, sampling_rate)
+        assert num_channels <= buffer.shape[0]
+        if num_channels == 1:
+            buffer = buffer[0]
+        elif num_channels < buffer.shape[0]:
+            buffer = buffer[:num_channels]
+        self._closed = False
+        BufferGenerator.__init__(self, buffer, sampling_rate)
+
+    def reset(self):
+        assert not self._closed
+        BufferGenerator.reset(self)
+
+    def _get(self):
+        value = BufferGenerator._get(self)
+        if self._finished:
+            self.close()
+        return value
+
+    def _render_channels(self, num_samples):
+        data = BufferGenerator._render_channels(self, num_samples)
+        if self._finished:
+            self.close()
+        return data
+
+    def close(self):
+        """Closes a streamed file, which finishes the generator."""
+        if self._reader is None: return
+        # The buffer views the file, so it is released first.
+        self._buffer = numpy.zeros(self._buffer.shape[:-1] + (0,))
+        self._reader.close()
+        self._reader = None
+        self._closed = True
+        self._finished = True
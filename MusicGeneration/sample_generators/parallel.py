@@ -0,0 +1,159 @@
+"""Rendering generators in worker processes, to mix them on several cores."""
+
+import collections
+import multiprocessing
+import traceback
+import numpy
+from . import SAMPLING_RATE
+from .generators import SampleGenerator, MixerGenerator
+
+
+DEFAULT_MAX_BLOCK_SIZE = 2 ** 14
+
+
+def _run_worker(source, connection, buffer, max_block_size):
+    """The worker process: renders blocks of source into the shared buffer."""
+    data = numpy.frombuffer(buffer, dtype=numpy.float64).reshape(source.num_channels, max_block_size)
+    while True:
+        request = connection.recv()
+        if request is None: break
+        (calls, num_samples) = request
+        try:
+            for (method, args) in calls:
+                getattr(source, method)(*args)
+            data[:, :num_samples] = source._render_channels(num_samples)
+            connection.send(source.is_finished())
+        except Exception:
+            connection.send(traceback.format_exc())
+            break
+    connection.close()
+
+
+class ProcessGenerator(SampleGenerator):
+    """Renders a generator in a worker process.
+
+    The source is moved to the worker (so it must be picklable on platforms
+    that spawn processes). request() asks the worker for the next block
+    without waiting for it, and the block is returned by the next _render()
+    or _render_channels() call, through a shared-memory buffer, so several
+    ProcessGenerators render their blocks at the same time. The samples are
+    exactly those the source would produce in this process.
+
+    The source can no longer be called directly: call() queues a method
+    call (e.g. to deliver an event), which the worker makes before it
+    renders the next block. Calls are made in order, and call() may be
+    used from another thread (e.g. a Clock's).
+
+    context is the multiprocessing context (or start method name, e.g.
+    "spawn") to start the worker with; by default, the platform's.
+    """
+    def __init__(self, source, max_block_size=DEFAULT_MAX_BLOCK_SIZE, sampling_rate=SAMPLING_RATE, context=None):
+        SampleGenerator.__init__(self, sampling_rate, source.num_channels)
+        if context is None or isinstance(context, str):
+            context = multiprocessing.get_context(context)
+        self._max_block_size = max_block_size
+        self._buffer = context.RawArray("d", source.num_channels * max_block_size)
+        self._data = numpy.frombuffer(self._buffer, dtype=numpy.float64).reshape(source.num_channels, max_block_size)
+        (self._connection, worker_connection) = context.Pipe()
+        self._process = context.Process(target=_run_worker, name="ProcessGenerator worker", daemon=True,
+                                        args=(source, worker_connection, self._buffer, max_block_size))
+        self._process.start()
+        worker_connection.close()
+        # Appending to and popping from a deque are atomic, so calls queued
+        # from other threads are never lost.
+        self._calls = collections.deque()
+        self._requested = None
+
+    def call(self, method, *args):
+        """Calls a method of the source (in the worker) before the next block."""
+        self._calls.append((method, args))
+
+    def request(self, num_samples):
+        """Starts rendering the next num_samples frames in the worker."""
+        assert self._requested is None and 0 < num_samples <= self._max_block_size
+        calls = []
+        while self._calls:
+            calls.append(self._calls.popleft())
+        self._connection.send((calls, num_samples))
+        self._requested = num_samples
+
+    def _receive(self, num_samples):
+        if self._requested is None:
+            self.request(num_samples)
+        assert self._requested == num_samples
+        self._requested = None
+        reply = self._connection.recv()
+        if isinstance(reply, str):
+            # The worker has stopped.
+            self._process.join()
+            self._connection.close()
+            self._process = None
+            raise Exception("ProcessGenerator worker failed:\n" + reply)
+        self._finished = reply
+        return self._data[:, :num_samples].copy()
+
+    def _get(self):
+        return float(self._render_channels(1).mean(axis=0)[0])
+
+    def _render_channels(self, num_samples):
+        self._time += self._sample_time * num_samples
+        blocks = []
+        for offset in range(0, num_samples, self._max_block_size):
+            blocks.append(self._receive(min(self._max_block_size, num_samples - offset)))
+        if len(blocks) == 1:
+            return blocks[0]
+        return numpy.concatenate(blocks, axis=1) if blocks else numpy.zeros((self._num_channels, 0))
+
+    def _render(self, num_samples):
+        data = self._render_channels(num_samples)
+        return data[0] if self._num_channels == 1 else data.mean(axis=0)
+
+    def close(self):
+        """Stops the worker process."""
+        if self._process is None: return
+        if self._requested is not None:
+            self._connection.recv()
+        self._connection.send(None)
+        self._process.join()
+        self._connection.close()
+        self._process = None
+
+
+class ParallelMixerGenerator(MixerGenerator):
+    """A MixerGenerator whose sources each render in their own process.
+
+    Sources that are not already ProcessGenerators are wrapped in one
+    (started with context).
+    For each block, every worker is asked for its block before any is
+    waited for, so the sources render in parallel, and the blocks are then
+    mixed exactly as MixerGenerator mixes them: the output is identical to
+    a MixerGenerator of the same sources. Sources added later with add()
+    are rendered in this process. Call close() to stop the workers.
+    """
+    def __init__(self, source_list=None, scaling=1.0, sampling_rate=SAMPLING_RATE, num_channels=1, pan=None,
+                 max_block_size=DEFAULT_MAX_BLOCK_SIZE, context=None):
+        source_list = [] if source_list is None else source_list
+        source_list = [source if isinstance(source, ProcessGenerator)
+                       else ProcessGenerator(source, max_block_size, sampling_rate, context) for source in source_list]
+        MixerGenerator.__init__(self, source_list, scaling, sampling_rate, num_channels, pan)
+        self._workers = list(source_list)
+        self._max_block_size = max_block_size
+
+    def _mix(self, data):
+        for offset in range(0, data.shape[1], self._max_block_size):
+            block = data[:, offset:offset + self._max_block_size]
+            for source in self._source_list:
+                if isinstance(source, ProcessGenerator):
+                    source.request(block.shape[1])
+            MixerGenerator._mix(self, block)
+
+    def close(self):
+        """Stops the worker processes."""
+        for worker in self._workers:
+            worker.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
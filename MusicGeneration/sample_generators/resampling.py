@@ -0,0 +1,114 @@
+"""Polyphase sampling-rate conversion.
+
+Converting from rate F to rate T is done by upsampling by L, low-pass
+filtering and downsampling by M, where T / F = L / M. Only the filter taps
+that line up with real input samples are ever evaluated: for each output
+sample one of the L "phases" of the filter is picked, and dotted with the
+most recent input samples. The filter banks are designed once per (L, M)
+and shared.
+"""
+
+import math
+import numpy
+from . import SAMPLING_RATE
+
+
+# Number of zero-crossings of the sinc on each side of the filter's center.
+DEFAULT_HALF_WIDTH = 16
+KAISER_BETA = 8.6
+# Inputs are processed in blocks of this many samples by resample().
+BLOCK_SIZE = 2 ** 16
+
+_filter_banks = {}
+
+
+def get_filter_bank(up, down, half_width=DEFAULT_HALF_WIDTH):
+    """Returns the (up x taps) polyphase filter bank for an up/down ratio.
+
+    Row p holds the taps h[p], h[p + up], h[p + 2 * up], ... of a windowed
+    sinc low-pass filter whose cutoff is the lower of the two Nyquist
+    frequencies.
+    """
+    key = (up, down, half_width)
+    if key not in _filter_banks:
+        factor = max(up, down)
+        num_taps = 2 * half_width * factor + 1
+        center = (num_taps - 1) / 2
+        cutoff = 0.5 / factor
+        h = 2 * cutoff * numpy.sinc(2 * cutoff * (numpy.arange(num_taps) - center))
+        h *= numpy.kaiser(num_taps, KAISER_BETA)
+        h *= up / h.sum()
+        taps_per_phase = int(math.ceil(num_taps / up))
+        padded = numpy.zeros(taps_per_phase * up)
+        padded[:num_taps] = h
+        bank = padded.reshape(taps_per_phase, up).T.copy()
+        bank.flags.writeable = False
+        _filter_banks[key] = (bank, int(center))
+    return _filter_banks[key]
+
+
+class Resampler:
+    """Streaming polyphase resampler.
+
+    Feed input blocks to process() and collect the output blocks. The output
+    is aligned with the input (the filter delay is compensated), so call
+    flush() after the last block to get the final samples.
+    """
+    def __init__(self, from_rate, to_rate, half_width=DEFAULT_HALF_WIDTH):
+        divisor = math.gcd(int(from_rate), int(to_rate))
+        self._up = int(to_rate) // divisor
+        self._down = int(from_rate) // divisor
+        (self._bank, self._delay) = get_filter_bank(self._up, self._down, half_width)
+        self._taps_per_phase = self._bank.shape[1]
+        # Inputs before the first one are zero. _history[0] holds the input
+        # with index _history_start.
+        self._history = numpy.zeros(self._taps_per_phase)
+        self._history_start = -self._taps_per_phase
+        self._next_output = 0
+        self._num_inputs = 0
+
+    def num_outputs(self, num_inputs):
+        """Returns how many output samples num_inputs input samples map to."""
+        return -((-num_inputs * self._up) // self._down)
+
+    def process(self, block):
+        """Consumes a block of input samples, returning the outputs now ready."""
+        self._num_inputs += len(block)
+        self._history = numpy.concatenate([self._history, block])
+        last_input = self._history_start + len(self._history) - 1
+        # Output m is centered on upsampled time m * down + delay, and needs
+        # inputs up to index (m * down + delay) // up.
+        last_output = (last_input * self._up + self._up - 1 - self._delay) // self._down
+        outputs = numpy.arange(self._next_output, last_output + 1)
+        upsampled_times = outputs * self._down + self._delay
+        newest = upsampled_times // self._up - self._history_start
+        indices = newest[:, numpy.newaxis] - numpy.arange(self._taps_per_phase)
+        data = numpy.einsum("ij,ij->i", self._bank[upsampled_times % self._up], self._history[indices])
+        self._next_output = last_output + 1
+        # Keep the inputs needed by the next output.
+        oldest = (self._next_output * self._down + self._delay) // self._up - self._taps_per_phase + 1
+        drop = max(0, min(oldest - self._history_start, len(self._history)))
+        self._history = self._history[drop:]
+        self._history_start += drop
+        return data
+
+    def flush(self):
+        """Returns the remaining outputs, assuming the input has ended."""
+        remaining = self.num_outputs(self._num_inputs) - self._next_output
+        if remaining <= 0:
+            return numpy.zeros(0)
+        num_zeros = self._delay // self._up + self._taps_per_phase + 1
+        num_inputs = self._num_inputs
+        data = self.process(numpy.zeros(num_zeros))
+        self._num_inputs = num_inputs
+        return data[:remaining]
+
+
+def resample(data, from_rate, to_rate=SAMPLING_RATE):
+    """Resamples a whole array of samples, returning a float64 array."""
+    if from_rate == to_rate:
+        return numpy.asarray(data, dtype=numpy.float64)
+    resampler = Resampler(from_rate, to_rate)
+    blocks = [resampler.process(data[start:start + BLOCK_SIZE]) for start in range(0, len(data), BLOCK_SIZE)]
+    blocks.append(resampler.flush())
+    return numpy.concatenate(blocks)
@@ -0,0 +1,138 @@
+"""A process-wide cache of decoded WAV file samples."""
+
+import collections
+import concurrent.futures
+import os
+import threading
+import numpy
+from MusicGeneration.wavefile import WaveReader
+from . import SAMPLING_RATE
+from .resampling import resample
+
+
+DEFAULT_MAX_BYTES = 128 * 2 ** 20
+
+
+def decode_wave_file(filename, sampling_rate=SAMPLING_RATE):
+    """Reads a WAV file into a planar (channels x frames) float32 array.
+
+    Files recorded at a different rate are resampled to sampling_rate.
+    """
+    with WaveReader(filename) as reader:
+        samples = reader.read(0, reader.num_frames)
+        if reader.sampling_rate != sampling_rate:
+            samples = numpy.array([resample(channel, reader.sampling_rate, sampling_rate)
+                                   for channel in samples], dtype=numpy.float32)
+    return samples
+
+
+class ArrayCache:
+    """A least-recently-used cache of read-only numpy arrays, limited by size.
+
+    lookup() returns the array cached for a key, or makes it. When the
+    cached arrays use more than max_bytes, the least recently used are
+    evicted. The returned arrays are read-only, since they are shared.
+
+    A cache can be used from several threads. Arrays are made outside the
+    cache's lock, so several can be made at the same time.
+    """
+    def __init__(self, max_bytes):
+        self._max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._num_bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    def lookup(self, key, make_array):
+        """Returns the array cached for key, calling make_array() to make it
+        if it is not cached."""
+        with self._lock:
+            if key in self._entries:
+                self._hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            self._misses += 1
+        array = make_array()
+        array.flags.writeable = False
+        with self._lock:
+            if key in self._entries:
+                # Another thread made the array at the same time.
+                return self._entries[key]
+            self._entries[key] = array
+            self._num_bytes += array.nbytes
+            self._evict()
+        return array
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def set_max_bytes(self, max_bytes):
+        with self._lock:
+            self._max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._num_bytes = 0
+
+    def _evict(self):
+        # The most recently used entry is always kept, even if it alone is
+        # over budget.
+        while self._num_bytes > self._max_bytes and len(self._entries) > 1:
+            (_, array) = self._entries.popitem(last=False)
+            self._num_bytes -= array.nbytes
+
+    @property
+    def num_bytes(self):
+        """Total size of the arrays held by the cache."""
+        return self._num_bytes
+
+    @property
+    def hits(self): return self._hits
+
+    @property
+    def misses(self): return self._misses
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SampleBank(ArrayCache):
+    """Decodes each WAV file once and shares the samples between all users.
+
+    Entries are keyed by file name and modification time, so an edited file
+    is decoded again. When the decoded samples use more than max_bytes, the
+    least recently used entries are evicted. The returned arrays are
+    read-only, since they are shared.
+
+    A bank can be used from several threads. Files are decoded outside the
+    bank's lock, so prefetch() decodes many files concurrently.
+    """
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        ArrayCache.__init__(self, max_bytes)
+
+    def get(self, filename, sampling_rate=SAMPLING_RATE):
+        """Returns the samples of a WAV file as a read-only planar
+        (channels x frames) float32 array."""
+        path = os.path.abspath(filename)
+        key = (path, os.path.getmtime(path), sampling_rate)
+        return self.lookup(key, lambda: decode_wave_file(path, sampling_rate))
+
+    def prefetch(self, filenames, sampling_rate=SAMPLING_RATE, max_workers=None):
+        """Decodes the WAV files concurrently in a thread pool, and returns
+        their samples in the same order. Errors (e.g. a missing file) are
+        raised once all files have been tried."""
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(self.get, filename, sampling_rate) for filename in filenames]
+        return [future.result() for future in futures]
+
+
+sample_bank = SampleBank()
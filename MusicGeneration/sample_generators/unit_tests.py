@@ -1,10 +1,25 @@
 """Unit tests for sample generators."""
 
+import math
 import os
+import shutil
+import tempfile
+import threading
 import unittest
+import wave
+import numpy
 from . import *
+from MusicGeneration.wavefile import WaveReader
 from . import generators
 from . import envelopes
+from . import wavetables
+from . import sample_banks
+from . import resampling
+from . import dynamics
+from . import parallel
+
+
+DRUMS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "wav_data", "drums")
 
 
 class TestSampleGeneration(unittest.TestCase):
@@ -34,6 +49,67 @@ class TestSampleGeneration(unittest.TestCase):
             else:
                 self.assertTrue(sample <= 0)
 
+    def test_render_matches_iteration(self):
+        make_generators = [
+            lambda: generators.ConstantGenerator(constant=0.25),
+            lambda: generators.SineWaveGenerator(441),
+            lambda: generators.SquareWaveGenerator(300),
+            lambda: generators.SawtoothWaveGenerator(300),
+            lambda: generators.SweepWaveGenerator(100, 1000, 1.0, mode="linear"),
+            lambda: generators.SweepWaveGenerator(100, 1000, 1.0, mode="exp"),
+        ]
+        for make_generator in make_generators:
+            scalar_gen = make_generator()
+            expected = [scalar_gen.__next__() for _ in range(1000)]
+            block_gen = make_generator()
+            data = block_gen.render(400)
+            self.assertEqual(data.dtype, numpy.float32)
+            self.assertEqual(data.shape, (400,))
+            # Block and list access can be interleaved.
+            data = numpy.concatenate([data, block_gen.get(100), block_gen.render(500)])
+            numpy.testing.assert_allclose(data, expected, atol=1e-6)
+            self.assertEqual(block_gen.getTime(), scalar_gen.getTime())
+
+    def test_sweep_seek(self):
+        for mode in generators.SWEEP_MODES:
+            full = generators.SweepWaveGenerator(100, 1000, 10.0, mode=mode).render(44100 * 5 + 1000)
+            sweep_gen = generators.SweepWaveGenerator(100, 1000, 10.0, mode=mode)
+            sweep_gen.seek(5.0)
+            self.assertAlmostEqual(sweep_gen.getTime(), 5.0)
+            numpy.testing.assert_allclose(sweep_gen.render(1000), full[-1000:], atol=1e-4)
+
+    def test_render_fallback(self):
+        delay_gen = generators.DelayedGenerator(generators.ConstantGenerator(), start_time=0.001)
+        data = delay_gen.render(100)
+        self.assertEqual(data.dtype, numpy.float32)
+        self.assertEqual(data[:44].tolist(), 44 * [0.0])
+        self.assertEqual(data[46:].tolist(), 54 * [1.0])
+        self.assertEqual(len(delay_gen.render(0)), 0)
+
+    def test_guitarwave(self):
+        for freq in [440, 2000, 30000]:
+            noise = generators.NoiseBank(seed=7)
+            scalar_gen = generators.GuitarWaveGenerator(freq, noise=noise)
+            expected = [scalar_gen.__next__() for _ in range(5000)]
+            noise.reseed(7)
+            block_gen = generators.GuitarWaveGenerator(freq, noise=noise)
+            # Mix block sizes, including blocks shorter than one period.
+            data = numpy.concatenate([block_gen.render(37), block_gen.get(1),
+                                      block_gen.render(4000), block_gen.render(962)])
+            numpy.testing.assert_allclose(data, expected, atol=1e-6)
+        # The string decays towards silence.
+        data = numpy.abs(generators.GuitarWaveGenerator(440).render(SAMPLING_RATE))
+        self.assertLess(data[-1000:].max(), 0.5 * data[:1000].max())
+
+    def test_noise_bank(self):
+        noise = generators.NoiseBank(size=100, seed=3)
+        first = noise.take(60)
+        second = noise.take(60)
+        self.assertTrue(numpy.array_equal(second[40:], first[:20]))
+        noise.reseed(3)
+        self.assertTrue(numpy.array_equal(noise.take(60), first))
+        self.assertLessEqual(numpy.abs(first).max(), 1.0)
+
     def test_delayed_generator(self):
         constant_gen = generators.ConstantGenerator(constant=-0.5)
         delay_get = generators.DelayedGenerator(source=constant_gen, start_time=0.5)
@@ -53,6 +129,125 @@ class TestSampleGeneration(unittest.TestCase):
         self.assertEqual(min(data), 0)
         self.assertEqual(max(data), 0)
 
+    def test_mixer_removes_finished_sources(self):
+        note = lambda: envelopes.StandardEnvelope(generators.ConstantGenerator(), attack=0.0, decay=0.0,
+                                                  sustain=0.0, release=0.01)
+        nested_mixer = generators.MixerGenerator([note()])
+        mixer = generators.MixerGenerator([note(), nested_mixer], scaling=[0.5, 0.25])
+        mixer.add(note(), start_time=0.02)
+        mixer.add(generators.ConstantGenerator(0.125))
+        self.assertEqual(len(mixer._source_list), 3)
+        mixer.get(int(0.015 * SAMPLING_RATE))
+        self.assertTrue(nested_mixer.is_finished())
+        self.assertEqual(len(mixer._source_list), 1)
+        self.assertEqual(mixer._gains, [1.0])
+        data = mixer.render(int(0.01 * SAMPLING_RATE))
+        self.assertEqual(len(mixer._source_list), 2)
+        self.assertEqual(mixer._gains, [1.0, 1.0])
+        data = mixer.render(int(0.02 * SAMPLING_RATE))
+        self.assertEqual(len(mixer._source_list), 1)
+        self.assertFalse(mixer.is_finished())
+        self.assertEqual(data[-1], 0.125)
+
+        mixer = generators.MixerGenerator([note()])
+        for _ in range(int(0.02 * SAMPLING_RATE)):
+            mixer.__next__()
+        self.assertTrue(mixer.is_finished())
+        mixer.add(generators.ConstantGenerator())
+        self.assertFalse(mixer.is_finished())
+        self.assertEqual(mixer.get(2), [1.0, 1.0])
+
+    def test_mixer_voice_stealing(self):
+        def make_mixer(steal_policy):
+            mixer = generators.MixerGenerator(max_voices=2, steal_policy=steal_policy, fade_time=0.001)
+            mixer.add(generators.ConstantGenerator(0.5), voice_key=60)
+            mixer.add(generators.ConstantGenerator(0.25), voice_key=64)
+            mixer.add(generators.ConstantGenerator(0.125), start_time=0.01, voice_key=64)
+            return mixer
+        # Which of the first two sources is still playing once the fade is over.
+        expected = {"oldest": 0.25, "quietest": 0.5, "retrigger": 0.5}
+        for (steal_policy, survivor) in expected.items():
+            mixer = make_mixer(steal_policy)
+            data = mixer.render(int(0.02 * SAMPLING_RATE))
+            self.assertEqual(data[0], 0.75)
+            self.assertEqual(len(mixer._source_list), 2)
+            # The stolen source fades out, rather than stopping dead.
+            fade = data[441:441 + 44]
+            self.assertTrue(numpy.all(numpy.diff(fade) < 0))
+            self.assertAlmostEqual(data[-1], survivor + 0.125)
+        # Without a limit, every source plays.
+        mixer = make_mixer("oldest")
+        mixer.set_max_voices(None)
+        self.assertAlmostEqual(mixer.render(int(0.02 * SAMPLING_RATE))[-1], 0.875)
+
+    def test_mixer_steals_quietest_after_gain(self):
+        num_samples = int(0.02 * SAMPLING_RATE)
+        for render_mode in ["render", "iterate"]:
+            mixer = generators.MixerGenerator(max_voices=2, steal_policy="quietest", fade_time=0.001)
+            # The first source is the loudest, but the quietest in the mix.
+            mixer.add(generators.ConstantGenerator(1.0), gain=0.1)
+            mixer.add(generators.ConstantGenerator(0.5))
+            mixer.add(generators.ConstantGenerator(0.125), start_time=0.01)
+            if render_mode == "render":
+                data = mixer.get(num_samples)
+            else:
+                data = [mixer.__next__() for _ in range(num_samples)]
+            self.assertAlmostEqual(data[0], 0.6, msg=render_mode)
+            self.assertAlmostEqual(data[-1], 0.625, msg=render_mode)
+
+    def test_mixer_start_times(self):
+        for render_mode in ["render", "get", "iterate"]:
+            mixer = generators.MixerGenerator()
+            mixer.add(generators.ConstantGenerator(0.5), start_time=3.0 / SAMPLING_RATE)
+            mixer.add(generators.ConstantGenerator(0.25), start_time=7.0 / SAMPLING_RATE)
+            mixer.add(generators.ConstantGenerator(0.125), start_time=3.0 / SAMPLING_RATE)
+            self.assertEqual(len(mixer._source_list), 0)
+            if render_mode == "render":
+                data = numpy.concatenate([mixer.render(5), mixer.render(5)]).tolist()
+            elif render_mode == "get":
+                data = mixer.get(10)
+            else:
+                data = [mixer.__next__() for _ in range(10)]
+            self.assertEqual(data, 3 * [0.0] + 4 * [0.625] + 3 * [0.875], msg=render_mode)
+            self.assertEqual(mixer.getTime(), 10.0 / SAMPLING_RATE)
+            # Start times are measured on the mixer's clock.
+            mixer.add(generators.ConstantGenerator(-0.875), start_time=12.0 / SAMPLING_RATE)
+            self.assertEqual(mixer.get(4), [0.875, 0.875, 0.0, 0.0], msg=render_mode)
+
+    def test_stereo_mixer(self):
+        left = generators.ConstantGenerator(0.5)
+        center = generators.ConstantGenerator(0.25)
+        stereo = generators.BufferGenerator(numpy.array([[0.1, 0.2, 0.3], [-0.1, -0.2, -0.3]]))
+        mixer = generators.MixerGenerator([left, center], scaling=[1.0, 0.5], num_channels=2, pan=[-1.0, 0.0])
+        mixer.add(stereo, pan=0.5)
+        self.assertEqual(mixer.num_channels, 2)
+        data = mixer.render_channels(3)
+        self.assertEqual(data.dtype, numpy.float32)
+        self.assertEqual(data.shape, (2, 3))
+        center_gain = 0.125 * math.sqrt(0.5)
+        expected = [[0.5 + center_gain + 0.05, 0.5 + center_gain + 0.1, 0.5 + center_gain + 0.15],
+                    [center_gain - 0.1, center_gain - 0.2, center_gain - 0.3]]
+        numpy.testing.assert_allclose(data, expected, atol=1e-6)
+        # The mono paths return the downmix.
+        self.assertAlmostEqual(mixer.get(1)[0], 0.25 + center_gain, places=6)
+        mixer = generators.MixerGenerator([generators.ConstantGenerator(0.5)], num_channels=2)
+        self.assertAlmostEqual(mixer.__next__(), 0.5 * math.sqrt(0.5))
+        self.assertEqual(mixer.render(4).shape, (4,))
+
+    def test_mono_mixer_downmixes_stereo_sources(self):
+        stereo = generators.BufferGenerator(numpy.array([[0.5, 0.25], [0.0, 0.25]]))
+        mixer = generators.MixerGenerator([stereo], scaling=2.0)
+        self.assertEqual(mixer.get(3), [0.5, 0.5, 0.0])
+
+    def test_delayed_generator_finishes(self):
+        note = envelopes.StandardEnvelope(generators.ConstantGenerator(), attack=0.0, decay=0.0,
+                                          sustain=0.0, release=0.01)
+        delay_gen = generators.DelayedGenerator(source=note, start_time=0.01)
+        delay_gen.render(int(0.015 * SAMPLING_RATE))
+        self.assertFalse(delay_gen.is_finished())
+        delay_gen.render(int(0.01 * SAMPLING_RATE))
+        self.assertTrue(delay_gen.is_finished())
+
     def test_wavefile_generator(self):
         # TODO: Obviously crappy test. I'm not sure how to specify a relative path so that
         # this test wav file is found.
@@ -74,6 +269,208 @@ class TestSampleGeneration(unittest.TestCase):
             self.assertGreater(max(data[:last_sample]), 0.25)
 
 
+class TestSampleBank(unittest.TestCase):
+    def test_shared_samples(self):
+        bank = sample_banks.SampleBank()
+        filename = os.path.join(DRUMS_DIR, "DR1-0.WAV")
+        samples = bank.get(filename)
+        self.assertEqual(samples.shape[0], 2)
+        self.assertEqual(samples.dtype, numpy.float32)
+        self.assertFalse(samples.flags.writeable)
+        self.assertIs(bank.get(os.path.relpath(filename)), samples)
+        self.assertEqual((bank.hits, bank.misses), (1, 1))
+        self.assertEqual(bank.num_bytes, samples.nbytes)
+
+        gen1 = generators.WaveFileGenerator(filename, bank=bank)
+        gen2 = generators.WaveFileGenerator(filename, bank=bank)
+        self.assertEqual((bank.hits, bank.misses), (3, 1))
+        data = gen1.get(samples.shape[1])
+        self.assertEqual(data, samples[0].tolist())
+        self.assertTrue(gen1.is_finished())
+        self.assertEqual(gen1.get(10), 10 * [0.0])
+        self.assertEqual(gen2.render(samples.shape[1] + 10).tolist(), data + 10 * [0.0])
+        gen1.reset()
+        self.assertFalse(gen1.is_finished())
+        self.assertEqual(gen1.get(100), data[:100])
+
+    def test_stereo_wavefile_generator(self):
+        filename = os.path.join(DRUMS_DIR, "DR1-3.WAV")
+        with WaveReader(filename) as reader:
+            expected = reader.read(0, reader.num_frames)
+        for stream in [False, True]:
+            stereo_gen = generators.WaveFileGenerator(filename, stream=stream, num_channels=2)
+            self.assertEqual(stereo_gen.num_channels, 2)
+            data = stereo_gen.render_channels(expected.shape[1])
+            self.assertTrue(numpy.array_equal(data, expected))
+            self.assertTrue(stereo_gen.is_finished())
+
+    def test_multichannel_wavefile_generator(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, "three_channels.wav")
+            wf = wave.open(filename, 'wb')
+            wf.setparams((3, 2, SAMPLING_RATE, 0, "NONE", "not compressed"))
+            wf.writeframes(numpy.arange(-300, 300, dtype="<i2").tobytes())
+            wf.close()
+            with WaveReader(filename) as reader:
+                expected = reader.read(0, reader.num_frames)
+            # Down-mixing to fewer channels keeps the first ones, streamed or not.
+            for stream in [False, True]:
+                gen = generators.WaveFileGenerator(filename, stream=stream, num_channels=2)
+                self.assertEqual(gen.render_channels(expected.shape[1]).tolist(), expected[:2].tolist())
+                gen = generators.WaveFileGenerator(filename, stream=stream)
+                self.assertEqual(gen.render(expected.shape[1]).tolist(), expected[0].tolist())
+                gen.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_streaming_wavefile_generator(self):
+        filename = os.path.join(DRUMS_DIR, "DR1-3.WAV")
+        expected = generators.WaveFileGenerator(filename).get(SAMPLING_RATE)
+        stream_gen = generators.WaveFileGenerator(filename, stream=True)
+        data = stream_gen.get(100) + [stream_gen.__next__() for _ in range(100)]
+        data += stream_gen.render(SAMPLING_RATE - 200).tolist()
+        self.assertEqual(data, expected)
+        self.assertTrue(stream_gen.is_finished())
+        # The file is closed once it has been played.
+        self.assertIsNone(stream_gen._reader)
+        self.assertEqual(stream_gen.get(10), 10 * [0.0])
+        stream_gen = generators.WaveFileGenerator(filename, stream=True, num_channels=2)
+        reader = stream_gen._reader
+        stream_gen.render_channels(100)
+        stream_gen.close()
+        self.assertTrue(reader._mmap.closed)
+        self.assertTrue(stream_gen.is_finished())
+        self.assertEqual(stream_gen.render_channels(10).tolist(), 2 * [10 * [0.0]])
+
+    def test_lru_eviction(self):
+        filenames = [os.path.join(DRUMS_DIR, "DR1-%d.WAV" % i) for i in range(3)]
+        sizes = [sample_banks.decode_wave_file(f).nbytes for f in filenames]
+        # Any two of the files fit in the budget, but not all three.
+        budget = sum(sizes) - min(sizes)
+        bank = sample_banks.SampleBank(max_bytes=budget)
+        bank.get(filenames[0])
+        bank.get(filenames[1])
+        bank.get(filenames[0])
+        # Loading the third file evicts the least recently used one.
+        bank.get(filenames[2])
+        self.assertLessEqual(bank.num_bytes, budget)
+        bank.get(filenames[0])
+        self.assertEqual(bank.misses, 3)
+        bank.get(filenames[1])
+        self.assertEqual(bank.misses, 4)
+        bank.set_max_bytes(0)
+        self.assertEqual(len(bank), 1)
+        bank.clear()
+        self.assertEqual((len(bank), bank.num_bytes), (0, 0))
+
+    def test_prefetch(self):
+        filenames = [os.path.join(DRUMS_DIR, "DR1-%d.WAV" % i) for i in range(8)]
+        bank = sample_banks.SampleBank()
+        samples = bank.prefetch(filenames + filenames[:2], max_workers=4)
+        self.assertEqual(len(samples), 10)
+        self.assertEqual(len(bank), 8)
+        for (filename, data) in zip(filenames, samples):
+            self.assertIs(bank.get(filename), data)
+            self.assertTrue(numpy.array_equal(data, sample_banks.decode_wave_file(filename)))
+        self.assertEqual(bank.num_bytes, sum(data.nbytes for data in samples[:8]))
+        with self.assertRaises(IOError):
+            bank.prefetch(filenames[:2] + [os.path.join(DRUMS_DIR, "missing.WAV")])
+
+
+class TestResampling(unittest.TestCase):
+    def test_resample_sine(self):
+        for from_rate in [22050, 48000, 96000]:
+            duration = 0.5
+            times = numpy.arange(int(duration * from_rate)) / from_rate
+            data = resampling.resample(numpy.sin(2 * numpy.pi * 1000 * times), from_rate)
+            self.assertEqual(len(data), int(duration * SAMPLING_RATE))
+            expected = numpy.sin(2 * numpy.pi * 1000 * numpy.arange(len(data)) / SAMPLING_RATE)
+            # Ignore the edges, where the filter sees the signal switch on/off.
+            numpy.testing.assert_allclose(data[200:-200], expected[200:-200], atol=1e-3)
+
+    def test_streaming_matches_whole(self):
+        data = numpy.random.RandomState(0).uniform(-1, 1, 5000)
+        expected = resampling.resample(data, 48000)
+        resampler = resampling.Resampler(48000, SAMPLING_RATE)
+        blocks = [resampler.process(data[start:start + 777]) for start in range(0, len(data), 777)]
+        blocks.append(resampler.flush())
+        numpy.testing.assert_allclose(numpy.concatenate(blocks), expected, atol=1e-12)
+        self.assertEqual(len(expected), resampler.num_outputs(len(data)))
+
+    def test_filter_banks_are_shared(self):
+        (bank, _) = resampling.get_filter_bank(147, 160)
+        self.assertIs(resampling.Resampler(48000, SAMPLING_RATE)._bank, bank)
+        self.assertEqual(bank.shape[0], 147)
+
+    def test_resample_generator(self):
+        source = generators.SineWaveGenerator(500, sampling_rate=48000)
+        resample_gen = generators.ResampleGenerator(source, 48000)
+        data = numpy.concatenate([resample_gen.render(1000), resample_gen.get(1), resample_gen.render(3000)])
+        expected = numpy.sin(2 * numpy.pi * 500 * numpy.arange(len(data)) / SAMPLING_RATE)
+        numpy.testing.assert_allclose(data[200:], expected[200:], atol=1e-3)
+
+    def test_sample_bank_resamples_once(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, "tone48k.wav")
+            wf = wave.open(filename, 'wb')
+            wf.setparams((1, 2, 48000, 0, "NONE", "not compressed"))
+            wf.writeframes(numpy.full(4800, 16384, dtype="<i2").tobytes())
+            wf.close()
+            bank = sample_banks.SampleBank()
+            gen = generators.WaveFileGenerator(filename, bank=bank)
+            data = gen.get(SAMPLING_RATE // 10 + 10)
+            self.assertEqual(bank.get(filename).shape, (1, SAMPLING_RATE // 10))
+            self.assertEqual((bank.hits, bank.misses), (1, 1))
+            self.assertAlmostEqual(data[SAMPLING_RATE // 20], 0.5, places=3)
+            self.assertEqual(data[-10:], 10 * [0.0])
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestWavetables(unittest.TestCase):
+    def test_sine_wavetable(self):
+        sine_gen = wavetables.WavetableSineGenerator(441)
+        data = sine_gen.render(SAMPLING_RATE)
+        expected = numpy.sin(2 * numpy.pi * 441 * numpy.arange(SAMPLING_RATE) / SAMPLING_RATE)
+        numpy.testing.assert_allclose(data, expected, atol=1e-5)
+
+    def test_render_matches_iteration(self):
+        for wave_class in [wavetables.WavetableSineGenerator,
+                           wavetables.WavetableSquareGenerator,
+                           wavetables.WavetableSawtoothGenerator]:
+            scalar_gen = wave_class(1234.5)
+            expected = scalar_gen.get(1) + [scalar_gen.__next__() for _ in range(999)]
+            block_gen = wave_class(1234.5)
+            data = numpy.concatenate([block_gen.render(300), block_gen.render(700)])
+            numpy.testing.assert_allclose(data, expected, atol=1e-6)
+            self.assertLessEqual(numpy.abs(data).max(), 1.0)
+
+    def test_shared_band_limited_tables(self):
+        low_gen = wavetables.WavetableSquareGenerator(55)
+        high_gen = wavetables.WavetableSquareGenerator(4000)
+        self.assertIs(wavetables.get_wavetable("square"), wavetables.get_wavetable("square"))
+        self.assertIs(low_gen._table, wavetables.WavetableSquareGenerator(56)._table)
+        # The high note's table may only contain harmonics below Nyquist.
+        for (gen, freq) in [(low_gen, 55), (high_gen, 4000)]:
+            spectrum = numpy.abs(numpy.fft.rfft(gen._table[:-1]))
+            max_harmonic = numpy.nonzero(spectrum > 1e-6 * spectrum.max())[0].max()
+            self.assertLess(max_harmonic * freq, SAMPLING_RATE / 2)
+        self.assertGreater(numpy.count_nonzero(numpy.abs(numpy.fft.rfft(low_gen._table[:-1])) > 1e-6), 10)
+
+    def test_phase_is_stable(self):
+        # The phase accumulator is exact: after a minute of blocks the phase
+        # is exactly increment * num_samples (mod 2**32).
+        one_minute = 60 * SAMPLING_RATE
+        sine_gen = wavetables.WavetableSineGenerator(440)
+        for _ in range(60):
+            sine_gen.render(SAMPLING_RATE)
+        expected_phase = (sine_gen._phase_increment * one_minute) % (wavetables.PHASE_MASK + 1)
+        self.assertEqual(sine_gen._phase, expected_phase)
+        self.assertLessEqual(numpy.abs(sine_gen.render(1000)).max(), 1.0)
+
+
 class TestEnvelopes(unittest.TestCase):
     def test_volume_envelope(self):
         constant_gen = generators.ConstantGenerator()
@@ -82,6 +479,13 @@ class TestEnvelopes(unittest.TestCase):
         self.assertEqual(type(data), list)
         self.assertEqual(data, 64 * [0.33])
 
+    def test_iterator_source(self):
+        vol_env = envelopes.VolumeEnvelope(iter([1.0, 2.0, 3.0]), 0.5)
+        self.assertEqual(vol_env.get(2), [0.5, 1.0])
+        self.assertEqual(vol_env.__next__(), 1.5)
+        std_env = envelopes.StandardEnvelope([1.0] * 8, attack=2, decay=0, sustain=0, release=0, sampling_rate=4)
+        self.assertEqual(std_env.render(8).tolist(), [0.0, 0.125, 0.25, 0.375, 0.5, 0.625, 0.75, 0.875])
+
     def test_standard_envelope_simple(self):
         constant_gen = generators.ConstantGenerator()
         # Total note length of 1 second
@@ -126,6 +530,154 @@ class TestEnvelopes(unittest.TestCase):
         self.assertAlmostEqual(min(data[8*one_tenth:SAMPLING_RATE+1]), 0)
         self.assertAlmostEqual(max(data[8*one_tenth:SAMPLING_RATE+1]), 0.8)
 
+    def test_standard_envelope_render(self):
+        def make_envelope(source):
+            return envelopes.StandardEnvelope(source=source, attack=0.01, decay=0.02,
+                                              sustain=0.03, release=0.04)
+        scalar_env = make_envelope(generators.SineWaveGenerator(440))
+        expected = [scalar_env.__next__() for _ in range(5000)]
+        sine_gen = generators.SineWaveGenerator(440)
+        block_env = make_envelope(sine_gen)
+        # Blocks that straddle the segment boundaries.
+        data = numpy.concatenate([block_env.render(n) for n in [700, 1, 2000, 2299]])
+        numpy.testing.assert_allclose(data, expected, atol=1e-6)
+        self.assertTrue(block_env.is_finished())
+        self.assertEqual(block_env.getTime(), scalar_env.getTime())
+        # After the release, the source is no longer pulled.
+        source_time = sine_gen.getTime()
+        self.assertEqual(block_env.render(1000).tolist(), 1000 * [0.0])
+        self.assertEqual(sine_gen.getTime(), source_time)
+
+    def test_breakpoint_envelope(self):
+        segments = [(0.1, 0.9, "linear"), (0.1, 0.8, "linear"), (0.6, 0.8, "linear"), (0.2, 0.0, "linear")]
+        bp_env = envelopes.BreakpointEnvelope(generators.ConstantGenerator(), segments, sampling_rate=20)
+        data = bp_env.get(21)
+        expected = [0.0, 0.45, 0.9, 0.85,
+                    0.8, 0.8, 0.8, 0.8, 0.8, 0.8,
+                    0.8, 0.8, 0.8, 0.8, 0.8, 0.8,
+                    0.8, 0.6, 0.4, 0.2, 0.0]
+        for (d,e) in zip(data, expected):
+            self.assertAlmostEqual(d, e)
+        self.assertTrue(bp_env.is_finished())
+        # Block and per-sample access agree, for every curve.
+        for curve in envelopes.CURVES:
+            segments = [(0.01, 1.0, curve), (0.02, 0.25, curve), (0.03, 0.0, curve)]
+            scalar_env = envelopes.BreakpointEnvelope(generators.SineWaveGenerator(440), segments)
+            expected = [scalar_env.__next__() for _ in range(3000)]
+            block_env = envelopes.BreakpointEnvelope(generators.SineWaveGenerator(440), segments)
+            data = numpy.concatenate([block_env.render(n) for n in [500, 1, 2499]])
+            numpy.testing.assert_allclose(data, expected, atol=1e-6)
+            self.assertTrue(block_env.is_finished())
+
+    def test_gain_tables_are_shared(self):
+        segments = [(0.01, 1.0, "linear"), (0.1, 0.0, "exp")]
+        table = envelopes.get_gain_table(segments)
+        self.assertIs(envelopes.get_gain_table(list(segments)), table)
+        self.assertIsNot(envelopes.get_gain_table(segments, sampling_rate=22050), table)
+        self.assertFalse(table.flags.writeable)
+        self.assertEqual(len(table), int(math.ceil(0.11 * SAMPLING_RATE)) + 1)
+        self.assertEqual(table[0], 0.0)
+        self.assertAlmostEqual(table[441], 1.0)
+        self.assertEqual(table[-1], 0.0)
+        # The exponential decay is front-loaded.
+        self.assertLess(table[441 + 2205], 0.2)
+
+
+
+class TestDynamics(unittest.TestCase):
+    def test_limiter(self):
+        # A quiet tone with a loud burst in the middle.
+        data = 0.5 * numpy.sin(numpy.arange(20000) * 0.05)
+        data[8000:9000] *= 4.0
+        limiter = dynamics.LimiterGenerator(generators.BufferGenerator(data), ceiling=0.9,
+                                            lookahead=0.005, release=0.05)
+        delay = limiter._window - 1
+        output = numpy.concatenate([limiter.render(n) for n in [3000, 1, 5000, 20000]])
+        # The delay line is flushed once the source has finished.
+        self.assertEqual(limiter.render(1000).tolist(), 1000 * [0.0])
+        self.assertTrue(limiter.is_finished())
+        self.assertLessEqual(numpy.abs(output).max(), 0.9 + 1e-6)
+        # Away from the burst, the signal is only delayed.
+        numpy.testing.assert_allclose(output[delay:7000 + delay], data[:7000], atol=1e-6)
+        numpy.testing.assert_allclose(output[16000 + delay:20000 + delay], data[16000:], atol=1e-6)
+        self.assertGreater(numpy.abs(output[8000 + delay:9000 + delay]).max(), 0.85)
+
+    def test_sliding_minimum(self):
+        values = numpy.random.RandomState(0).uniform(size=1000)
+        for window in [1, 2, 7, 220, 1000]:
+            expected = [values[start:start + window].min() for start in range(len(values) - window + 1)]
+            self.assertEqual(dynamics._sliding_minimum(values, window).tolist(), expected)
+
+    def test_limiter_stereo(self):
+        data = numpy.array([numpy.linspace(0.0, 2.0, 1000), numpy.linspace(0.0, 1.0, 1000)])
+        limiter = dynamics.LimiterGenerator(generators.BufferGenerator(data), ceiling=0.5)
+        output = limiter.render_channels(2000)
+        self.assertLessEqual(numpy.abs(output).max(), 0.5 + 1e-6)
+        # Both channels get the same gain.
+        numpy.testing.assert_allclose(output[0], 2 * output[1])
+
+    def test_normalize(self):
+        sine_gen = generators.SineWaveGenerator(440)
+        expected = 0.25 * sine_gen.render(30000)
+        source = generators.MixerGenerator([generators.SineWaveGenerator(440)], scaling=0.25)
+        normalized = dynamics.NormalizedGenerator(source, 30000, target_peak=0.5, block_size=4096)
+        self.assertAlmostEqual(normalized.peak, 0.25, places=4)
+        self.assertAlmostEqual(normalized.rms, 0.25 / math.sqrt(2), places=3)
+        output = numpy.concatenate([normalized.render(n) for n in [10000, 25000]])
+        numpy.testing.assert_allclose(output[:30000], expected * normalized.gain, atol=1e-6)
+        self.assertEqual(output[30000:].tolist(), 5000 * [0.0])
+        self.assertAlmostEqual(numpy.abs(output).max(), 0.5, places=6)
+        self.assertTrue(normalized.is_finished())
+        normalized.close()
+        # The RMS target wins if it is quieter.
+        source = generators.SineWaveGenerator(440)
+        normalized = dynamics.NormalizedGenerator(source, 30000, target_peak=1.0, target_rms=0.1)
+        self.assertAlmostEqual(normalized.gain, 0.1 * math.sqrt(2), places=3)
+        normalized.close()
+
+
+class TestParallel(unittest.TestCase):
+    def _make_sources(self):
+        return [generators.SineWaveGenerator(440), generators.SquareWaveGenerator(110),
+                generators.BufferGenerator(numpy.linspace(-1.0, 1.0, 3000))]
+
+    def test_matches_serial_mix(self):
+        for num_channels in [1, 2]:
+            expected = generators.MixerGenerator(self._make_sources(), scaling=[0.2, 0.3, 0.5],
+                                                 num_channels=num_channels, pan=[-0.5, 0.0, 1.0])
+            with parallel.ParallelMixerGenerator(self._make_sources(), scaling=[0.2, 0.3, 0.5],
+                                                 num_channels=num_channels, pan=[-0.5, 0.0, 1.0],
+                                                 max_block_size=1000) as mixer:
+                for num_samples in [10, 2500, 1000, 3]:
+                    self.assertTrue(numpy.array_equal(mixer.render_channels(num_samples),
+                                                      expected.render_channels(num_samples)))
+                # The finished buffer was dropped from the mix.
+                self.assertEqual(len(mixer._source_list), 2)
+
+    def test_calls_from_another_thread(self):
+        source = parallel.ProcessGenerator(generators.MixerGenerator())
+        add_sources = lambda: [source.call("add", generators.BufferGenerator(numpy.ones(1))) for _ in range(200)]
+        thread = threading.Thread(target=add_sources)
+        thread.start()
+        total = 0.0
+        while thread.is_alive():
+            total += source.render(1).sum()
+        thread.join()
+        total += source.render(1).sum()
+        # Each added source plays one sample of 1.0, and none was lost.
+        self.assertEqual(total, 200.0)
+        source.close()
+
+    def test_calls(self):
+        source = parallel.ProcessGenerator(generators.BufferGenerator(numpy.arange(10.0)))
+        self.assertEqual(source.get(4), [0.0, 1.0, 2.0, 3.0])
+        source.call("reset")
+        self.assertEqual(source.get(12), list(range(10)) + [0.0, 0.0])
+        self.assertTrue(source.is_finished())
+        source.call("no_such_method")
+        with self.assertRaises(Exception):
+            source.get(1)
+        source.close()
 
 
 def main():
@@ -0,0 +1,133 @@
+"""Wavetable oscillators driven by a fixed-point phase accumulator.
+
+Each waveform is stored as a set of band-limited tables, one per octave,
+computed once per sampling rate and shared by every oscillator instance.
+The phase is a 32-bit integer, so it never drifts no matter how long an
+oscillator runs, and the table for a note's octave only contains harmonics
+below the Nyquist frequency, so square and sawtooth waves do not alias.
+"""
+
+import math
+import numpy
+from . import SAMPLING_RATE
+from .generators import SampleGenerator
+
+
+# Each table holds one cycle of the waveform (plus a guard sample so that
+# interpolation never has to wrap around).
+TABLE_BITS = 11
+TABLE_SIZE = 2 ** TABLE_BITS
+PHASE_BITS = 32
+PHASE_MASK = 2 ** PHASE_BITS - 1
+FRAC_BITS = PHASE_BITS - TABLE_BITS
+FRAC_MASK = 2 ** FRAC_BITS - 1
+# The first table covers notes from LOWEST_FREQ up to 2 * LOWEST_FREQ, the
+# next covers the octave above, and so on up to the Nyquist frequency.
+LOWEST_FREQ = 20.0
+
+
+def _sine_harmonics(num_harmonics):
+    return [(1, 1.0)]
+
+
+def _square_harmonics(num_harmonics):
+    return [(k, 4.0 / (math.pi * k)) for k in range(1, num_harmonics + 1, 2)]
+
+
+def _sawtooth_harmonics(num_harmonics):
+    return [(k, -2.0 / (math.pi * k)) for k in range(1, num_harmonics + 1)]
+
+
+# Maps a waveform name to a function returning its (harmonic, amplitude) list.
+WAVEFORMS = {
+    "sine": _sine_harmonics,
+    "square": _square_harmonics,
+    "sawtooth": _sawtooth_harmonics,
+}
+
+
+class Wavetable:
+    """A set of per-octave band-limited tables for a single waveform."""
+    def __init__(self, waveform, sampling_rate=SAMPLING_RATE):
+        self._waveform = waveform
+        self._sampling_rate = sampling_rate
+        nyquist = sampling_rate / 2.0
+        self._num_octaves = max(1, int(math.ceil(math.log(nyquist / LOWEST_FREQ, 2))))
+        x = numpy.arange(TABLE_SIZE + 1) / TABLE_SIZE
+        tables = []
+        for octave in range(self._num_octaves):
+            top_freq = LOWEST_FREQ * 2 ** (octave + 1)
+            num_harmonics = min(TABLE_SIZE // 2 - 1, max(1, int(nyquist / top_freq)))
+            table = numpy.zeros(TABLE_SIZE + 1)
+            for (harmonic, amplitude) in WAVEFORMS[waveform](num_harmonics):
+                table += amplitude * numpy.sin(2 * math.pi * harmonic * x)
+            # Remove the Gibbs overshoot so that every table peaks at 1.0
+            table /= numpy.abs(table).max()
+            tables.append(table)
+        self._tables = tables
+
+    def get_table(self, freq):
+        """Returns the table to use for a note of the given frequency."""
+        octave = int(math.log(max(freq, LOWEST_FREQ) / LOWEST_FREQ, 2))
+        return self._tables[min(octave, self._num_octaves - 1)]
+
+
+_wavetables = {}
+
+
+def get_wavetable(waveform, sampling_rate=SAMPLING_RATE):
+    """Returns the shared Wavetable for a waveform, creating it if needed."""
+    key = (waveform, sampling_rate)
+    if key not in _wavetables:
+        _wavetables[key] = Wavetable(waveform, sampling_rate)
+    return _wavetables[key]
+
+
+class WavetableGenerator(SampleGenerator):
+    """A sample generator that plays a band-limited wavetable."""
+    def __init__(self, freq, waveform, sampling_rate=SAMPLING_RATE):
+        SampleGenerator.__init__(self, sampling_rate)
+        assert waveform in WAVEFORMS
+        self._freq = freq
+        self._table = get_wavetable(waveform, sampling_rate).get_table(freq)
+        # The phase is a fraction of a cycle in 32-bit fixed-point.
+        self._phase = 0
+        self._phase_increment = int(round(freq * (PHASE_MASK + 1) / sampling_rate)) & PHASE_MASK
+
+    def seek(self, time):
+        """Moves the oscillator so that the next sample is the one at time."""
+        self._time = time - self._sample_time
+        self._phase = int(round(time * self._freq * (PHASE_MASK + 1))) & PHASE_MASK
+
+    def _get(self):
+        index = self._phase >> FRAC_BITS
+        frac = (self._phase & FRAC_MASK) / (FRAC_MASK + 1)
+        self._phase = (self._phase + self._phase_increment) & PHASE_MASK
+        return self._table[index] + frac * (self._table[index + 1] - self._table[index])
+
+    def _render(self, num_samples):
+        self._time += self._sample_time * num_samples
+        phases = (self._phase + self._phase_increment * numpy.arange(num_samples, dtype=numpy.uint64)) & PHASE_MASK
+        self._phase = (self._phase + self._phase_increment * num_samples) & PHASE_MASK
+        index = (phases >> FRAC_BITS).astype(numpy.intp)
+        frac = (phases & FRAC_MASK) * (1.0 / (FRAC_MASK + 1))
+        lower = self._table[index]
+        return lower + frac * (self._table[index + 1] - lower)
+
+
+class WavetableSineGenerator(WavetableGenerator):
+    """A wavetable Sine-wave sample generator."""
+    def __init__(self, freq, sampling_rate=SAMPLING_RATE):
+        WavetableGenerator.__init__(self, freq, "sine", sampling_rate)
+
+
+class WavetableSquareGenerator(WavetableGenerator):
+    """A band-limited wavetable Square-wave sample generator."""
+    def __init__(self, freq, sampling_rate=SAMPLING_RATE):
+        WavetableGenerator.__init__(self, freq, "square", sampling_rate)
+
+
+class WavetableSawtoothGenerator(WavetableGenerator):
+    """A band-limited wavetable Sawtooth-wave sample generator."""
+    def __init__(self, freq, sampling_rate=SAMPLING_RATE):
+        WavetableGenerator.__init__(self, freq, "sawtooth", sampling_rate)
@@ -1,12 +1,28 @@
 
-import array
-import wave
+import queue
+import threading
+import time
+import numpy
+from MusicGeneration.sample_generators import SAMPLING_RATE
+from .reader import WaveReader, WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT
+from .writer import WaveWriter
 
 
 MONO = 1
 STEREO = 2
 SAMPLING_16BIT = 2
-SAMPLING_RATE = 44100
+
+INT16 = "int16"
+INT24 = "int24"
+FLOAT32 = "float32"
+# The number of frames that each buffer of a threaded WaveFile holds.
+DEFAULT_BLOCK_SIZE = 4096
+# Maps an output sample format to its WAV format tag and bits per sample.
+OUTPUT_FORMATS = {
+    INT16: (WAVE_FORMAT_PCM, 16),
+    INT24: (WAVE_FORMAT_PCM, 24),
+    FLOAT32: (WAVE_FORMAT_IEEE_FLOAT, 32),
+}
 
 
 def scale_and_clip_data(d, scaling):
@@ -27,31 +43,145 @@ class WaveFile:
       data = [sin(2*pi*x/SAMPLING_RATE*1000) for x in range(SAMPLING_RATE*5)]
       with WaveFile("test_1000Hz.wav") as wave_file:
         wave_file.writeData(data)
+
+    Samples are written as 16-bit integers by default; sample_format can
+    also be INT24, or FLOAT32 which writes the float data as it is, without
+    scaling or clipping (e.g. for intermediate stems).
+
+    The sizes in the header are refreshed every header_interval seconds of
+    audio, so the file can be read while it is being written. Files over
+    4 GB are written as RF64.
+
+    With threaded=True, writeData() copies the data into one of num_buffers
+    buffers of block_size frames, allocated up front, and returns; a
+    background thread converts the buffers to PCM and writes them,
+    overlapping with rendering the next block. A block larger than
+    block_size replaces its buffer with a larger one, which is then reused. writeData() only blocks when every buffer is waiting to be
+    written; queue_depth, stall_time and num_stalls report how often.
     """
 
-    def __init__(self, filename):
-        self._wavefile = wave.open(filename, 'wb')
-        sample_width = SAMPLING_16BIT
-        self._wavefile.setparams((MONO, sample_width, SAMPLING_RATE, 0, "NONE", "not compressed"))
-        self._scaling = 2 ** ((sample_width * 8) - 1)
-        assert self._scaling == 32768
+    def __init__(self, filename, num_channels=MONO, dither=False, threaded=False, num_buffers=2,
+                 block_size=DEFAULT_BLOCK_SIZE, header_interval=1.0, sampling_rate=SAMPLING_RATE, sample_format=INT16):
+        (format_tag, bits_per_sample) = OUTPUT_FORMATS[sample_format]
+        self._num_channels = num_channels
+        self._sample_format = sample_format
+        if header_interval is not None:
+            header_interval = int(header_interval * sampling_rate)
+        self._wavefile = WaveWriter(filename, num_channels, sampling_rate, bits_per_sample,
+                                    format_tag=format_tag, header_interval=header_interval)
+        self._scaling = 2 ** (bits_per_sample - 1)
+        # With dither, triangular (TPDF) noise of +/- 1 LSB is added before
+        # rounding, which turns quantization distortion into a low noise floor.
+        self._random = numpy.random.RandomState(0) if dither and sample_format != FLOAT32 else None
+        self._thread = None
+        self._stall_time = 0.0
+        self._num_stalls = 0
+        self._error = None
+        if threaded:
+            assert num_buffers >= 1
+            self._free_buffers = queue.Queue()
+            for _ in range(num_buffers):
+                self._free_buffers.put(numpy.empty((num_channels, block_size), dtype=self._buffer_dtype()))
+            self._full_buffers = queue.Queue()
+            self._thread = threading.Thread(target=self._write_buffers, name="WaveFile writer", daemon=True)
+            self._thread.start()
 
     def writeData(self, data, correct_nframes=False):
         """Writes the given data to the wave file.
 
-        data should be a list of floats in the range -1.0 .. 1.0
-        Values outside this range will be clipped"""
-        # Hard-coded to use signed-short data-type
+        data should be a list, array('f') or numpy array of floats in the
+        range -1.0 .. 1.0. Values outside this range will be clipped
+        (except in FLOAT32 files).
+        For multichannel files, data should be a planar (channels x frames)
+        numpy array.
+        The data is interleaved, scaled, dithered and clipped in one
+        vectorized pass."""
         assert self._wavefile
-        byte_data = array.array("h", [scale_and_clip_data(d, self._scaling) for d in data])
-        self._wavefile.writeframesraw(byte_data.tobytes())
+        self._check_error()
+        samples = numpy.asarray(data)
+        if samples.ndim == 2:
+            assert samples.shape[0] == self._num_channels
+        else:
+            assert self._num_channels == MONO
+            samples = samples[numpy.newaxis, :]
+        if self._thread is None:
+            self._write(samples, correct_nframes)
+            return
+        try:
+            buffer = self._free_buffers.get_nowait()
+        except queue.Empty:
+            start = time.perf_counter()
+            buffer = self._free_buffers.get()
+            self._stall_time += time.perf_counter() - start
+            self._num_stalls += 1
+        num_frames = samples.shape[1]
+        if buffer.shape[1] < num_frames:
+            buffer = numpy.empty((self._num_channels, num_frames), dtype=self._buffer_dtype())
+        buffer[:, :num_frames] = samples
+        self._full_buffers.put((buffer, num_frames, correct_nframes))
+
+    def _buffer_dtype(self):
+        return numpy.float32 if self._sample_format == FLOAT32 else numpy.float64
+
+    def _write(self, samples, correct_nframes):
+        """Converts planar (channels x frames) samples to PCM and writes them."""
+        if self._sample_format == FLOAT32:
+            # Mono float32 blocks are written without any copy.
+            self._wavefile.write(numpy.ascontiguousarray(samples.T, dtype="<f4"))
+        else:
+            scaled = samples.T * float(self._scaling)
+            if self._random is not None:
+                scaled += self._random.triangular(-1.0, 0.0, 1.0, scaled.shape)
+                numpy.rint(scaled, out=scaled)
+            numpy.clip(scaled, -self._scaling, self._scaling - 1, out=scaled)
+            if self._sample_format == INT16:
+                pcm = scaled.astype("<i2", order="C")
+            else:
+                # Keep the low 3 bytes of each little-endian 32-bit sample.
+                pcm = scaled.astype("<i4", order="C").view(numpy.uint8).reshape(-1, 4)[:, :3].copy()
+            self._wavefile.write(pcm)
         if correct_nframes:
-            # Calling writeframes with no data will ensure the WAV header contains
-            # the correct value for nframes.
-            # Closing _wavefile will also correct nframes in the header, so this
-            # correction is not necessary in general, just conservative, or if you want
-            # to be able to play the WAV file while it's still being written to.
-            self._wavefile.writeframes([])
+            # Ensures the WAV header contains the correct sizes right away.
+            # Closing _wavefile will also correct them, and the header is
+            # refreshed every header_interval anyway, so this is only needed
+            # if you want to play the WAV file while it's still being written to.
+            self._wavefile.update_header()
+
+    def _write_buffers(self):
+        """The writer thread: writes queued buffers until it gets None."""
+        while True:
+            item = self._full_buffers.get()
+            if item is None:
+                return
+            (buffer, num_frames, correct_nframes) = item
+            try:
+                # After an error, nothing more is written, so the file never
+                # has a gap in it.
+                if self._error is None:
+                    self._write(buffer[:, :num_frames], correct_nframes)
+            except Exception as e:
+                # Reported by every later writeData(), and by close().
+                self._error = e
+            self._free_buffers.put(buffer)
+
+    def _check_error(self):
+        if self._error is not None:
+            raise self._error
+
+    @property
+    def queue_depth(self):
+        """The number of blocks waiting to be written by the writer thread."""
+        return self._full_buffers.qsize() if self._thread else 0
+
+    @property
+    def stall_time(self):
+        """Total seconds writeData() spent waiting for a free buffer."""
+        return self._stall_time
+
+    @property
+    def num_stalls(self):
+        """The number of writeData() calls that had to wait for a free buffer."""
+        return self._num_stalls
 
     def __enter__(self):
         return self
@@ -60,8 +190,15 @@ class WaveFile:
         self.close()
 
     def close(self):
+        if self._wavefile is None:
+            return
+        if self._thread is not None:
+            self._full_buffers.put(None)
+            self._thread.join()
+            self._thread = None
         self._wavefile.close()
         self._wavefile = None
+        self._check_error()
 
 
 def test():
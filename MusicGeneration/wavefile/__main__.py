@@ -0,0 +1,6 @@
+"""WAV file input and output. Run with: python -m MusicGeneration.wavefile"""
+
+from .unit_tests import *
+
+print("Running main 'wavefile' code")
+main()
@@ -0,0 +1,218 @@
+"""Memory-mapped WAV file reader."""
+
+import mmap
+import struct
+import numpy
+
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# Maps (format tag, bits per sample) to the numpy dtype of one sample, the
+# value that a full-scale sample is divided by to give -1.0 .. 1.0, and the
+# offset of the zero level (8-bit WAV samples are unsigned).
+# 24-bit samples have no numpy dtype, so they are stored as 3 bytes and
+# converted in read().
+SAMPLE_FORMATS = {
+    (WAVE_FORMAT_PCM, 8): ("u1", 2.0 ** 7, 128),
+    (WAVE_FORMAT_PCM, 16): ("<i2", 2.0 ** 15, 0),
+    (WAVE_FORMAT_PCM, 24): ("u1", 2.0 ** 23, 0),
+    (WAVE_FORMAT_PCM, 32): ("<i4", 2.0 ** 31, 0),
+    (WAVE_FORMAT_IEEE_FLOAT, 32): ("<f4", 1.0, 0),
+    (WAVE_FORMAT_IEEE_FLOAT, 64): ("<f8", 1.0, 0),
+}
+
+
+class WaveReader:
+    """Reads WAV files through a memory map, without copying the file.
+
+    The RIFF header is parsed once. The sample data is exposed as a numpy
+    view over the mapped file (frames x channels), and samples are only
+    converted to floats for the frames and channel that are asked for.
+
+      with WaveReader("drum.wav") as reader:
+        left = reader.read(0, 1000, channel=0)
+    """
+    def __init__(self, filename):
+        self._filename = filename
+        # The map keeps its own handle on the file, so the file can be closed
+        # straight away.
+        with open(filename, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._parse_header()
+        except (ValueError, struct.error, OSError) as error:
+            self._mmap.close()
+            raise ValueError("%s: cannot read the WAV header (%s)" % (filename, error)) from error
+        (dtype, self._scaling, self._zero) = SAMPLE_FORMATS[(self._format_tag, self._bits_per_sample)]
+        sample_width = self._bits_per_sample // 8
+        frame_size = self._num_channels * sample_width
+        # The data size may be wrong (e.g. a file still being written), so
+        # never read beyond the end of the file.
+        data_size = min(self._data_size, len(self._mmap) - self._data_offset)
+        self._num_frames = data_size // frame_size
+        self._frames = numpy.frombuffer(self._mmap, dtype=dtype, offset=self._data_offset,
+                                        count=self._num_frames * frame_size // numpy.dtype(dtype).itemsize)
+        if self._bits_per_sample == 24:
+            self._frames = self._frames.reshape(self._num_frames, self._num_channels, 3)
+        else:
+            self._frames = self._frames.reshape(self._num_frames, self._num_channels)
+
+    def _parse_header(self):
+        (riff, _, wave) = struct.unpack_from("<4sI4s", self._mmap, 0)
+        if riff not in (b"RIFF", b"RF64") or wave != b"WAVE":
+            raise ValueError("%s is not a WAV file" % self._filename)
+        offset = 12
+        self._data_offset = None
+        ds64_data_size = None
+        while offset + 8 <= len(self._mmap):
+            (chunk_id, chunk_size) = struct.unpack_from("<4sI", self._mmap, offset)
+            if chunk_id == b"ds64":
+                # RF64 files keep the 64-bit data size here.
+                (_, ds64_data_size) = struct.unpack_from("<QQ", self._mmap, offset + 8)
+            elif chunk_id == b"fmt ":
+                (self._format_tag, self._num_channels, self._sampling_rate, _, _,
+                 self._bits_per_sample) = struct.unpack_from("<HHIIHH", self._mmap, offset + 8)
+                if self._format_tag == WAVE_FORMAT_EXTENSIBLE:
+                    # The real format tag is the start of the sub-format GUID.
+                    (self._format_tag,) = struct.unpack_from("<H", self._mmap, offset + 8 + 24)
+            elif chunk_id == b"data":
+                self._data_offset = offset + 8
+                self._data_size = chunk_size
+                if riff == b"RF64" and chunk_size == 0xFFFFFFFF and ds64_data_size is not None:
+                    self._data_size = ds64_data_size
+                break
+            # Chunks are padded to an even number of bytes.
+            offset += 8 + chunk_size + (chunk_size % 2)
+        if self._data_offset is None:
+            raise ValueError("%s has no data chunk" % self._filename)
+        if (self._format_tag, self._bits_per_sample) not in SAMPLE_FORMATS:
+            raise ValueError("%s: unsupported sample format %d (%d bits)" % (
+                self._filename, self._format_tag, self._bits_per_sample))
+
+    @property
+    def num_channels(self): return self._num_channels
+
+    @property
+    def sampling_rate(self): return self._sampling_rate
+
+    @property
+    def num_frames(self): return self._num_frames
+
+    @property
+    def bits_per_sample(self): return self._bits_per_sample
+
+    @property
+    def frames(self):
+        """The raw samples, as a read-only (frames x channels) view of the file.
+
+        For 24-bit files the view is (frames x channels x 3) bytes.
+        """
+        return self._frames
+
+    def read(self, start, num_frames, channel=None):
+        """Returns float32 samples for frames start .. start+num_frames.
+
+        If channel is given, a 1-D array of that channel is returned.
+        Otherwise a planar (channels x frames) array is returned, of all
+        channels or of the channels in channel if it is a slice.
+        """
+        frames = self._frames[start:start + num_frames]
+        if isinstance(channel, slice):
+            frames = numpy.moveaxis(frames[:, channel], 1, 0)
+        elif channel is not None:
+            frames = frames[:, channel]
+        else:
+            frames = numpy.moveaxis(frames, 1, 0)
+        if self._bits_per_sample == 24:
+            # Assemble little-endian 3-byte samples, sign-extending the top byte.
+            frames = (frames[..., 0].astype(numpy.int32) | (frames[..., 1].astype(numpy.int32) << 8) |
+                      (frames[..., 2].view(numpy.int8).astype(numpy.int32) << 16))
+        elif self._zero:
+            frames = frames.astype(numpy.int32) - self._zero
+        if self._scaling == 1.0:
+            # Always copy, so that the result outlives the memory map.
+            return numpy.array(frames, dtype=numpy.float32)
+        if frames.dtype == numpy.int16:
+            data = frames * numpy.float32(1.0 / self._scaling)
+        else:
+            data = (frames * (1.0 / self._scaling)).astype(numpy.float32)
+        return numpy.ascontiguousarray(data)
+
+    def float_view(self):
+        """Returns all samples as a planar (channels x frames) float32 array.
+
+        For float32 files this is a read-only view of the mapped file, with
+        no conversion or copy; it must be released before the reader is
+        closed. Other formats are converted, as by read().
+        """
+        if self._format_tag == WAVE_FORMAT_IEEE_FLOAT and self._bits_per_sample == 32:
+            return self._frames.T
+        return self.read(0, self._num_frames)
+
+    def channel(self, channel):
+        """Returns a sliceable view of one channel, converted on demand."""
+        return WaveChannelView(self, channel)
+
+    def channels(self):
+        """Returns a sliceable planar (channels x frames) view of all channels,
+        converted on demand."""
+        return WaveChannelView(self)
+
+    def close(self):
+        # The views must be released before the map can be closed.
+        self._frames = None
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+class WaveChannelView:
+    """One channel (or several channels, as channels x frames) of a
+    WaveReader, which can be indexed and sliced like a numpy array along the
+    frame axis, e.g. view[100:200] or view[..., 100:200]. Slicing the channel
+    axis of a planar view, e.g. view[:2], gives a view of fewer channels.
+    Samples are converted to floats only when they are accessed."""
+    def __init__(self, reader, channel=None):
+        if channel is None:
+            channel = slice(0, reader.num_channels)
+        if isinstance(channel, slice):
+            # Planar views keep their channels as a slice with explicit bounds.
+            channel = slice(*channel.indices(reader.num_channels))
+        else:
+            assert 0 <= channel < reader.num_channels
+        self._reader = reader
+        self._channel = channel
+
+    @property
+    def shape(self):
+        if isinstance(self._channel, slice):
+            return (len(range(self._channel.start, self._channel.stop, self._channel.step)),
+                    self._reader.num_frames)
+        return (self._reader.num_frames,)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        if isinstance(index, tuple):
+            assert len(index) == 2 and index[0] is Ellipsis
+            index = index[1]
+        elif isinstance(self._channel, slice):
+            # Without an Ellipsis, the first axis of a planar view is the channel.
+            channels = range(self._channel.start, self._channel.stop, self._channel.step)[index]
+            if isinstance(index, slice):
+                assert channels.step > 0
+                return WaveChannelView(self._reader, slice(channels.start, channels.stop, channels.step))
+            return self._reader.channel(channels)
+        if isinstance(index, slice):
+            (start, stop, step) = index.indices(self._reader.num_frames)
+            assert step == 1
+            return self._reader.read(start, max(0, stop - start), self._channel)
+        data = self._reader.read(index, 1, self._channel)[..., 0]
+        return data if isinstance(self._channel, slice) else float(data)
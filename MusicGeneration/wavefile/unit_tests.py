@@ -0,0 +1,306 @@
+"""Unit tests for WAV file input and output."""
+
+import array
+import os
+import shutil
+import struct
+import tempfile
+import time
+import unittest
+import wave
+import numpy
+
+from . import *
+from . import writer
+
+
+DRUMS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "wav_data", "drums")
+
+
+def write_test_file(filename, samples, num_channels=1, sampling_rate=SAMPLING_RATE):
+    """Writes interleaved int16 samples with the standard library wave module."""
+    wf = wave.open(filename, 'wb')
+    wf.setparams((num_channels, 2, sampling_rate, 0, "NONE", "not compressed"))
+    wf.writeframes(numpy.asarray(samples, dtype="<i2").tobytes())
+    wf.close()
+
+
+def write_raw_test_file(filename, data, format_tag, bits_per_sample, num_channels=1,
+                        sampling_rate=SAMPLING_RATE, extensible=False):
+    """Writes already-encoded sample bytes behind a hand-made RIFF header."""
+    block_align = num_channels * bits_per_sample // 8
+    fmt = struct.pack("<HHIIHH", 0xFFFE if extensible else format_tag, num_channels, sampling_rate,
+                      sampling_rate * block_align, block_align, bits_per_sample)
+    if extensible:
+        fmt += struct.pack("<HHIH14s", 22, bits_per_sample, 0, format_tag,
+                           b"\x00\x00\x00\x00\x10\x00\x80\x00\x00\xaa\x00\x38\x9b\x71")
+    chunks = b"fmt " + struct.pack("<I", len(fmt)) + fmt + b"data" + struct.pack("<I", len(data)) + data
+    with open(filename, "wb") as f:
+        f.write(b"RIFF" + struct.pack("<I", 4 + len(chunks)) + b"WAVE" + chunks)
+
+
+class TestWaveReader(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_read_drum_sample(self):
+        filename = os.path.join(DRUMS_DIR, "DR1-0.WAV")
+        wf = wave.open(filename, 'rb')
+        expected = numpy.frombuffer(wf.readframes(wf.getnframes()), dtype="<i2")[::2] / 32768.0
+        wf.close()
+        with WaveReader(filename) as reader:
+            self.assertEqual(reader.num_channels, 2)
+            self.assertEqual(reader.sampling_rate, SAMPLING_RATE)
+            self.assertEqual(reader.num_frames, len(expected))
+            # The frames are a view of the mapped file, not a copy.
+            self.assertFalse(reader.frames.flags.owndata)
+            data = reader.read(0, reader.num_frames, channel=0)
+            self.assertEqual(data.dtype, numpy.float32)
+            self.assertEqual(data.tolist(), expected.tolist())
+            self.assertEqual(reader.read(10, 5).shape, (2, 5))
+
+    def test_read_stereo(self):
+        filename = os.path.join(self._dir, "stereo.wav")
+        write_test_file(filename, [16384, -16384, 8192, 0, -32768, 32767], num_channels=2)
+        with WaveReader(filename) as reader:
+            self.assertEqual((reader.num_channels, reader.num_frames), (2, 3))
+            self.assertEqual(reader.read(0, 3).tolist(), [[0.5, 0.25, -1.0], [-0.5, 0.0, 32767 / 32768.0]])
+            self.assertEqual(reader.read(1, 10, channel=1).tolist(), [0.0, 32767 / 32768.0])
+            right = reader.channel(1)
+            self.assertEqual(len(right), 3)
+            self.assertEqual(right[0], -0.5)
+            self.assertEqual(right[1:].tolist(), [0.0, 32767 / 32768.0])
+            self.assertEqual(len(right[5:8]), 0)
+            channels = reader.channels()
+            self.assertEqual(channels.shape, (2, 3))
+            self.assertEqual(channels[1:].shape, (1, 3))
+            self.assertEqual(channels[1:][..., 1:].tolist(), [[0.0, 32767 / 32768.0]])
+            self.assertEqual(channels[:1][0][:].tolist(), [0.5, 0.25, -1.0])
+            self.assertEqual(channels[..., 2].tolist(), [-1.0, 32767 / 32768.0])
+
+    def test_sample_formats(self):
+        expected = [0.0, 0.5, -0.5, -1.0]
+        encodings = [
+            (1, 8, bytes([128, 192, 64, 0])),
+            (1, 16, numpy.array([0, 16384, -16384, -32768], dtype="<i2").tobytes()),
+            (1, 24, b"\x00\x00\x00" + b"\x00\x00\x40" + b"\x00\x00\xc0" + b"\x00\x00\x80"),
+            (1, 32, numpy.array([0, 2 ** 30, -2 ** 30, -2 ** 31], dtype="<i4").tobytes()),
+            (3, 32, numpy.array(expected, dtype="<f4").tobytes()),
+            (3, 64, numpy.array(expected, dtype="<f8").tobytes()),
+        ]
+        for extensible in [False, True]:
+            for (format_tag, bits_per_sample, data) in encodings:
+                filename = os.path.join(self._dir, "test_%d_%d.wav" % (format_tag, bits_per_sample))
+                write_raw_test_file(filename, data, format_tag, bits_per_sample, sampling_rate=22050,
+                                    extensible=extensible)
+                with WaveReader(filename) as reader:
+                    self.assertEqual(reader.bits_per_sample, bits_per_sample)
+                    self.assertEqual(reader.sampling_rate, 22050)
+                    self.assertEqual(reader.num_frames, 4)
+                    data = reader.read(0, 4, channel=0)
+                    self.assertEqual(data.dtype, numpy.float32)
+                    self.assertEqual(data.tolist(), expected, msg=filename)
+
+    def test_24bit_stereo(self):
+        filename = os.path.join(self._dir, "stereo24.wav")
+        data = b"\x00\x00\x40" + b"\xff\xff\xff" + b"\x00\x00\x80" + b"\x01\x00\x00"
+        write_raw_test_file(filename, data, 1, 24, num_channels=2)
+        with WaveReader(filename) as reader:
+            self.assertEqual(reader.frames.shape, (2, 2, 3))
+            self.assertEqual(reader.read(0, 2).tolist(), [[0.5, -1.0], [-2.0 ** -23, 2.0 ** -23]])
+
+    def test_not_a_wave_file(self):
+        filename = os.path.join(self._dir, "junk.wav")
+        with open(filename, "wb") as f:
+            f.write(b"not a wave file at all")
+        self.assertRaises(ValueError, WaveReader, filename)
+        # A truncated header is reported the same way, with the cause kept.
+        with open(filename, "wb") as f:
+            f.write(b"RIFF")
+        with self.assertRaises(ValueError) as context:
+            WaveReader(filename)
+        self.assertIsInstance(context.exception.__cause__, struct.error)
+
+
+class TestWaveFile(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_write_stereo(self):
+        filename = os.path.join(self._dir, "stereo.wav")
+        data = numpy.array([[0.0, 0.5, -1.0, 2.0], [-0.5, 0.25, 1.0, -2.0]])
+        with WaveFile(filename, num_channels=STEREO) as wave_file:
+            wave_file.writeData(data)
+        with WaveReader(filename) as reader:
+            self.assertEqual(reader.num_channels, 2)
+            self.assertEqual(reader.frames.tolist(), [[0, -16384], [16384, 8192], [-32768, 32767], [32767, -32768]])
+
+    def test_write_mono_inputs(self):
+        values = [0.0, 0.5, -0.25, 0.99999, -1.0, 1.5, -1.5, 0.3]
+        expected = [scale_and_clip_data(v, 32768) for v in values]
+        for data in [values, array.array("f", values), numpy.array(values, dtype=numpy.float32)]:
+            filename = os.path.join(self._dir, "mono.wav")
+            with WaveFile(filename) as wave_file:
+                wave_file.writeData(data)
+            with WaveReader(filename) as reader:
+                self.assertEqual(reader.frames[:, 0].tolist(), expected)
+
+    def test_write_dither(self):
+        filename = os.path.join(self._dir, "dither.wav")
+        data = numpy.linspace(-0.5, 0.5, 10000)
+        with WaveFile(filename, dither=True) as wave_file:
+            wave_file.writeData(data)
+        with WaveReader(filename) as reader:
+            error = reader.frames[:, 0] - data * 32768
+        # Triangular dither never moves a sample by more than 1 LSB
+        # (plus 0.5 LSB of rounding), and has no DC offset.
+        self.assertLessEqual(numpy.abs(error).max(), 1.5)
+        self.assertGreater(numpy.abs(error).max(), 0.5)
+        self.assertAlmostEqual(error.mean(), 0.0, places=1)
+
+    def test_threaded_writer(self):
+        blocks = [numpy.sin(numpy.arange(n) * 0.01 * (k + 1)) for (k, n) in enumerate([1000, 5000, 10, 3000, 7000])]
+        filenames = [os.path.join(self._dir, name) for name in ["direct.wav", "threaded.wav"]]
+        with WaveFile(filenames[0]) as wave_file:
+            for block in blocks:
+                wave_file.writeData(block)
+        with WaveFile(filenames[1], threaded=True, num_buffers=2) as wave_file:
+            for block in blocks:
+                wave_file.writeData(block)
+                # The block is copied, so it can be reused straight away.
+                block[:] = 0.0
+                self.assertLessEqual(wave_file.queue_depth, 2)
+        self.assertGreaterEqual(wave_file.stall_time, 0.0)
+        self.assertGreaterEqual(wave_file.num_stalls, 0)
+        with WaveReader(filenames[0]) as expected, WaveReader(filenames[1]) as reader:
+            self.assertEqual(reader.num_frames, 16010)
+            self.assertEqual(reader.frames.tolist(), expected.frames.tolist())
+
+    def test_threaded_writer_reuses_buffers(self):
+        filename = os.path.join(self._dir, "reused.wav")
+        with WaveFile(filename, threaded=True, num_buffers=2, block_size=1000) as wave_file:
+            buffers = list(wave_file._free_buffers.queue)
+            self.assertEqual([buffer.shape for buffer in buffers], [(1, 1000), (1, 1000)])
+            for num_frames in [1000, 10, 500, 1000]:
+                wave_file.writeData(numpy.full(num_frames, 0.5))
+        # Blocks that fit are copied into the buffers allocated up front.
+        self.assertEqual(sorted(map(id, wave_file._free_buffers.queue)), sorted(map(id, buffers)))
+        with WaveReader(filename) as reader:
+            self.assertEqual(reader.num_frames, 2510)
+
+    def test_threaded_writer_error(self):
+        filename = os.path.join(self._dir, "error.wav")
+        wave_file = WaveFile(filename, threaded=True)
+        # Writing is deferred, so a failure is reported later on.
+        wave_file._wavefile.close()
+        wave_file.writeData([0.5])
+        self.assertRaises(Exception, wave_file.close)
+
+    def test_threaded_writer_stops_after_error(self):
+        filename = os.path.join(self._dir, "gap.wav")
+        wave_file = WaveFile(filename, threaded=True)
+        write = wave_file._wavefile.write
+        calls = []
+        def fail_once(data):
+            calls.append(len(calls))
+            if len(calls) == 2:
+                raise IOError("disk full")
+            write(data)
+        wave_file._wavefile.write = fail_once
+        wave_file.writeData(numpy.full(100, 0.5))
+        wave_file.writeData(numpy.full(100, 0.25))
+        while wave_file._error is None:
+            time.sleep(0.001)
+        # Every later block is refused, rather than written after a gap.
+        self.assertRaises(IOError, wave_file.writeData, numpy.full(100, 0.125))
+        self.assertRaises(IOError, wave_file.writeData, numpy.full(100, 0.125))
+        self.assertRaises(IOError, wave_file.close)
+        wave_file.close()
+        self.assertEqual(len(calls), 2)
+        with WaveReader(filename) as reader:
+            self.assertEqual(reader.num_frames, 100)
+
+    def test_header_refresh(self):
+        filename = os.path.join(self._dir, "growing.wav")
+        with WaveFile(filename, header_interval=0.01) as wave_file:
+            wave_file.writeData(numpy.zeros(1000))
+            # The header is patched while the file is still open.
+            with WaveReader(filename) as reader:
+                self.assertEqual(reader.num_frames, 1000)
+            wave_file.writeData(numpy.zeros(10))
+        # The standard library reader skips the reserved JUNK chunk.
+        wf = wave.open(filename, 'rb')
+        self.assertEqual(wf.getnframes(), 1010)
+        wf.close()
+
+    def test_unclosed_writer(self):
+        filename = os.path.join(self._dir, "unclosed.wav")
+        wave_writer = writer.WaveWriter(filename, 1, SAMPLING_RATE, 16)
+        wave_writer.write(numpy.zeros(999, dtype="<i2"))
+        # The header is only written when the writer is collected.
+        del wave_writer
+        wf = wave.open(filename, 'rb')
+        self.assertEqual(wf.getnframes(), 999)
+        wf.close()
+        self.assertEqual(os.path.getsize(filename), writer.HEADER_SIZE + 999 * 2)
+
+    def test_rf64(self):
+        filename = os.path.join(self._dir, "big.wav")
+        data = numpy.linspace(-1.0, 1.0, 5000)
+        riff_size_limit = writer.RIFF_SIZE_LIMIT
+        # Pretend that 4 GB is only a few thousand bytes.
+        writer.RIFF_SIZE_LIMIT = 6000
+        try:
+            with WaveFile(filename) as wave_file:
+                wave_file.writeData(data[:2000])
+                self.assertFalse(wave_file._wavefile.is_rf64)
+                wave_file.writeData(data[2000:])
+                self.assertTrue(wave_file._wavefile.is_rf64)
+        finally:
+            writer.RIFF_SIZE_LIMIT = riff_size_limit
+        with open(filename, "rb") as f:
+            self.assertEqual(f.read(4), b"RF64")
+        with WaveReader(filename) as reader:
+            self.assertEqual(reader.num_frames, 5000)
+            self.assertEqual(reader.frames[:, 0].tolist(), [scale_and_clip_data(d, 32768) for d in data])
+
+    def test_sample_formats(self):
+        data = numpy.array([[0.0, 0.5, -1.0, 1.5], [-0.5, 0.25, 1.0, -2.0]], dtype=numpy.float32)
+        expected = {
+            INT16: [[0.0, 0.5, -1.0, 32767 / 32768], [-0.5, 0.25, 32767 / 32768, -1.0]],
+            INT24: [[0.0, 0.5, -1.0, (2 ** 23 - 1) / 2 ** 23], [-0.5, 0.25, (2 ** 23 - 1) / 2 ** 23, -1.0]],
+            # Float files are neither scaled nor clipped.
+            FLOAT32: data.tolist(),
+        }
+        for sample_format in OUTPUT_FORMATS:
+            filename = os.path.join(self._dir, "%s.wav" % sample_format)
+            with WaveFile(filename, num_channels=STEREO, sampling_rate=48000, sample_format=sample_format) as wave_file:
+                wave_file.writeData(data)
+            with WaveReader(filename) as reader:
+                self.assertEqual(reader.sampling_rate, 48000)
+                self.assertEqual(reader.bits_per_sample, OUTPUT_FORMATS[sample_format][1])
+                numpy.testing.assert_allclose(reader.read(0, 4), expected[sample_format], rtol=1e-6)
+
+    def test_float_view(self):
+        filename = os.path.join(self._dir, "float.wav")
+        data = numpy.linspace(-2.0, 2.0, 1000, dtype=numpy.float32)
+        with WaveFile(filename, sample_format=FLOAT32) as wave_file:
+            wave_file.writeData(data)
+        reader = WaveReader(filename)
+        view = reader.float_view()
+        self.assertEqual(view.shape, (1, 1000))
+        self.assertFalse(view.flags.owndata)
+        self.assertFalse(view.flags.writeable)
+        self.assertEqual(view[0].tolist(), data.tolist())
+        del view
+        reader.close()
+
+
+def main():
+    unittest.main()
@@ -0,0 +1,107 @@
+"""Streaming WAV file writer, switching to RF64 for files over 4 GB."""
+
+import struct
+from .reader import WAVE_FORMAT_PCM
+
+
+# The largest size that fits in a 32-bit RIFF chunk size field. Files whose
+# RIFF size would be larger are written as RF64 (EBU Tech 3306) instead.
+RIFF_SIZE_LIMIT = 2 ** 32 - 1
+# The ds64 chunk body: RIFF size, data size and sample count (64 bits each),
+# and an empty table of other chunk sizes. Until the file needs it, the
+# space is reserved with a JUNK chunk of the same size.
+DS64_SIZE = 28
+FMT_SIZE = 16
+HEADER_SIZE = 12 + (8 + DS64_SIZE) + (8 + FMT_SIZE) + 8
+
+
+class WaveWriter:
+    """Writes raw sample data to a WAV file, keeping its header up to date.
+
+    The header is written as a placeholder when the file is opened, and the
+    sizes in it are patched every header_interval frames (if given), on
+    update_header() and on close(), so that other programs can read the file
+    while it is still being written. Once the data no longer fits in a RIFF
+    file, the header is rewritten as RF64.
+    """
+    def __init__(self, filename, num_channels, sampling_rate, bits_per_sample,
+                 format_tag=WAVE_FORMAT_PCM, header_interval=None):
+        self._file = open(filename, 'wb')
+        self._num_channels = num_channels
+        self._sampling_rate = sampling_rate
+        self._bits_per_sample = bits_per_sample
+        self._format_tag = format_tag
+        self._frame_size = num_channels * bits_per_sample // 8
+        self._header_interval = header_interval
+        self._data_size = 0
+        self._frames_since_update = 0
+        self._update_header()
+
+    @property
+    def num_frames(self):
+        return self._data_size // self._frame_size
+
+    @property
+    def is_rf64(self):
+        return self._riff_size() > RIFF_SIZE_LIMIT
+
+    def _riff_size(self):
+        return HEADER_SIZE - 8 + self._data_size + (self._data_size % 2)
+
+    def _update_header(self):
+        riff_size = self._riff_size()
+        if riff_size > RIFF_SIZE_LIMIT:
+            header = struct.pack("<4sI4s4sIQQQI", b"RF64", 0xFFFFFFFF, b"WAVE", b"ds64", DS64_SIZE,
+                                 riff_size, self._data_size, self.num_frames, 0)
+            data_size = 0xFFFFFFFF
+        else:
+            header = struct.pack("<4sI4s4sI", b"RIFF", riff_size, b"WAVE", b"JUNK", DS64_SIZE)
+            header += bytes(DS64_SIZE)
+            data_size = self._data_size
+        header += struct.pack("<4sIHHIIHH", b"fmt ", FMT_SIZE, self._format_tag, self._num_channels,
+                              self._sampling_rate, self._sampling_rate * self._frame_size,
+                              self._frame_size, self._bits_per_sample)
+        header += struct.pack("<4sI", b"data", data_size)
+        assert len(header) == HEADER_SIZE
+        position = self._file.tell()
+        self._file.seek(0)
+        self._file.write(header)
+        self._file.seek(max(position, HEADER_SIZE))
+        self._frames_since_update = 0
+
+    def write(self, data):
+        """Appends raw interleaved frames (any bytes-like object)."""
+        data = memoryview(data).cast("B")
+        assert len(data) % self._frame_size == 0
+        self._file.write(data)
+        self._data_size += len(data)
+        self._frames_since_update += len(data) // self._frame_size
+        if self._header_interval is not None and self._frames_since_update >= self._header_interval:
+            self.update_header()
+
+    def update_header(self):
+        """Writes the current sizes to the header and flushes the file."""
+        self._update_header()
+        self._file.flush()
+
+    def close(self):
+        if self._file is None:
+            return
+        if self._data_size % 2:
+            # Chunks are padded to an even number of bytes.
+            self._file.write(b"\x00")
+        self._update_header()
+        self._file.close()
+        self._file = None
+
+    def __del__(self):
+        # Like wave.Wave_write, a writer that is never closed still leaves a
+        # complete file. __init__ may have failed before opening the file.
+        if getattr(self, "_file", None) is not None:
+            self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()